@@ -379,7 +379,7 @@ def listdir(Lochness, d):
 
 
 def attempt(f, Lochness, *args, **kwargs):
-    '''attempt a function call'''
+    '''attempt a function call, returning True if it raised no exception'''
 
     '''
     if len(attempt.warnings) >= 5:
@@ -394,6 +394,9 @@ def attempt(f, Lochness, *args, **kwargs):
         logger.warn(e)
         logger.debug(tb.format_exc().strip())
         attempt.warnings.append(str(e))
+        return False
+
+    return True
 
 
 attempt.warnings = []
@@ -437,9 +440,9 @@ def crc32(content, encoding='utf-8'):
     return _crc32bin(io.BytesIO(content))
 
 
-def crc32file(f):
+def crc32file(f, buffersize=1024*1024):
     with open(f, 'rb') as fo:
-        return _crc32bin(fo)
+        return _crc32bin(fo, buffersize=buffersize)
 
 
 def _crc32bin(content, buffersize=4096):
@@ -14,10 +14,14 @@ from io import BytesIO
 import lochness.keyring as keyring
 import lochness.net as net
 import lochness.tree as tree
+import lochness.state as state
+import lochness.ratelimit as ratelimit
 from os.path import join, basename
 logging.getLogger('boxsdk').setLevel(logging.CRITICAL)
 from boxsdk import Client, OAuth2
 from boxsdk.exception import BoxOAuthException
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import AuthorizedSession
 import cryptease as enc
 import re
 import requests
@@ -48,6 +52,20 @@ def base(Lochness, module_name):
                    .get('base', '')
 
 
+class RateLimitedNetwork(DefaultNetwork):
+    '''Box network layer sending every API request through a rate limiter,
+    with the socket timeouts of lochness.net'''
+    def __init__(self, limiter: ratelimit.Limiter):
+        super(RateLimitedNetwork, self).__init__()
+        self._limiter = limiter
+
+    def request(self, method, url, access_token, **kwargs):
+        kwargs['timeout'] = net.request_timeout(kwargs.get('timeout'))
+        with self._limiter:
+            return super(RateLimitedNetwork, self).request(
+                    method, url, access_token, **kwargs)
+
+
 class TokenAccessError(Exception):
     pass
 
@@ -62,13 +80,15 @@ class TokenRefreshMissingError(Exception):
 
 def get_access_token(client_id: str,
                      client_secret: str,
-                     enterprise_id: str) -> str:
+                     enterprise_id: str,
+                     alias: str = None) -> str:
     '''Get new access token using Box API
 
     Key Argument:
         client_id: Client ID from the box app from box dev console, str
         client_secret: Client secret from the box app from box dev console, str
         enterprise_id: user id from the box app from box dev console, str of digits.
+        alias: Box keyring alias used for rate limiting, str.
 
     Returns:
         api_token: API TOKEN used to pull data, str.
@@ -85,7 +105,8 @@ def get_access_token(client_id: str,
             "box_subject_type": "enterprise",
             "box_subject_id": enterprise_id}
 
-    response = requests.post(url, headers=headers, data=data)
+    with ratelimit.get(alias):
+        response = requests.post(url, headers=headers, data=data)
 
     try:
         api_token = response.json()['access_token']
@@ -286,8 +307,16 @@ def save(Lochness: 'lochness',
          box_path_tuple: Tuple[str, str],
          out_base: str,
          key=None,
-         compress=False, delete=False, dry=False):
-    '''save a box file to an output directory'''
+         compress=False, delete=False, dry=False,
+         subject_id: str = None):
+    '''Save a box file to an output directory
+
+    When subject_id is given, the Box file id and sha1 are looked up in the
+    state store first. A file with the same sha1 as the last download is
+    skipped while the downloaded file is still there, and a file which has
+    changed on Box since, or whose download was moved or removed, is
+    downloaded again.
+    '''
     # file path
     box_path_root, box_path_name = box_path_tuple
     box_fullpath = os.path.join(box_path_root, box_path_name)
@@ -299,7 +328,17 @@ def save(Lochness: 'lochness',
     # local path
     local_fullfile = os.path.join(out_base, box_path_name + ext)
 
-    if os.path.exists(local_fullfile):
+    store = state.get(Lochness) if subject_id else None
+    record = store.get('box', subject_id, box_file_object.id) \
+        if store else None
+    if record is not None:
+        if record.remote_version == box_file_object.sha1 and \
+                os.path.exists(local_fullfile):
+            return
+    elif os.path.exists(local_fullfile):
+        if store:
+            store.put('box', subject_id, box_file_object.id,
+                      remote_version=box_file_object.sha1)
         return
     local_dirname = os.path.dirname(local_fullfile)
     if not os.path.exists(local_dirname):
@@ -311,6 +350,10 @@ def save(Lochness: 'lochness',
             if is_transferred_and_removed(Lochness, local_fullfile):
                 return
             _save(box_file_object, box_fullpath, local_fullfile, key, compress)
+            if store:
+                store.put('box', subject_id, box_file_object.id,
+                          remote_version=box_file_object.sha1,
+                          local_path=local_fullfile)
             if delete:
                 logger.debug(f'deleting file on box {box_fullpath}')
                 _delete(box_file_object, box_fullpath)
@@ -465,7 +508,8 @@ def sync_module(Lochness: 'lochness.config',
         try:
             api_token = get_access_token(client_id,
                                          client_secret,
-                                         enterprise_id)
+                                         enterprise_id,
+                                         alias=module_name)
         # error get_access_token may occur when your box app is not authorized
         except TokenAccessError as err:
             refresh_token_path = Path(Lochness['keyring_file']).parent / \
@@ -480,7 +524,11 @@ def sync_module(Lochness: 'lochness.config',
             client_secret=client_secret,
             access_token=api_token,
         )
-        client = Client(auth)
+        # all Box API calls made by the client share the rate limit of the
+        # keyring alias
+        network = RateLimitedNetwork(ratelimit.get(module_name))
+        client = Client(auth, session=AuthorizedSession(
+            auth, network_layer=network))
 
         # check if the login details are correct
         try:
@@ -592,7 +640,7 @@ def sync_module(Lochness: 'lochness.config',
                              (root, box_file_object.name),
                              output_dir_full, key=key,
                              compress=compress, delete=False,
-                             dry=False)
+                             dry=False, subject_id=subject.id)
 
 
 def _find_product(s, product, **kwargs):
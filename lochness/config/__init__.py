@@ -5,6 +5,8 @@ import yaml.reader
 import getpass as gp
 import cryptease as crypt
 import string
+import lochness.ratelimit as ratelimit
+import lochness.net as net
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +50,12 @@ def load(f: 'location', archive_base=None):
         except yaml.reader.ReaderError:
             raise KeyringError('could not decrypt keyring {0} (wrong passphrase?)'.format(Lochness['keyring_file']))
 
+    # per keyring alias request rate and in-flight limits
+    ratelimit.configure(Lochness)
+
+    # pooled HTTP sessions and timeouts
+    net.configure(Lochness)
+
     return Lochness
 
 
@@ -4,11 +4,14 @@ import lochness
 import logging
 import zipfile
 import shutil
+import subprocess
 from pathlib import Path
 import tempfile as tf
 import collections as col
 import lochness.net as net
+import lochness.deadline as deadline
 import lochness.tree as tree
+import lochness.state as state
 from datetime import datetime
 import json
 from typing import List
@@ -42,7 +45,8 @@ def daris_download(daris_uid: str, latest_pull_mtime: float,
                    f'--data-urlencode "filter={curl_filter}" ' \
                    f'"{url}/daris/dicom.mfjp"'
 
-    os.popen(curl_command).read()
+    # curl is killed if it outlives the deadline of the sync
+    deadline.run(curl_command, stdout=subprocess.PIPE)
 
 
 def collect_all_daris_metadata(daris_pull_dir: Path,
@@ -78,6 +82,7 @@ def sync(Lochness, subject, dry=False):
         url = Keyring['URL']
         project_cid = Keyring['PROJECT_CID']
 
+        store = state.get(Lochness)
         for daris_uid in daris_uids:
             dirname = tree.get('mri',
                                subject.protected_folder,
@@ -94,7 +99,10 @@ def sync(Lochness, subject, dry=False):
 
             # load the time of the lastest data pull from daris
             # estimated from the mtime of the zip file downloaded
-            if Path(timestamp_loc).is_file():
+            record = store.get('daris', subject.id, daris_uid)
+            if record is not None:
+                latest_pull_mtime = float(record.remote_version)
+            elif Path(timestamp_loc).is_file():
                 latest_pull_mtime = load_latest_pull_timestamp(timestamp_loc)
             else:
                 latest_pull_mtime = 0
@@ -124,6 +132,8 @@ def sync(Lochness, subject, dry=False):
                 if any([x > 1 for x in nfiles_in_dirs]):
                     logger.info(f'New MRI file downloaded for {daris_uid}')
                     save_latest_pull_timestamp(dst_zipfile, timestamp_loc)
+                    store.put('daris', subject.id, daris_uid,
+                              remote_version=Path(dst_zipfile).stat().st_mtime)
 
                     # write metadata in the processed folder
                     collect_all_daris_metadata(tmpdir, metadata_dst)
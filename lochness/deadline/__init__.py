@@ -0,0 +1,136 @@
+import os
+import time
+import signal
+import logging
+import threading
+import contextlib
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def configured(Lochness: 'Lochness', source: str) -> float:
+    '''Return the deadline of a source from the configuration file, or None
+
+    Deadlines are in seconds, with default applying to every source without
+    its own entry.
+
+        deadlines:
+            default: 3600
+            mediaflux: 14400
+            transfer: 7200
+    '''
+    deadlines = Lochness.get('deadlines', dict()) or dict()
+    seconds = deadlines.get(source, deadlines.get('default'))
+    return float(seconds) if seconds else None
+
+
+@contextlib.contextmanager
+def limit(seconds: float = None):
+    '''Set the deadline of the calling thread for the duration of the block
+
+    A nested block can only bring the deadline forward. None leaves the
+    current deadline unchanged.
+    '''
+    previous = getattr(_local, 'deadline', None)
+    deadline = previous
+    if seconds:
+        deadline = time.monotonic() + seconds
+        if previous is not None:
+            deadline = min(previous, deadline)
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining() -> float:
+    '''seconds left before the deadline of the calling thread, or None'''
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    '''True if the deadline of the calling thread has passed'''
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check(what: str = 'sync') -> None:
+    '''raise DeadlineExceeded if the deadline of the calling thread passed'''
+    if expired():
+        raise DeadlineExceeded(f'deadline exceeded for {what}')
+
+
+def timeout(seconds: float = None) -> float:
+    '''Return the smaller of seconds and the time left before the deadline
+
+    Raises DeadlineExceeded if the deadline has already passed.
+    '''
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded('deadline exceeded')
+    return left if seconds is None else min(seconds, left)
+
+
+def run(command, timeout_seconds: float = None, shell: bool = True,
+        stdout=None, stderr=None) -> subprocess.CompletedProcess:
+    '''Run a command, killing it if it outlives the deadline
+
+    The command runs in its own process group, so a shell and everything it
+    started (eg. unimelb-mf-download, curl, aws or rsync) are terminated
+    together. Output sent to subprocess.PIPE is returned as str.
+
+    Key Arguments:
+        command: command line, str (or list with shell=False).
+        timeout_seconds: timeout of the command, on top of the deadline of
+                         the calling thread, float.
+        shell: run the command through the shell, bool.
+        stdout, stderr: passed to subprocess.Popen.
+
+    Returns:
+        subprocess.CompletedProcess
+
+    Raises:
+        DeadlineExceeded: when the command was killed.
+    '''
+    seconds = timeout(timeout_seconds)
+    proc = subprocess.Popen(command, shell=shell, stdout=stdout,
+                            stderr=stderr, universal_newlines=True,
+                            start_new_session=True)
+    try:
+        out, err = proc.communicate(timeout=seconds)
+    except subprocess.TimeoutExpired:
+        logger.warning(f'killing command after {seconds:.0f} s: {command}')
+        _kill(proc)
+        raise DeadlineExceeded(f'command killed after {seconds:.0f} s: '
+                               f'{command}')
+    except BaseException:
+        _kill(proc)
+        raise
+    return subprocess.CompletedProcess(command, proc.returncode, out, err)
+
+
+def _kill(proc: subprocess.Popen, grace: float = 10) -> None:
+    '''terminate the process group of proc, then kill it after grace'''
+    for sig in signal.SIGTERM, signal.SIGKILL:
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            proc.communicate(timeout=grace)
+            break
+        except subprocess.TimeoutExpired:
+            continue
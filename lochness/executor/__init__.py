@@ -0,0 +1,277 @@
+import time
+import logging
+import lochness
+import threading
+import lochness.deadline as deadline
+import collections as col
+import concurrent.futures as cf
+
+logger = logging.getLogger(__name__)
+
+Job = col.namedtuple('Job', ['source', 'func', 'subject'])
+Result = col.namedtuple('Result', ['source', 'study', 'subject',
+                                   'ok', 'seconds', 'skipped', 'timed_out'],
+                        defaults=[False, False])
+
+DEFAULT_BREAKER_THRESHOLD = 5
+
+
+def source_name(Module) -> str:
+    '''return the short source name of a lochness module, eg) "box"'''
+    return lochness.lchop(Module.__name__, 'lochness.')
+
+
+def run(jobs: list,
+        Lochness: 'Lochness',
+        workers: int = 1,
+        max_per_source: int = None,
+        dry: bool = False) -> list:
+    '''Run subject x source sync jobs, optionally on a bounded thread pool
+
+    Each job is executed through lochness.attempt, so exceptions raised by a
+    source module are logged and recorded in lochness.attempt.warnings in the
+    same way as a serial sync.
+
+    Jobs go through a circuit breaker for each source and keyring alias of
+    the subject. After circuit_breaker_threshold consecutive failures (5 by
+    default, 0 to disable) the breaker opens, and the remaining jobs of the
+    alias are skipped. On the next run a single job is let through as a
+    probe, and the breaker closes again if it succeeds.
+
+    Key Arguments:
+        jobs: list of Job.
+        Lochness: Lochness object.
+        workers: number of worker threads. 1 runs the jobs in series in the
+                 calling thread, int.
+        max_per_source: maximum number of in-flight jobs per source, int.
+                        Defaults to the number of workers.
+        dry: dry run flag passed to each sync function, bool.
+
+    Returns:
+        results: list of Result, in the same order as jobs.
+    '''
+    jobs = list(jobs)
+    breakers.new_cycle(Lochness.get('circuit_breaker_threshold',
+                                    DEFAULT_BREAKER_THRESHOLD))
+    if workers <= 1:
+        results = []
+        for job in jobs:
+            if breakers.decide(job) == SKIP:
+                results.append(_skipped_result(job))
+            else:
+                results.append(_run_job(job, Lochness, dry))
+        return results
+
+    max_per_source = max_per_source or workers
+    results = [None] * len(jobs)
+
+    # job indices waiting to be dispatched, for each source
+    queues = col.OrderedDict()
+    for index, job in enumerate(jobs):
+        queues.setdefault(job.source, col.deque()).append(index)
+
+    in_flight = col.Counter()
+    futures = {}
+    with cf.ThreadPoolExecutor(max_workers=workers,
+                               thread_name_prefix='lochness') as pool:
+        while queues or futures:
+            # hand out free workers one job per source at a time, so a single
+            # source with many subjects does not starve the others
+            dispatched = True
+            while dispatched and len(futures) < workers:
+                dispatched = False
+                for source in list(queues):
+                    if len(futures) >= workers:
+                        break
+                    if in_flight[source] >= max_per_source:
+                        continue
+                    index = queues[source][0]
+                    decision = breakers.decide(jobs[index])
+                    if decision == WAIT:
+                        # a probe of the alias is in flight
+                        continue
+                    queues[source].popleft()
+                    if not queues[source]:
+                        del queues[source]
+                    if decision == SKIP:
+                        results[index] = _skipped_result(jobs[index])
+                        dispatched = True
+                        continue
+                    future = pool.submit(_run_job, jobs[index], Lochness, dry)
+                    futures[future] = index
+                    in_flight[source] += 1
+                    dispatched = True
+
+            done, _ = cf.wait(futures, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                in_flight[jobs[index].source] -= 1
+                results[index] = future.result()
+
+    return results
+
+
+def _run_job(job: Job, Lochness: 'Lochness', dry: bool) -> Result:
+    '''Run a single job through lochness.attempt and time it
+
+    The job runs under the deadline of its source from the configuration
+    file. A job which outlived its deadline is recorded as timed out, and
+    counts as a failure for the circuit breakers.
+    '''
+    logger.debug(f'{job.source} sync start for '
+                 f'{job.subject.study}/{job.subject.id}')
+    start = time.time()
+    with deadline.limit(deadline.configured(Lochness, job.source)):
+        ok = lochness.attempt(job.func, Lochness, job.subject, dry=dry)
+        timed_out = deadline.expired()
+    if timed_out:
+        logger.warning(f'{job.source} sync timed out for '
+                       f'{job.subject.study}/{job.subject.id} after '
+                       f'{time.time() - start:.0f} s')
+    breakers.record(job, ok and not timed_out)
+    return Result(job.source, job.subject.study, job.subject.id,
+                  ok, time.time() - start, timed_out=timed_out)
+
+
+def _skipped_result(job: Job) -> Result:
+    logger.debug(f'{job.source} sync skipped for '
+                 f'{job.subject.study}/{job.subject.id}, circuit open')
+    return Result(job.source, job.subject.study, job.subject.id,
+                  False, 0.0, skipped=True)
+
+
+RUN, WAIT, SKIP = 'run', 'wait', 'skip'
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker(object):
+    '''Consecutive failure count and state of a source and keyring alias'''
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+
+class CircuitBreakers(object):
+    '''Circuit breakers of every source and keyring alias, kept across runs
+
+    A job is keyed by the keyring aliases of its subject for the source, eg)
+    ('box', 'box.PronetLA'), or by the source alone when the subject has no
+    aliases for it. A job runs if any of its breakers is closed, or is the
+    single probe of a half-open breaker.
+    '''
+    def __init__(self):
+        self.threshold = DEFAULT_BREAKER_THRESHOLD
+        self._breakers = col.defaultdict(CircuitBreaker)
+        self._lock = threading.Lock()
+
+    def keys(self, job: Job) -> list:
+        aliases = getattr(job.subject, job.source, None)
+        if isinstance(aliases, dict) and aliases:
+            return [(job.source, alias) for alias in sorted(aliases)]
+        return [(job.source, None)]
+
+    def new_cycle(self, threshold: int) -> None:
+        '''let a single probe through each open breaker'''
+        with self._lock:
+            self.threshold = threshold
+            for key, breaker in self._breakers.items():
+                if breaker.state == OPEN:
+                    logger.info(f'circuit breaker for {_key_str(key)} is '
+                                'half-open, probing with a single job')
+                    breaker.state = HALF_OPEN
+                    breaker.probing = False
+
+    def decide(self, job: Job) -> str:
+        '''return RUN, WAIT (for a probe in flight) or SKIP for a job'''
+        if not self.threshold:
+            return RUN
+        with self._lock:
+            breakers = [self._breakers[key] for key in self.keys(job)]
+            probes = [x for x in breakers
+                      if x.state == HALF_OPEN and not x.probing]
+            if probes or any(x.state == CLOSED for x in breakers):
+                for breaker in probes:
+                    breaker.probing = True
+                return RUN
+            if any(x.state == HALF_OPEN for x in breakers):
+                return WAIT
+            return SKIP
+
+    def record(self, job: Job, ok: bool) -> None:
+        '''update the breakers of a job with its outcome'''
+        if not self.threshold:
+            return
+        with self._lock:
+            for key in self.keys(job):
+                breaker = self._breakers[key]
+                if ok:
+                    if breaker.state != CLOSED:
+                        logger.info(f'circuit breaker for {_key_str(key)} '
+                                    'closed')
+                    breaker.state = CLOSED
+                    breaker.failures = 0
+                    breaker.probing = False
+                    continue
+
+                breaker.failures += 1
+                if breaker.state == HALF_OPEN or \
+                        (breaker.state == CLOSED and
+                         breaker.failures >= self.threshold):
+                    logger.warning(f'circuit breaker for {_key_str(key)} '
+                                   f'opened after {breaker.failures} '
+                                   'consecutive failures, skipping its '
+                                   'remaining jobs this cycle')
+                    breaker.state = OPEN
+                    breaker.probing = False
+
+    def state(self, source: str, alias: str = None) -> str:
+        with self._lock:
+            key = (source, alias)
+            return self._breakers[key].state if key in self._breakers \
+                else CLOSED
+
+    def reset(self) -> None:
+        with self._lock:
+            self._breakers.clear()
+
+
+def _key_str(key: tuple) -> str:
+    source, alias = key
+    return f'{source}/{alias}' if alias else source
+
+
+breakers = CircuitBreakers()
+
+
+def summarize(results: list) -> str:
+    '''Return a deterministic summary of job results, grouped by source
+
+    Sources are listed in alphabetical order, followed by the failed
+    study/subject pairs sorted by name. Durations are left out on purpose, so
+    the same outcome always produces the same summary.
+    '''
+    by_source = col.defaultdict(list)
+    for result in results:
+        by_source[result.source].append(result)
+
+    lines = [f'sync summary: {len(results)} jobs, '
+             f'{sum(not x.ok and not x.skipped for x in results)} failed']
+    for source in sorted(by_source):
+        source_results = by_source[source]
+        failed = sorted((x.study, x.subject)
+                        for x in source_results
+                        if not x.ok and not x.skipped)
+        skipped = sum(x.skipped for x in source_results)
+        timed_out = sum(x.timed_out for x in source_results)
+        line = f'  {source}: {len(source_results) - len(failed) - skipped} ' \
+               f'ok, {len(failed)} failed'
+        if skipped:
+            line += f', {skipped} skipped (circuit open)'
+        if timed_out:
+            line += f', {timed_out} timed out'
+        lines.append(line)
+        for study, subject in failed:
+            lines.append(f'    failed {study}/{subject}')
+
+    return '\n'.join(lines)
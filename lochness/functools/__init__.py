@@ -1,4 +1,6 @@
 import pickle
+import threading
+import functools
 
 def lru_cache(fn):
     '''
@@ -20,3 +22,63 @@ def lru_cache(fn):
         setattr(memoized_fn, attr, value)
     memoized_fn.cache = {}
     return memoized_fn
+
+
+_cycle_cached = []
+
+
+def cycle_cache(fn):
+    '''
+    Memoization wrapper which keeps results until the next sync cycle starts.
+    Concurrent callers with the same arguments wait for a single call to fn,
+    and exceptions are not cached, so a failed call is tried again.
+    :param fn: Function
+    :type fn: function
+    :returns: Memoized function, cleared by new_cycle(). A single result is
+              forgotten with cache_forget(*args, **kwargs)
+    :rtype: function
+    '''
+    lock = threading.Lock()
+    key_locks = {}
+
+    @functools.wraps(fn)
+    def memoized_fn(*args, **kwargs):
+        key = pickle.dumps((args, sorted(kwargs.items())))
+        with lock:
+            if key in memoized_fn.cache:
+                return memoized_fn.cache[key]
+            key_lock = key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with lock:
+                if key in memoized_fn.cache:
+                    return memoized_fn.cache[key]
+            value = fn(*args, **kwargs)
+            with lock:
+                memoized_fn.cache[key] = value
+            return value
+
+    def cache_clear():
+        with lock:
+            memoized_fn.cache.clear()
+            key_locks.clear()
+
+    def cache_forget(*args, **kwargs):
+        '''forget the result of a single call, eg) an expired login'''
+        key = pickle.dumps((args, sorted(kwargs.items())))
+        with lock:
+            memoized_fn.cache.pop(key, None)
+
+    memoized_fn.cache = {}
+    memoized_fn.cache_clear = cache_clear
+    memoized_fn.cache_forget = cache_forget
+    _cycle_cached.append(memoized_fn)
+    return memoized_fn
+
+
+def new_cycle():
+    '''
+    Forget every result memoized with cycle_cache, called at the start of each
+    sync cycle.
+    '''
+    for memoized_fn in _cycle_cached:
+        memoized_fn.cache_clear()
@@ -14,7 +14,8 @@ import lochness.keyring as keyring
 from os.path import join as pjoin, basename, dirname, isfile
 import cryptease as enc
 import re
-from subprocess import Popen, DEVNULL, STDOUT
+from subprocess import DEVNULL, STDOUT
+import lochness.deadline as deadline
 import pandas as pd
 from numpy import nan
 from distutils.spawn import find_executable
@@ -102,9 +103,7 @@ def sync_module(Lochness: 'lochness.config',
                                           mf_remote_root,
                                           '-o', diff_path])
                         
-                        p = Popen(cmd, shell=True,
-                                  stdout=DEVNULL, stderr=STDOUT)
-                        p.wait()
+                        deadline.run(cmd, stdout=DEVNULL, stderr=STDOUT)
 
                         # ENH
                         # if dry: exit()
@@ -172,17 +171,13 @@ def sync_module(Lochness: 'lochness.config',
                                               '--nb-retries 5',
                                               f'\"{remote}\"'])
 
-                            p = Popen(cmd, shell=True,
-                                      stdout=DEVNULL, stderr=STDOUT)
-                            p.wait()
+                            deadline.run(cmd, stdout=DEVNULL, stderr=STDOUT)
 
                             # verify checksum after download completes if
                             # checksum does not match, data will be downloaded
                             # again ENH should we verify checksum 5 times?
                             cmd += ' --csum-check'
-                            p = Popen(cmd, shell=True,
-                                      stdout=DEVNULL, stderr=STDOUT)
-                            p.wait()
+                            deadline.run(cmd, stdout=DEVNULL, stderr=STDOUT)
 
                             # for A/V related files, force permission to 770
                             # so A/V pipeline can work
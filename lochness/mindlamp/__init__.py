@@ -3,17 +3,21 @@ import logging
 import lochness
 import os
 import lochness.net as net
+import lochness.ratelimit as ratelimit
+import lochness.state as state
 import sys
 import json
 import lochness.tree as tree
 from io import BytesIO
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple, List, Iterator
+import collections as col
 import pytz
 import time
 from datetime import datetime, timedelta
 import base64
 import re
+import bisect
 import tempfile as tf
 from lochness.cleaner import is_transferred_and_removed
 from lochness.utils.checksum import get_sha
@@ -125,8 +129,87 @@ def sync(Lochness: 'lochness.config',
                           BIDS=Lochness['BIDS'],
                           makedirs=True)
 
+    store = state.get(Lochness)
+    alias = f'mindlamp.{subject.study}'
+
+    # in range mode, the days to pull are collected for a single range query
+    # per data type after the loop
+    range_query = range_query_mode(Lochness)
+    days_to_pull = {'activity': [], 'sensor': []}
+
     # the loop below downloads all data from mindlamp from the current date
     # to (current date - 100 days), overwriting pre-downloaded files.
+    for day in day_windows(ct_utc_00, days_to_check, consent_date):
+        logger.debug(f'Mindlamp {subject_id} {day.date_str} data pull - start')
+
+        # store both data types
+        for data_name in ['activity', 'sensor']:
+            dst = Path(dst_folder) / \
+                f'{subject_id}_{subject.study}_{data_name}_{day.date_str}.json'
+
+            # do not re-download already transferred & removed data
+            # if is_transferred_and_removed(Lochness, dst):
+            #    continue
+
+            pull, prev_file_sha256 = check_day_to_pull(
+                    store, subject, dst, day, data_name)
+            if not pull:
+                continue
+
+            if range_query:
+                days_to_pull[data_name].append((day, dst, prev_file_sha256))
+                continue
+
+            function_to_execute = get_activity_events_lamp \
+                if data_name == 'activity' else get_sensor_events_lamp
+
+            # pull data from mindlamp
+            begin = time.time()
+            data_dict = function_to_execute(LAMP, subject_id,
+                                            from_ts=day.from_ts,
+                                            to_ts=day.to_ts,
+                                            alias=alias)
+            end = time.time()
+            logger.debug(
+                f'Mindlamp {subject_id} {day.date_str} {data_name} data pull'
+                f' - completed in ({end - begin} seconds)')
+
+            save_day(store, subject, subject_id, dst, day, data_name,
+                     data_dict, prev_file_sha256, end - begin)
+
+    # a single range query for each run of consecutive days to pull,
+    # partitioned into the same days as above
+    for data_name, days in days_to_pull.items():
+        for run in day_runs(days):
+            from_ts = run[0][0].from_ts
+            to_ts = run[-1][0].to_ts
+            begin = time.time()
+            events = get_events_range_lamp(LAMP, data_name, subject_id,
+                                           from_ts=from_ts, to_ts=to_ts,
+                                           alias=alias)
+            end = time.time()
+            logger.debug(f'Mindlamp {subject_id} {data_name} data pull for '
+                         f'{len(run)} days - completed in ({end - begin} '
+                         'seconds)')
+
+            buckets = partition_events(events, [x[0] for x in run])
+            for (day, dst, prev_file_sha256), data_dict in zip(run, buckets):
+                save_day(store, subject, subject_id, dst, day, data_name,
+                         data_dict, prev_file_sha256, end - begin)
+
+
+DayWindow = col.namedtuple('DayWindow', ['days_from_ct', 'date_str',
+                                         'from_ts', 'to_ts'])
+
+
+def day_windows(ct_utc_00: datetime, days_to_check: int,
+                consent_date: datetime) -> Iterator[DayWindow]:
+    '''Yield the days to check, from the oldest to the current day
+
+    Days before the consent date are left out. The time stamps of a day are
+    13 digit time stamps of its UTC 00:00 and 24:00, as used by the MindLAMP
+    API.
+    '''
     for days_from_ct in reversed(range(days_to_check)):
         # get time range: n days before current date
         # 1000 has been multiplied to match timestamp format
@@ -142,83 +225,175 @@ def sync(Lochness: 'lochness.config',
         # date string to be used in the file name
         date_str = time_utc_00.strftime("%Y_%m_%d")
 
-        logger.debug(f'Mindlamp {subject_id} {date_str} data pull - start')
+        yield DayWindow(days_from_ct, date_str, time_utc_00_ts, time_utc_24_ts)
 
-        # store both data types
-        for data_name in ['activity', 'sensor']:
-            dst = Path(dst_folder) / \
-                f'{subject_id}_{subject.study}_{data_name}_{date_str}.json'
 
-            function_to_execute = get_activity_events_lamp \
-                if data_name == 'activity' else get_sensor_events_lamp
+def day_runs(days: List[tuple]) -> Iterator[List[tuple]]:
+    '''Split the days to pull into runs of consecutive days
 
-            # do not re-download already transferred & removed data
-            # if is_transferred_and_removed(Lochness, dst):
-            #    continue
+    Key Arguments:
+        days: (DayWindow, dst, prev_file_sha256) of the days to pull, from
+              the oldest to the newest, list of tuple.
 
-            prev_file_sha256 = ''  # set previous sha as empty
-            checksum_file = dst.parent / f'.check_sum_{dst.name}'
-            if days_from_ct >= 2 and Path(dst).is_file():
-                # if the days_from_ct is more than two days, the mindlmap data
-                # on the mindlamp server should not change, thus no need to
-                # re-download data for checking checksum.
-                if checksum_file.is_file():
-                    logger.debug(f'{data_name} data has been downloaded for '
-                                 f'{date_str} - skip downloading')
-                    continue
-
-            elif days_from_ct < 2 and Path(dst).is_file():
-                # potentially within 24 hours from the data acquisition, data
-                # may change so check if there is any changes in the data on
-                # the source
-                if checksum_file.is_file():
-                    logger.debug(f'{data_name} data has been downloaded more '
-                                 'than once for checksum')
-
-                    # read checksum of the existing file
-                    with open(checksum_file, 'r') as fp:
-                        prev_file_sha256 = fp.read().strip()
+    Yields:
+        runs of the items of days, whose DayWindows follow each other.
+    '''
+    run = []
+    for item in days:
+        if run and run[-1][0].to_ts != item[0].from_ts:
+            yield run
+            run = []
+        run.append(item)
+    if run:
+        yield run
 
-            # pull data from mindlamp
-            begin = time.time()
-            data_dict = function_to_execute(LAMP, subject_id,
-                                            from_ts=time_utc_00_ts,
-                                            to_ts=time_utc_24_ts)
-            end = time.time()
-            logger.debug(
-                f'Mindlamp {subject_id} {date_str} {data_name} data pull'
-                f' - completed in ({end - begin} seconds)')
 
-            # separate out audio data from the activity dictionary
-            if data_name == 'activity' and data_dict:
-                sound_dst = os.path.join(
-                        dst_folder,
-                        f'{subject_id}_{subject.study}_{data_name}_'
-                        f'{date_str}_sound.mp3')
-                # if is_transferred_and_removed(Lochness, sound_dst):
-                    # continue
-                data_dict = get_audio_out_from_content(data_dict, sound_dst)
-
-            jsonData = json.dumps(data_dict, sort_keys=True,
-                                  indent=3, separators=(',', ': '))
-            content = jsonData.encode()
-            if content.strip() == b'[]':
-                logger.info(f'No mindlamp data for {subject_id} {date_str}')
-                continue
+def partition_events(events: List[dict],
+                     days: List[DayWindow]) -> List[List[dict]]:
+    '''Split the events of consecutive days into the events of each day
+
+    Each event is put in its day by bisecting the start of the days, as the
+    days of day_windows are not always 24 hours long (they follow the local
+    time). Like the per day query, whose to_ts is inclusive, an event at
+    the boundary of two days is in both.
+
+    Key Arguments:
+        events: events of the days, newest first, list of dict.
+        days: consecutive days, from the oldest to the newest, list of
+              DayWindow.
+
+    Returns:
+        events of each day, in the order of events, list of list of dict.
+    '''
+    starts = [x.from_ts for x in days]
+    buckets = [[] for _ in days]
+    for event in events:
+        timestamp = event['timestamp']
+        index = bisect.bisect_right(starts, timestamp) - 1
+        if index < 0 or timestamp > days[index].to_ts:
+            continue
+        buckets[index].append(event)
+        if index > 0 and timestamp == days[index].from_ts:
+            buckets[index - 1].append(event)
+    return buckets
+
+
+def check_day_to_pull(store: state.StateStore,
+                      subject: 'subject.metadata',
+                      dst: Path,
+                      day: DayWindow,
+                      data_name: str) -> Tuple[bool, str]:
+    '''Check if the data of a day needs to be pulled
 
-            with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
-                lochness.atomic_write(tmpfilename.name, content)
-                new_file_sha256 = get_sha(tmpfilename.name)
-                # if checksum is the same don't overwrite the existing data
-                if new_file_sha256 == prev_file_sha256:
-                    continue
-                else:
-                    with open(checksum_file, 'w') as fp:
-                        fp.write(new_file_sha256)
+    Returns:
+        (pull, prev_file_sha256): True if the data should be pulled, and the
+                                  checksum of the file saved before, if any.
+    '''
+    prev_file_sha256 = ''  # set previous sha as empty
+    checksum_file = dst.parent / f'.check_sum_{dst.name}'
+    record = store.get('mindlamp', subject.id, dst.name)
+    if record is not None and not Path(dst).is_file():
+        # the file was moved or removed since it was saved
+        record = None
+
+    if record is not None:
+        # checksum of the last saved file, from the state store
+        if day.days_from_ct >= 2:
+            logger.debug(f'{data_name} data has been downloaded for '
+                         f'{day.date_str} - skip downloading')
+            return False, prev_file_sha256
+        prev_file_sha256 = record.local_hash or ''
+
+    elif day.days_from_ct >= 2 and Path(dst).is_file():
+        # if the days_from_ct is more than two days, the mindlmap data
+        # on the mindlamp server should not change, thus no need to
+        # re-download data for checking checksum.
+        if checksum_file.is_file():
+            logger.debug(f'{data_name} data has been downloaded for '
+                         f'{day.date_str} - skip downloading')
+            with open(checksum_file, 'r') as fp:
+                store.put('mindlamp', subject.id, dst.name,
+                          local_hash=fp.read().strip())
+            return False, prev_file_sha256
+
+    elif day.days_from_ct < 2 and Path(dst).is_file():
+        # potentially within 24 hours from the data acquisition, data
+        # may change so check if there is any changes in the data on
+        # the source
+        if checksum_file.is_file():
+            logger.debug(f'{data_name} data has been downloaded more '
+                         'than once for checksum')
+
+            # read checksum of the existing file
+            with open(checksum_file, 'r') as fp:
+                prev_file_sha256 = fp.read().strip()
+
+    return True, prev_file_sha256
+
+
+def save_day(store: state.StateStore,
+             subject: 'subject.metadata',
+             subject_id: str,
+             dst: Path,
+             day: DayWindow,
+             data_name: str,
+             data_dict: List[dict],
+             prev_file_sha256: str,
+             seconds: float) -> None:
+    '''Save the data of a day, unless its checksum did not change
+
+    Key Arguments:
+        store: state store of the Lochness object.
+        subject: Subject object.
+        subject_id: MindLAMP subject id, str.
+        dst: path of the json file of the day, Path.
+        day: DayWindow of the data.
+        data_name: activity or sensor, str.
+        data_dict: events of the day, list of dict.
+        prev_file_sha256: checksum of the file saved before, str.
+        seconds: time taken to pull the data, float.
+    '''
+    checksum_file = dst.parent / f'.check_sum_{dst.name}'
+
+    # separate out audio data from the activity dictionary
+    if data_name == 'activity' and data_dict:
+        sound_dst = os.path.join(
+                dst.parent,
+                f'{subject_id}_{subject.study}_{data_name}_'
+                f'{day.date_str}_sound.mp3')
+        # if is_transferred_and_removed(Lochness, sound_dst):
+            # continue
+        data_dict = get_audio_out_from_content(data_dict, sound_dst)
+
+    jsonData = json.dumps(data_dict, sort_keys=True,
+                          indent=3, separators=(',', ': '))
+    content = jsonData.encode()
+    if content.strip() == b'[]':
+        # days without data are checked again in the next syncs, as long
+        # as they are within mindlamp_days_to_pull, for late uploads
+        logger.info(f'No mindlamp data for {subject_id} {day.date_str}')
+        return
+
+    with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
+        lochness.atomic_write(tmpfilename.name, content)
+        new_file_sha256 = get_sha(tmpfilename.name)
+        # if checksum is the same don't overwrite the existing data
+        if new_file_sha256 == prev_file_sha256:
+            return
+        else:
+            with open(checksum_file, 'w') as fp:
+                fp.write(new_file_sha256)
+
+    lochness.atomic_write(dst, content)
+    store.put('mindlamp', subject.id, dst.name,
+              local_hash=new_file_sha256, local_path=dst)
+    logger.info(f'Mindlamp {data_name} data is saved for '
+                f'{subject_id} {day.date_str} (took {seconds} s)')
 
-            lochness.atomic_write(dst, content)
-            logger.info(f'Mindlamp {data_name} data is saved for '
-                        f'{subject_id} {date_str} (took {end-begin} s)')
+
+def range_query_mode(Lochness: 'lochness.config') -> bool:
+    '''True if the days to pull are fetched with a range query per type'''
+    return Lochness.get('mindlamp_range_query', False) is True
 
 
 def deidentify_flag(Lochness, study):
@@ -341,7 +516,8 @@ def get_sensors_lamp(lamp: LAMP, subject_id: str,
 
 def get_activity_events_lamp(
         lamp: LAMP, subject_id: str,
-        from_ts: str = None, to_ts: str = None) -> List[str]:
+        from_ts: str = None, to_ts: str = None,
+        alias: str = None) -> List[str]:
 
     '''Return list of activity events for a subject
 
@@ -350,19 +526,22 @@ def get_activity_events_lamp(
         subject_id: MindLamp subject id, str.
         from_ts: 13 digit timestamp used to limit the api call from, str.
         to_ts: 13 digit timestamp used to limit the api call to, str.
+        alias: MindLamp keyring alias used for rate limiting, str.
 
     Returns:
         activity_events_dicts: activity records, list of dict.
     '''
-    activity_events_dicts = lamp.ActivityEvent.all_by_participant(
-                    subject_id, _from=from_ts, to=to_ts,
-                    _limit=LIMIT)['data']
+    with ratelimit.get(alias):
+        activity_events_dicts = lamp.ActivityEvent.all_by_participant(
+                        subject_id, _from=from_ts, to=to_ts,
+                        _limit=LIMIT)['data']
     return activity_events_dicts
 
 
 def get_sensor_events_lamp(
         lamp: LAMP, subject_id: str,
-        from_ts: str = None, to_ts: str = None) -> List[str]:
+        from_ts: str = None, to_ts: str = None,
+        alias: str = None) -> List[str]:
 
     '''Return list of sensor events for a subject
 
@@ -371,6 +550,7 @@ def get_sensor_events_lamp(
         subject_id: MindLamp subject id, str.
         from_ts: 13 digit timestamp used to limit the api call from, str.
         to_ts: 13 digit timestamp used to limit the api call to, str.
+        alias: MindLamp keyring alias used for rate limiting, str.
 
     Returns:
         activity_dicts: activity records, list of dict.
@@ -381,23 +561,87 @@ def get_sensor_events_lamp(
     timestamp_limit = to_ts - from_ts
 
     sensor_event_dicts = []
+    boundary = []
     if from_ts is not None:
         while True:
-            res = lamp.SensorEvent.all_by_participant(
-                            subject_id, _from=from_ts, to=to_ts,
-                            _limit=LIMIT)
+            with ratelimit.get(alias):
+                res = lamp.SensorEvent.all_by_participant(
+                                subject_id, _from=from_ts, to=to_ts,
+                                _limit=LIMIT)
             if 'error' in res:
                 raise RuntimeError(res["error"])
 
+            # the events at to_ts of the previous chunk are returned again
             chunk = res['data'] if 'data' in res else []
-            sensor_event_dicts += chunk
+            new = [x for x in chunk if x not in boundary]
+            sensor_event_dicts += new
 
-            if not chunk or int(to_ts) - int(chunk[-1]['timestamp']) == 0:
+            if not new or int(to_ts) - int(chunk[-1]['timestamp']) == 0:
                 break
 
             to_ts = chunk[-1]['timestamp']
+            boundary = [x for x in sensor_event_dicts
+                        if x['timestamp'] == to_ts]
     else:
-        sensor_event_dicts = lamp.SensorEvent.all_by_participant(
-                        subject_id, _limit=LIMIT)['data']
+        with ratelimit.get(alias):
+            sensor_event_dicts = lamp.SensorEvent.all_by_participant(
+                            subject_id, _limit=LIMIT)['data']
 
     return sensor_event_dicts
+
+
+def get_events_range_lamp(
+        lamp: LAMP, data_name: str, subject_id: str,
+        from_ts: float, to_ts: float,
+        alias: str = None, page_size: int = LIMIT) -> List[dict]:
+    '''Return the activity or sensor events of a subject within a range
+
+    Events come newest first, one page of up to page_size events at a time.
+    The next page ends at the time stamp of the last event of the previous
+    page, as in get_sensor_events_lamp, and the events of the previous page
+    returned again at that time stamp are dropped. A page made only of
+    events at a single time stamp can not get past it, so the page size is
+    doubled until every event of the time stamp fits in a page.
+
+    Key arguments:
+        lamp: authenticated LAMP object.
+        data_name: activity or sensor, str.
+        subject_id: MindLamp subject id, str.
+        from_ts: 13 digit timestamp used to limit the api call from, float.
+        to_ts: 13 digit timestamp used to limit the api call to, float.
+        alias: MindLamp keyring alias used for rate limiting, str.
+        page_size: maximum number of events per api call, int.
+
+    Returns:
+        events: activity or sensor events, list of dict.
+    '''
+    api = lamp.ActivityEvent if data_name == 'activity' \
+        else lamp.SensorEvent
+
+    events = []
+    boundary = []  # events of the previous page at its last time stamp
+    limit = page_size
+    while True:
+        with ratelimit.get(alias):
+            res = api.all_by_participant(subject_id, _from=from_ts,
+                                         to=to_ts, _limit=limit)
+        if 'error' in res:
+            raise RuntimeError(res["error"])
+
+        chunk = res['data'] if 'data' in res else []
+        events += [x for x in chunk if x not in boundary]
+        if len(chunk) < limit:
+            break
+
+        last_ts = chunk[-1]['timestamp']
+        if chunk[0]['timestamp'] == last_ts:
+            logger.warning(f'more than {limit} MindLAMP {data_name} events '
+                           f'of {subject_id} at {last_ts}, pulling them '
+                           f'again {limit * 2} events at a time')
+            limit *= 2
+        else:
+            limit = page_size
+        to_ts = last_ts
+        boundary = [x for x in events if x['timestamp'] == to_ts]
+
+    return events
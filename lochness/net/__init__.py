@@ -2,30 +2,436 @@ import time
 import random
 import logging
 import requests
+import datetime
+import threading
+import functools
+import email.utils
+import collections as col
+import lochness.deadline as deadline
+from lochness.functools import cycle_cache
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 600
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_RETRY_BUDGET = 600
+
+
 class retry(object):
-    def __init__(self, max_attempts):
+    '''Retry a function on transient network errors
+
+    Connection errors, timeouts and responses with a status code in
+    RETRY_STATUS_CODES (429 and 5xx) are retried, up to max_attempts calls in
+    total. The wait before each retry uses decorrelated jitter between base
+    and cap seconds, and is never shorter than the Retry-After header of the
+    response. Every wait is taken from the retry budget of the source (the
+    lochness module of the function, eg. redcap), so a failing service can
+    only block the sync workers for a bounded time per sync cycle. Any other
+    exception is raised immediately, and the return value of the function is
+    passed on.
+    '''
+    def __init__(self, max_attempts: int, base: float = 1, cap: float = 60,
+                 source: str = None, sleep=time.sleep):
         self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.source = source
+        self._sleep = sleep
+
     def __call__(self, f):
+        source = self.source or _source_of(f)
+
+        @functools.wraps(f)
         def wrapped_f(*args, **kwargs):
             attempt = 1
+            delay = self.base
             while True:
                 try:
-                    f(*args, **kwargs)
-                    break
-                except requests.exceptions.ConnectionError as e:
+                    return f(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    if attempt == self.max_attempts:
+                        _retry_stats[source].failures += 1
+                        raise RetryError('maximum retries exceeded') from e
+
+                    delay = min(self.cap,
+                                random.uniform(self.base, delay * 3))
+                    seconds = max(delay, retry_after(e) or 0)
+                    left = deadline.remaining()
+                    if left is not None and seconds >= left:
+                        _retry_stats[source].failures += 1
+                        raise RetryError('no time left before the deadline '
+                                         'of the sync to retry') from e
+                    if not _spend_budget(source, seconds):
+                        _retry_stats[source].failures += 1
+                        raise RetryError(f'retry budget of {source} '
+                                         'exhausted for this cycle') from e
+
                     attempt += 1
-                    if attempt == self.max_attempts + 1:
-                        raise RetryError("maximum retries exceeded")
-                    seconds = (2 ** attempt) + (random.randint(0, 1000) / 1000)
-                    message = "sleeping for {0} seconds before retry {1}/{2} due to error {3}"
-                    logger.warn(message.format(seconds, attempt, self.max_attempts, e))
-                    time.sleep(seconds)
-                else:
-                    raise e
+                    logger.warning(f'sleeping for {seconds:.1f} seconds '
+                                   f'before retry {attempt}/'
+                                   f'{self.max_attempts} due to error {e}')
+                    self._sleep(seconds)
         return wrapped_f
 
+
 class RetryError(Exception):
     pass
+
+
+class RetryableHTTPError(requests.exceptions.HTTPError):
+    '''response with a status code which is worth retrying'''
+    pass
+
+
+def is_retryable(e: Exception) -> bool:
+    '''True for connection errors, timeouts, 429 and 5xx responses'''
+    if isinstance(e, (requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError)):
+        return True
+    response = getattr(e, 'response', None)
+    return response is not None and \
+        getattr(response, 'status_code', None) in RETRY_STATUS_CODES
+
+
+def retry_after(e: Exception) -> float:
+    '''return the Retry-After of the response of an error in seconds'''
+    response = getattr(e, 'response', None)
+    value = getattr(response, 'headers', {}).get('retry-after') \
+        if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(
+        datetime.timezone.utc)).total_seconds())
+
+
+def _source_of(f) -> str:
+    '''source name of a function, eg) redcap for lochness.redcap.sync'''
+    parts = f.__module__.split('.')
+    return parts[1] if parts[0] == 'lochness' and len(parts) > 1 \
+        else parts[0]
+
+
+class RetryStats(object):
+    '''Retries, time spent backing off and failures of a source'''
+    def __init__(self):
+        self.retries = 0
+        self.backoff = 0.0
+        self.failures = 0
+
+
+_retry_budgets = dict()
+_retry_stats = col.defaultdict(RetryStats)
+_retry_lock = threading.Lock()
+
+
+def _spend_budget(source: str, seconds: float) -> bool:
+    '''take seconds from the retry budget of source, if there is enough'''
+    with _retry_lock:
+        budget = _retry_budgets.get(
+                source, _retry_budgets.get('default', DEFAULT_RETRY_BUDGET))
+        stats = _retry_stats[source]
+        if stats.backoff + seconds > budget:
+            return False
+        stats.retries += 1
+        stats.backoff += seconds
+        return True
+
+
+def retry_stats() -> dict:
+    '''return a copy of the retry statistics of each source'''
+    with _retry_lock:
+        stats = dict()
+        for source, x in _retry_stats.items():
+            stats[source] = RetryStats()
+            stats[source].__dict__.update(x.__dict__)
+        return stats
+
+
+class HostMetrics(object):
+    '''Request count, response size and latency of a single host'''
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.latency / self.requests if self.requests else 0.0
+
+
+class Client(object):
+    '''HTTP client with a pooled keep-alive session for each host
+
+    Every request to a host goes through the same requests.Session, so its
+    TCP and TLS connections are reused across subjects and sync workers.
+    Requests passing a session_key (eg. the user name of a login) get a
+    separate session for the host and key, so the cookies of different
+    logins to the same host are kept apart. Requests get the configured
+    timeouts unless the caller passes its own, and the number of requests,
+    response size and latency (time until the response headers arrived) are
+    kept per host.
+    Responses with a status code in RETRY_STATUS_CODES raise
+    RetryableHTTPError, to be retried by the retry decorator. Timeouts are
+    shortened to the time left before the deadline of the calling thread.
+    '''
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT):
+        self.pool_size = int(pool_size)
+        self.timeout = (connect_timeout, read_timeout)
+        self._sessions = dict()
+        self._metrics = col.defaultdict(HostMetrics)
+        self._lock = threading.Lock()
+
+    def session(self, url: str, session_key: str = None) -> requests.Session:
+        '''return the pooled session for the host of url and session_key'''
+        key = (_host(url), session_key)
+        with self._lock:
+            if key not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[key] = session
+            return self._sessions[key]
+
+    def request(self, method: str, url: str, session_key: str = None,
+                **kwargs) -> requests.Response:
+        '''send a request through the pooled session of the host'''
+        kwargs['timeout'] = request_timeout(kwargs.get('timeout',
+                                                       self.timeout))
+        host = _host(url)
+        start = time.monotonic()
+        try:
+            r = self.session(url, session_key).request(method, url,
+                                                       **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._metrics[host].errors += 1
+            raise
+        latency = time.monotonic() - start
+
+        # the size of a streamed response is only known from its headers
+        if kwargs.get('stream'):
+            size = int(r.headers.get('content-length', 0))
+        else:
+            size = len(r.content)
+
+        with self._lock:
+            metrics = self._metrics[host]
+            metrics.requests += 1
+            metrics.bytes += size
+            metrics.latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+            if r.status_code >= 400:
+                metrics.errors += 1
+
+        if r.status_code in RETRY_STATUS_CODES:
+            r.close()
+            raise RetryableHTTPError(
+                    f'{url} responded {r.status_code}', response=r)
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def metrics(self) -> dict:
+        '''return a copy of the metrics of each host'''
+        with self._lock:
+            return {host: _copy_metrics(x)
+                    for host, x in self._metrics.items()}
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self._metrics.clear()
+
+    def close(self) -> None:
+        '''close every pooled session'''
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def request_timeout(timeout=None):
+    '''Return the (connect, read) timeout of a request
+
+    Defaults to the timeouts of the shared client, and neither is longer than
+    the time left before the deadline of the calling thread.
+    '''
+    if timeout is None:
+        timeout = client().timeout
+    if isinstance(timeout, tuple):
+        return tuple(deadline.timeout(x) for x in timeout)
+    return deadline.timeout(timeout)
+
+
+def login_expired(r: requests.Response, login_url: str) -> bool:
+    '''True when a response shows that the login of its session expired
+
+    ie) the response is 401 or 403, or the request was redirected to the
+    login page.
+    '''
+    if r.status_code in (401, 403):
+        return True
+    return bool(r.history) and \
+        urlsplit(r.url).path == urlsplit(login_url).path
+
+
+@cycle_cache
+def login(login_url: str, session_key: str, data: dict,
+          verify: bool = True) -> bool:
+    '''Log in once per sync cycle, with the session of session_key
+
+    Key Arguments:
+        login_url: url the login form is posted to, str.
+        session_key: key of the session keeping the login cookies, eg) the
+                     user name, str.
+        data: login form, dict.
+        verify: verify the TLS certificate of the host, bool.
+    '''
+    r = post(login_url, data=data, verify=verify, session_key=session_key)
+    if r.status_code != requests.codes.OK:
+        raise LoginError(f'login url {r.url} responded {r.status_code}')
+    return True
+
+
+def get_logged_in(url: str, login_url: str, session_key: str, data: dict,
+                  **kwargs) -> requests.Response:
+    '''GET url with the session of session_key, logged in with login
+
+    The login is done again, once, if the response shows it has expired.
+
+    Key Arguments:
+        url: url to GET, str.
+        login_url: url the login form is posted to, str.
+        session_key: key of the session keeping the login cookies, eg) the
+                     user name, str.
+        data: login form, dict.
+        kwargs: arguments of the GET request, eg) params.
+    '''
+    verify = kwargs.get('verify', True)
+    login(login_url, session_key, data, verify=verify)
+    r = get(url, session_key=session_key, **kwargs)
+    if login_expired(r, login_url):
+        r.close()
+        logger.info(f'login of {session_key} to {_host(login_url)} expired, '
+                    'logging in again')
+        login.cache_forget(login_url, session_key, data, verify=verify)
+        login(login_url, session_key, data, verify=verify)
+        r = get(url, session_key=session_key, **kwargs)
+    return r
+
+
+class LoginError(Exception):
+    pass
+
+
+def _host(url: str) -> str:
+    split = urlsplit(url)
+    return f'{split.scheme}://{split.netloc}'
+
+
+def _copy_metrics(metrics: HostMetrics) -> HostMetrics:
+    copy = HostMetrics()
+    copy.__dict__.update(metrics.__dict__)
+    return copy
+
+
+class NetConfigError(Exception):
+    pass
+
+
+_client = Client()
+_client_lock = threading.Lock()
+
+
+def configure(Lochness: 'Lochness') -> None:
+    '''Set up the shared HTTP client and retry budgets from the
+    configuration file
+
+        http:
+            pool_size: 10
+            connect_timeout: 30
+            read_timeout: 600
+        retry_budget:
+            default: 600
+            redcap: 1200
+    '''
+    global _client
+    budgets = Lochness.get('retry_budget', dict()) or dict()
+    with _retry_lock:
+        _retry_budgets.clear()
+        _retry_budgets.update({k: float(v) for k, v in budgets.items()})
+    settings = Lochness.get('http', dict()) or dict()
+    unknown = set(settings) - {'pool_size', 'connect_timeout',
+                               'read_timeout'}
+    if unknown:
+        raise NetConfigError(f'unknown http fields: {unknown}')
+    with _client_lock:
+        _client.close()
+        _client = Client(**settings)
+    logger.debug(f'http client settings: {settings}')
+
+
+def client() -> Client:
+    '''return the shared HTTP client'''
+    with _client_lock:
+        return _client
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    '''GET url through the shared HTTP client'''
+    return client().get(url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    '''POST to url through the shared HTTP client'''
+    return client().post(url, **kwargs)
+
+
+def new_cycle() -> None:
+    '''reset the metrics, retry statistics and retry budgets of a cycle'''
+    client().reset_metrics()
+    with _retry_lock:
+        _retry_stats.clear()
+
+
+def summarize() -> str:
+    '''one line summary of the requests sent to each host, and of the
+    retries of each source'''
+    lines = []
+    for host, x in sorted(client().metrics().items()):
+        lines.append(f'{host}: {x.requests} requests, {x.errors} errors, '
+                     f'{x.bytes / 1024 / 1024:.1f} MB, '
+                     f'latency mean {x.mean_latency:.2f} s '
+                     f'max {x.max_latency:.2f} s')
+    for source, x in sorted(retry_stats().items()):
+        lines.append(f'{source}: {x.retries} retries, '
+                     f'{x.backoff:.1f} s backing off, '
+                     f'{x.failures} failures after retries')
+    return '\n'.join(lines)
@@ -0,0 +1,136 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket
+
+    Tokens are added at `rate` per second, up to `burst` tokens. Each acquire
+    takes a single token, blocking the calling thread until one is available.
+    '''
+    def __init__(self, rate: float, burst: float = None,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise RateLimitConfigError(f'rate must be positive: {rate}')
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        '''take a token, returning the number of seconds spent waiting'''
+        waited = 0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
+
+
+class Limiter(object):
+    '''Request rate and in-flight limit for a single keyring alias
+
+    Use as a context manager around each remote call. The in-flight slot is
+    held until the block exits, and a token is taken from the bucket before
+    the block runs.
+
+        with ratelimit.get('redcap.Pronet'):
+            requests.post(...)
+    '''
+    def __init__(self, alias: str, rate: float = None, burst: float = None,
+                 max_in_flight: int = None):
+        self.alias = alias
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight) \
+            if max_in_flight else None
+        self.waited = 0
+        self._waited_lock = threading.Lock()
+
+    def __enter__(self):
+        if self._slots is not None:
+            self._slots.acquire()
+        if self.bucket is not None:
+            try:
+                waited = self.bucket.acquire()
+            except BaseException:
+                self.__exit__(None, None, None)
+                raise
+            if waited:
+                with self._waited_lock:
+                    self.waited += waited
+                logger.debug(f'{self.alias} rate limited for {waited:.2f} s')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._slots is not None:
+            self._slots.release()
+        return False
+
+
+class RateLimitConfigError(Exception):
+    pass
+
+
+_limiters = dict()
+_configured = dict()
+_lock = threading.Lock()
+
+
+def configure(Lochness: 'Lochness') -> None:
+    '''Register the rate limits defined in the configuration file
+
+    Limits are set per keyring alias, eg) redcap.Pronet or box.PronetLA. An
+    entry named after the source alone, eg) box, is shared by all aliases of
+    that source which do not have their own entry.
+
+        rate_limits:
+            redcap.Pronet:
+                rate: 5
+                burst: 10
+                max_in_flight: 4
+            box:
+                rate: 10
+    '''
+    settings = Lochness.get('rate_limits', dict()) or dict()
+    with _lock:
+        _limiters.clear()
+        _configured.clear()
+        for alias, values in settings.items():
+            values = values or dict()
+            unknown = set(values) - {'rate', 'burst', 'max_in_flight'}
+            if unknown:
+                raise RateLimitConfigError(
+                        f'unknown rate_limits fields for {alias}: {unknown}')
+            _configured[alias] = Limiter(alias, **values)
+            logger.debug(f'rate limit for {alias}: {values}')
+
+
+def get(alias: str = None) -> Limiter:
+    '''Return the limiter for a keyring alias
+
+    Aliases without a configured limit get a limiter that never blocks.
+    '''
+    with _lock:
+        if alias not in _limiters:
+            source = alias.split('.')[0] if alias else None
+            if alias in _configured:
+                _limiters[alias] = _configured[alias]
+            elif source in _configured:
+                _limiters[alias] = _configured[source]
+            else:
+                _limiters[alias] = Limiter(alias)
+        return _limiters[alias]
@@ -2,18 +2,29 @@ import os
 import sys
 import re
 import json
+import time
+import zlib
+import itertools
+import codecs
 import lochness
+import threading
 import logging
 import requests
 import lochness.net as net
+import lochness.ratelimit as ratelimit
+import lochness.state as state
+import lochness.shard as shard
+from lochness.functools import cycle_cache
 import collections as col
 import lochness.tree as tree
+from io import BytesIO
 from pathlib import Path
 import pandas as pd
 import datetime
-from typing import List, Union
+from typing import List, Union, Iterator, Iterable
 import tempfile as tf
 from lochness.redcap.process_piis import process_and_copy_db
+import lochness.redcap.det_log as det_log
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -34,18 +45,10 @@ def get_field_names_from_redcap(api_url: str,
     }
 
     # pull field names from REDCap for the study
-    content = post_to_redcap(api_url,
-                             record_query,
-                             f'initializing data {study_name}')
-
-    # load pulled information as list of dictionary : data
-    with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
-        lochness.atomic_write(tmpfilename.name, content)
-        with open(tmpfilename.name, 'r') as f:
-            data = json.load(f)
-
     field_names = []
-    for item in data:
+    for item in iter_records_from_redcap(api_url,
+                                         record_query,
+                                         f'initializing data {study_name}'):
         field_names.append(item['original_field_name'])
 
     return field_names
@@ -91,70 +94,24 @@ def initialize_metadata(Lochness: 'Lochness object',
     # sources to add to the metadata, apart from REDCap, XNAT, and Box
     source_source_name_dict = {'mindlamp': ['Mindlamp', 'chrdbb_lamp_id']}
 
-    # to extract ID and consent form for all the records that
-    # belong to the site from screening & baseline arms
-    record_query = {
-        'token': api_key,
-        'content': 'record',
-        'format': 'json',
-        'fields[0]': redcap_id_colname,
-        'fields[1]': redcap_consent_colname,
-        'events[0]': 'screening_arm_1',
-        'events[1]': 'screening_arm_2',
-        'events[2]': 'baseline_arm_1',
-        'events[3]': 'baseline_arm_2',
-        'filterLogic': f"contains([{redcap_id_colname}],'{site_code_study}')"
-        }
+    # ID, consent date and source IDs of all records in the project, pulled
+    # once per sync cycle and shared by all sites of the project
+    records_by_site = get_metadata_records_by_site(
+            api_url, api_key,
+            redcap_id_colname, redcap_consent_colname,
+            tuple(x[1] for x in source_source_name_dict.values()),
+            alias=f'redcap.{project_name}')
 
+    df_final = records_by_site.get(site_code_study)
 
-    # to add mindlamp source ID to the record query
-    for num, (source, (source_name, source_field_name)) in \
-            enumerate(source_source_name_dict.items()):
-        record_query[f"fields[{2+num}]"] = source_field_name
-
-    # pull all records from the project's REDCap repo
-    content = post_to_redcap(api_url,
-                             record_query,
-                             f'initializing data {study_name}')
-
-    # load pulled information as a list of dictionaries
-    with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
-        lochness.atomic_write(tmpfilename.name, content)
-        with open(tmpfilename.name, 'r') as f:
-            data = json.load(f)
-
-    # replace empty string as None
-    df = pd.DataFrame(data).replace('', None)
-
-    # if empty REDCap
-    if len(df) == 0:
-        logger.warn(f'There are no records for {site_code_study}')
-        remove_file_that_may_exist(metadata_study)
-        return
-
-    # only keep AMPSCZ rows
-    df = df[df[redcap_id_colname].str.match('[A-Z]{2}\d{5}')]
-
-    # if no data matches AMPSCZ ID
-    if len(df) == 0:
+    # if empty REDCap, or if no data matches AMPSCZ ID
+    if df_final is None:
         logger.warn(f'There are no records for {site_code_study}')
         remove_file_that_may_exist(metadata_study)
         return
 
-    # make a single row for each subject record
-    # redcap_event_name column contains timepoint information (different arms)
-    df.drop('redcap_event_name', axis=1, inplace=True)
-
-    df_final = pd.DataFrame()
-    for subject, df_tmp in df.groupby(redcap_id_colname):
-        df_new = pd.concat(
-            [df_tmp[col].dropna().reset_index(drop=True) for col in df_tmp],
-            axis=1)
-        df_final = pd.concat([df_final, df_new], axis=0)
-
     # drop if consent date is missing
-    df_final = df_final[
-            ~df_final[redcap_consent_colname].isnull()].reset_index()
+    df_final = df_final[~df_final[redcap_consent_colname].isnull()]
 
     # skip no data has consent date
     if len(df_final) == 0:
@@ -162,57 +119,101 @@ def initialize_metadata(Lochness: 'Lochness object',
         remove_file_that_may_exist(metadata_study)
         return
 
-    df = pd.DataFrame()
-
     # extract subject ID and source IDs for each sources
-    for index, row in df_final.iterrows():
-        subject_id = row[redcap_id_colname]
-        # Subject ID
-        subject_dict = {'Subject ID': subject_id, 'Study': site_code_study}
+    subject_ids = df_final[redcap_id_colname]
+    df = pd.DataFrame({
+        'Active': 1,  # register all of the lables as active
+        'Consent': df_final[redcap_consent_colname],
+        'Subject ID': subject_ids,
+        'Study': site_code_study,
+        'REDCap': f'redcap.{project_name}:' + subject_ids + \
+                  ';redcap.UPENN:' + subject_ids,  # UPENN REDCAP
+        'Box': f'box.{study_name}:' + subject_ids,
+        'XNAT': f'xnat.{study_name}:*:' + subject_ids,
+        })
+
+    # for the datatype, which requires ID extraction from REDCap
+    for source, (source_name, source_field_name) \
+            in source_source_name_dict.items():
+        source_ids = df_final[source_field_name]
+        if source_ids.notnull().any():
+            df[source_name] = (f'{source}.{study_name}:' + source_ids) \
+                    .where(source_ids.notnull())
 
-        # Consent date
-        subject_dict['Consent'] = row[redcap_consent_colname]
+    # only overwrite when there is an update in the data
+    content = df.to_csv(index=False)
+    if metadata_study.is_file() and \
+            lochness.crc32file(metadata_study) == lochness.crc32(content):
+        pass
+    else:
+        lochness.atomic_write(metadata_study, content.encode('utf-8'))
 
-        # Redcap default information
-        subject_dict['REDCap'] = \
-                f'redcap.{project_name}:{subject_id}'
-        subject_dict['REDCap'] += \
-                f';redcap.UPENN:{row[redcap_id_colname]}'  # UPENN REDCAP
-        subject_dict['Box'] = f'box.{study_name}:{subject_id}'
-        subject_dict['XNAT'] = f'xnat.{study_name}:*:{subject_id}'
 
-        # for the datatype, which requires ID extraction from REDCap
-        for source, (source_name, source_field_name) \
-                in source_source_name_dict.items():
-            if pd.isnull(row[source_field_name]):
-                pass
-            else:
-                value = row[source_field_name]
-                subject_dict[source_name] = f"{source}.{study_name}:{value}"
+@cycle_cache
+def get_metadata_records_by_site(api_url: str,
+                                 api_key: str,
+                                 redcap_id_colname: str,
+                                 redcap_consent_colname: str,
+                                 source_field_names: tuple,
+                                 alias: str = None) -> dict:
+    '''Pull ID, consent date and source ID fields of all records in a project
 
-        subject_df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
-        df = pd.concat([df, subject_df_tmp.T])
+    The records are pulled from the screening and baseline arms in a single
+    query, once per sync cycle, and split by site code, which is the first
+    two letters of the AMP-SCZ ID. Each subject is reduced to a single row
+    made of the first non-empty value of each field across its events.
 
-    # register all of the lables as active
-    df['Active'] = 1
+    Key Arguments:
+        api_url: REDCap API url, str.
+        api_key: REDCap API key, str.
+        redcap_id_colname: Name of the ID field name in REDCap, str.
+        redcap_consent_colname: Name of the consent date field name in
+                                REDCap, str.
+        source_field_names: names of the source ID fields in REDCap, tuple.
+        alias: REDCap keyring alias, for the rate limit, str.
 
-    # reorder columns to match lochness metadata format
-    main_cols = ['Active', 'Consent', 'Subject ID']
-    df = df[main_cols + \
-            [x for x in df.columns if x not in main_cols]]
+    Returns:
+        dictionary of site code to dataframe with one row per subject,
+        sorted by subject ID.
+    '''
+    fields = [redcap_id_colname, redcap_consent_colname] + \
+        list(source_field_names)
+    record_query = {
+        'token': api_key,
+        'content': 'record',
+        'format': 'json',
+        'events[0]': 'screening_arm_1',
+        'events[1]': 'screening_arm_2',
+        'events[2]': 'baseline_arm_1',
+        'events[3]': 'baseline_arm_2',
+        }
+    for num, field in enumerate(fields):
+        record_query[f'fields[{num}]'] = field
+
+    # pull all records from the project's REDCap repo, only keeping AMPSCZ
+    # rows while the response is parsed
+    ampscz_id = re.compile(r'[A-Z]{2}\d{5}')
+    records = (record for record in iter_records_from_redcap(
+                   api_url,
+                   record_query,
+                   f'initializing data {alias}',
+                   alias=alias)
+               if ampscz_id.match(str(record.get(redcap_id_colname, ''))))
 
-    # only overwrite when there is an update in the data
-    if metadata_study.is_file():
-        target_df = pd.read_csv(metadata_study)
-    else:
-        target_df = pd.DataFrame()
+    # replace empty string as None
+    df = pd.DataFrame.from_records(records).replace('', None)
+    if len(df) == 0:
+        return {}
 
-    same_df = df.reset_index(drop=True).equals(target_df)
+    # make a single row for each subject record, across the events
+    for field in fields:
+        if field not in df.columns:
+            df[field] = None
+    df = df[fields].groupby(redcap_id_colname, sort=True).first() \
+        .reset_index()
 
-    if same_df:
-        pass
-    else:
-        df.to_csv(metadata_study, index=False)
+    return {site: site_df.reset_index(drop=True)
+            for site, site_df in df.groupby(df[redcap_id_colname].str[:2])}
 
 
 def initialize_metadata_rm(Lochness: 'Lochness object',
@@ -269,18 +270,13 @@ def initialize_metadata_rm(Lochness: 'Lochness object',
         record_query[f"fields[{2+num}]"] = source_field_name
 
     # pull all records from the project's REDCap repo
-    content = post_to_redcap(api_url,
-                             record_query,
-                             f'initializing data {study_name}')
-
-    # load pulled information as a list of dictionaries
-    with tf.NamedTemporaryFile(suffix='tmp.json') as tmpfilename:
-        lochness.atomic_write(tmpfilename.name, content)
-        with open(tmpfilename.name, 'r') as f:
-            data = json.load(f)
+    data = iter_records_from_redcap(api_url,
+                                    record_query,
+                                    f'initializing data {study_name}',
+                                    alias=f'redcap.{project_name}')
 
     # replace empty string as None
-    df = pd.DataFrame(data).replace('', None)
+    df = pd.DataFrame.from_records(data).replace('', None)
 
     # if empty REDCap
     if len(df) == 0:
@@ -454,9 +450,26 @@ def get_run_sheets_for_datatypes_rm(api_url, api_key,
             os.chmod(run_sheet_output, 0o0755)
 
 
+RUN_SHEETS = {
+    'eeg': ['eeg_run_sheet'],
+    'mri': ['mri_run_sheet'],
+    'interviews': ['speech_sampling_run_sheet'],
+    'phone': ['digital_biomarkers_mindlamp_onboarding',
+              'digital_biomarkers_mindlamp_checkin'],
+    'actigraphy': ['digital_biomarkers_axivity_onboarding',
+                   'digital_biomarkers_axivity_checkin'],
+    'surveys': ['penncnb']}
+
+RECORD_KEY_FIELDS = ['redcap_event_name', 'redcap_repeat_instrument',
+                     'redcap_repeat_instance']
+
+
 def get_run_sheets_for_datatypes(api_url, api_key,
                                  redcap_subject, id_field,
-                                 json_path: Union[Path, str]) -> None:
+                                 json_path: Union[Path, str],
+                                 alias: str = None,
+                                 content_dict_list: List[dict] = None,
+                                 run_sheets: dict = None) -> None:
     '''Extract run sheet information from REDCap JSON and save as csv file
 
     For each data types, there should a record of the data acquisition in the
@@ -475,57 +488,43 @@ def get_run_sheets_for_datatypes(api_url, api_key,
     "baseline_arm_1". Each list will have information about of the repeated run
     sheets.
 
+    The run sheets are extracted from the records already saved in json_path,
+    in a single pass, using the fields of each run sheet form listed in the
+    data dictionary of the project (downloaded once per sync cycle). A run
+    sheet csv is only written when its content changes.
+
     Key Arguments:
         - json_path: REDCap json path, Path.
+        - alias: REDCap keyring alias used for rate limiting, str.
+        - content_dict_list: records saved in json_path, list of dict. Read
+                             from json_path if not given.
+        - run_sheets: run sheet rows already extracted from the records with
+                      RunSheetExtractor, dict.
 
     Returns:
         - None
     '''
-    if not json_path.is_file():
-        return
-
-    raw_path = Path(json_path).parent.parent
-
-    mod_run_sheet_name_dict = {
-            'eeg':['eeg_run_sheet'],
-            'mri':['mri_run_sheet'],
-            'interviews':['speech_sampling_run_sheet'],
-            'phone':['digital_biomarkers_mindlamp_onboarding',
-                     'digital_biomarkers_mindlamp_checkin'],
-            'actigraphy':['digital_biomarkers_axivity_onboarding',
-                          'digital_biomarkers_axivity_checkin'],
-            'surveys': ['penncnb'] }
-
-    for modality, run_sheet_names in mod_run_sheet_name_dict.items():
+    json_path = Path(json_path)
+    if run_sheets is None:
+        if content_dict_list is None:
+            if not json_path.is_file():
+                return
+            with open(json_path, 'r') as fp:
+                content_dict_list = json.load(fp)
+
+        field_forms = get_data_dictionary(api_url, api_key,
+                                          alias=alias).field_forms
+        run_sheets = extract_run_sheets(content_dict_list, field_forms,
+                                        id_field)
+
+    raw_path = json_path.parent.parent
+    output_name = json_path.name.split('.json')[0]
+    for modality, run_sheet_names in RUN_SHEETS.items():
         for run_sheet_name in run_sheet_names:
-            redcap_subject_sl = redcap_subject.lower()
-
-            metadata_query = {'token': api_key,
-                    'content': 'record',
-                    'format': 'json',
-                    'forms[0]': run_sheet_name,
-                    'filterLogic': f"[{id_field}] = '{redcap_subject}' or "
-                                   f"[{id_field}] = '{redcap_subject_sl}'",
-                    'rawOrLabel': 'raw',
-                    }
-
-            try:
-                content = post_to_redcap(api_url, metadata_query, '').decode(
-                        'utf-8')
-            except:
-                print(f"{redcap_subject}: {run_sheet_name} does not exist"
-                      " in REDCap")
-                continue
-
-            content_dict_list = json.loads(content)
-
-            # select the right form, and ignore the weird empty dictionary
-            content_dict_list = [x for x in content_dict_list if
-                    x[run_sheet_name+'_complete'] != '']
-
             # for run sheet at each timepoint - baseline, follow up1, etc.
             # content_num is set to start with 1 to match the session number
-            for content_num, content_dict in enumerate(content_dict_list, 1):
+            for content_num, content_dict in enumerate(
+                    run_sheets[run_sheet_name], 1):
                 content_df = pd.DataFrame.from_dict(content_dict,
                                                     orient='index',
                                                     columns=['field_value'])
@@ -540,10 +539,8 @@ def get_run_sheets_for_datatypes(api_url, api_key,
 
                 raw_modality_path = raw_path / modality
                 raw_modality_path.mkdir(exist_ok=True, parents=True)
-                output_name = Path(json_path).name.split('.json')[0]
-                
+
                 # output run sheet path
-                suffix = '' if content_num == 1 else f"_{content_num}"
                 if modality == 'surveys':  # run sheet for PENN CNB
                     run_sheet_output = raw_modality_path / \
                        f'{output_name}.Run_sheet_PennCNB_{content_num}.csv'
@@ -558,40 +555,147 @@ def get_run_sheets_for_datatypes(api_url, api_key,
                            f'{output_name}.' \
                            f'Run_sheet_{modality}_{content_num}.csv'
 
-                if run_sheet_output.is_file():
-                    target_df = pd.read_csv(run_sheet_output, index_col=0)
-                    with tf.NamedTemporaryFile(suffix='tmp.csv') as tmp_file:
-                        content_df.to_csv(tmp_file.name)
-                        check_df = pd.read_csv(tmp_file.name, index_col=0)
-                    
-                    same_df = check_df.equals(target_df)
-
-                    if same_df:
-                        print('Not saving run sheet')
-                        continue
+                content = content_df.to_csv().encode('utf-8')
+                if run_sheet_output.is_file() and \
+                        lochness.crc32file(run_sheet_output) == \
+                        lochness.crc32(content.decode('utf-8')):
+                    logger.debug(f'Not saving run sheet {run_sheet_output}')
+                    continue
 
-                content_df.to_csv(run_sheet_output)
+                lochness.atomic_write(run_sheet_output, content)
                 os.chmod(run_sheet_output, 0o0755)
 
 
+class RunSheetExtractor(object):
+    '''Collect the run sheet rows of REDCap records in a single pass
+
+    Records are added one at a time, eg) while they are streamed to the json
+    file, and only the values of the run sheet forms are kept.
+
+    Key Arguments:
+        field_forms: field name -> form name, from the data dictionary, dict.
+        id_field: name of the record ID field, str.
+        forms: forms to extract, list of str. Defaults to all run sheets.
+    '''
+    def __init__(self, field_forms: dict, id_field: str,
+                 forms: List[str] = None):
+        if forms is None:
+            forms = [x for names in RUN_SHEETS.values() for x in names]
+        self.field_forms = field_forms
+        self.id_field = id_field
+        self.forms = forms
+        self.key_forms = {}
+        self.rows = {form: [] for form in forms}
+
+    def _key_form(self, key: str) -> str:
+        if key.endswith('_complete') and key[:-9] in self.rows:
+            return key[:-9]
+        elif key == self.id_field or key in RECORD_KEY_FIELDS:
+            return None
+        return self.field_forms.get(key.split('___')[0])
+
+    def add(self, content_dict: dict) -> None:
+        for key in content_dict:
+            if key not in self.key_forms:
+                self.key_forms[key] = self._key_form(key)
+
+        for form in self.forms:
+            if content_dict.get(f'{form}_complete', '') == '':
+                continue
+            self.rows[form].append(
+                    {key: value for key, value in content_dict.items()
+                     if self.key_forms[key] in (form, None)})
+
+    def observe(self, records: Iterable[dict]) -> Iterator[dict]:
+        '''yield the records, adding each of them on the way'''
+        for content_dict in records:
+            self.add(content_dict)
+            yield content_dict
+
+    def run_sheets(self) -> dict:
+        '''Return the rows of each run sheet form
+
+        The keys of the rows are the record ID, event and repeat instance
+        fields, followed by the fields of the form seen in any record, and
+        the form complete status.
+        '''
+        keys = list(self.key_forms)
+        common_keys = [x for x in [self.id_field] + RECORD_KEY_FIELDS
+                       if x in self.key_forms]
+        run_sheets = {}
+        for form in self.forms:
+            form_keys = common_keys + \
+                [x for x in keys if self.key_forms[x] == form and
+                 x != f'{form}_complete'] + \
+                [x for x in keys if x == f'{form}_complete']
+            run_sheets[form] = [{key: row.get(key, '') for key in form_keys}
+                                for row in self.rows[form]]
+        return run_sheets
+
+
+def extract_run_sheets(content_dict_list: Iterable[dict],
+                       field_forms: dict,
+                       id_field: str,
+                       forms: List[str] = None) -> dict:
+    '''Split REDCap records into the rows of each run sheet form
+
+    Returns the same rows as an export of each form on its own: the record ID,
+    event and repeat instance fields, followed by the fields of the form
+    (including checkbox options, eg. chrmri_scanner___1) and the form
+    complete status, for the rows where the form complete status is not
+    empty.
+
+    Key Arguments:
+        content_dict_list: REDCap records, iterable of dict.
+        field_forms: field name -> form name, from the data dictionary, dict.
+        id_field: name of the record ID field, str.
+        forms: forms to extract, list of str. Defaults to all run sheets.
+
+    Returns:
+        dictionary of form name to list of row dictionaries, in the order of
+        the records.
+    '''
+    extractor = RunSheetExtractor(field_forms, id_field, forms)
+    for content_dict in content_dict_list:
+        extractor.add(content_dict)
+    return extractor.run_sheets()
+
+
 def check_if_modified(subject_id: str,
                       existing_json: str,
-                      df: pd.DataFrame) -> bool:
+                      df: Union[pd.DataFrame, dict],
+                      last_pull_time: float = None) -> bool:
     '''Check if subject data has been modified in the data entry trigger db
 
-    Comparing unix times of the json modification and lastest redcap update
-    '''
+    Comparing unix times of the json modification, or the last pull from
+    REDCap if it is more recent, and lastest redcap update.
 
+    Key Arguments:
+        subject_id: REDCap record ID, str.
+        existing_json: path of the subject json file, str or Path.
+        df: data entry trigger database, either as a dataframe or as a
+            dictionary of record ID to the latest timestamp returned by
+            get_data_entry_trigger_index.
+        last_pull_time: unix time of the last pull from REDCap, float.
+    '''
     json_modified_time = Path(existing_json).stat().st_mtime  # in unix time
+    if last_pull_time is not None:
+        json_modified_time = max(json_modified_time, last_pull_time)
+
+    if isinstance(df, dict):
+        lastest_update_time = df.get(subject_id)
+        # if the subject does not exist in the DET_DB, return False
+        if lastest_update_time is None:
+            return False
+    else:
+        subject_df = df[df.record == subject_id]
 
-    subject_df = df[df.record == subject_id]
-
-    # if the subject does not exist in the DET_DB, return False
-    if len(subject_df) < 1:
-        return False
+        # if the subject does not exist in the DET_DB, return False
+        if len(subject_df) < 1:
+            return False
 
-    lastest_update_time = subject_df.loc[
-            subject_df['timestamp'].idxmax()].timestamp
+        lastest_update_time = subject_df.loc[
+                subject_df['timestamp'].idxmax()].timestamp
 
     if lastest_update_time > json_modified_time:
         return True
@@ -610,21 +714,334 @@ def get_data_entry_trigger_df(Lochness: 'Lochness',
     Returns:
         pandas dataframe for data entry trigger database
     '''
-    if 'redcap' in Lochness:
-        if 'data_entry_trigger_csv' in Lochness['redcap'][study]:
-            db_loc = Lochness['redcap'][study]['data_entry_trigger_csv']
-            if Path(db_loc).is_file():
-                db_df = pd.read_csv(db_loc)
-                try:
-                    db_df['record'] = db_df['record'].astype(str)
-                except KeyError:
-                    db_df = pd.DataFrame({'record':[]})
-                return db_df
+    db_path = data_entry_trigger_path(Lochness, study)
+    if db_path is not None:
+        if db_path.suffix == '.jsonl':
+            db_df = det_log.read_df(db_path)
+        else:
+            db_df = pd.read_csv(db_path)
+        try:
+            db_df['record'] = db_df['record'].astype(str)
+        except KeyError:
+            db_df = pd.DataFrame({'record':[]})
+        return db_df
 
     db_df = pd.DataFrame({'record':[]})
     return db_df
 
 
+def data_entry_trigger_path(Lochness: 'Lochness', study: str) -> Path:
+    '''Return the Data Entry Trigger database of a study, or None
+
+    The log written by listen_to_redcap.py is used when it exists, otherwise
+    the CSV database of the configuration file.
+    '''
+    if 'redcap' in Lochness:
+        if 'data_entry_trigger_csv' in Lochness['redcap'][study]:
+            return det_log.database_path(
+                    Lochness['redcap'][study]['data_entry_trigger_csv'])
+    return None
+
+
+def get_data_entry_trigger_index(Lochness: 'Lochness', study: str) -> dict:
+    '''Read Data Entry Trigger database as record ID -> latest timestamp
+
+    The database is read once per sync cycle, and again only when its size
+    or modification time changes.
+
+    Key Arguments:
+        Lochness: Lochness config object, obj.
+        study: study string, str. eg) PronetYA
+
+    Returns:
+        dictionary of REDCap record ID to the latest DET timestamp
+    '''
+    db_path = data_entry_trigger_path(Lochness, study)
+    if db_path is not None:
+        db_stat = db_path.stat()
+        return _read_data_entry_trigger_index(
+                str(db_path), db_stat.st_mtime, db_stat.st_size)
+
+    return {}
+
+
+@cycle_cache
+def _read_data_entry_trigger_index(db_loc: str,
+                                   mtime: float,
+                                   size: int) -> dict:
+    '''read the DET database into a dictionary of record -> timestamp'''
+    if db_loc.endswith('.jsonl'):
+        index = {}
+        for entry in det_log.read_current(db_loc):
+            record, timestamp = entry.get('record'), entry.get('timestamp')
+            if record is None or timestamp is None:
+                continue
+            record = str(record)
+            index[record] = max(index.get(record, timestamp), timestamp)
+        return index
+
+    db_df = pd.read_csv(db_loc)
+    if 'record' not in db_df.columns or 'timestamp' not in db_df.columns:
+        return {}
+
+    db_df = db_df.dropna(subset=['record', 'timestamp'])
+    return db_df.groupby(db_df['record'].astype(str))['timestamp'] \
+        .max().to_dict()
+
+
+# records modified shortly before the watermark are exported again, to cover
+# the difference between the REDCap server timezone or clock and ours
+WATERMARK_OVERLAP = datetime.timedelta(days=1)
+
+_pending_watermarks = {}
+_pending_watermarks_lock = threading.Lock()
+
+
+def watermark_mode(Lochness: 'Lochness') -> bool:
+    '''True if REDCap records are pulled incrementally from watermarks'''
+    return Lochness.get('redcap_watermarks', False) is True
+
+
+def get_watermark(Lochness: 'Lochness',
+                  redcap_instance: str,
+                  redcap_project: str) -> float:
+    '''Return unix time of the last successful sync of a project, or None'''
+    record = state.get(Lochness).get('redcap_watermarks',
+                                     redcap_instance, redcap_project)
+    if record is None or record.remote_version is None:
+        return None
+    return float(record.remote_version)
+
+
+def watermark_project(Lochness: 'Lochness',
+                      redcap_project: str,
+                      subject: 'Subject' = None) -> str:
+    '''Return the key of the watermark of a project for a subject
+
+    When subjects are sharded across sync nodes, each shard keeps its own
+    watermark, since a node only syncs the subjects of its shards.
+    '''
+    node_shard = Lochness.get('shard')
+    if node_shard is None or subject is None:
+        return redcap_project
+    subject_shard = shard.shard_of(subject.study, subject.id,
+                                   node_shard.count)
+    return f'{redcap_project}#shard{subject_shard}of{node_shard.count}'
+
+
+def _register_watermark(redcap_instance: str,
+                        redcap_project: str,
+                        watermark: float) -> None:
+    '''keep the earliest watermark of a project seen in this cycle'''
+    with _pending_watermarks_lock:
+        _pending_watermarks.setdefault((redcap_instance, redcap_project),
+                                       watermark)
+
+
+def commit_watermarks(Lochness: 'Lochness', success: bool = True) -> None:
+    '''Save the watermarks of this cycle, if all REDCap syncs succeeded
+
+    Watermarks are only moved forward after every REDCap sync job of the
+    cycle succeeded, so the records modified since the previous watermark
+    are pulled again if any subject failed. success is also False after a
+    sync of selected subjects, eg) for data entry triggers, as the other
+    subjects of the project were not checked.
+    '''
+    with _pending_watermarks_lock:
+        pending = dict(_pending_watermarks)
+        _pending_watermarks.clear()
+
+    if not success:
+        if pending:
+            logger.info('watermarks are not updated in this cycle')
+        return
+
+    store = state.get(Lochness)
+    for (redcap_instance, redcap_project), watermark in pending.items():
+        logger.debug(f'{redcap_instance} {redcap_project} watermark: '
+                     f'{datetime.datetime.fromtimestamp(watermark)}')
+        store.put('redcap_watermarks', redcap_instance, redcap_project,
+                  remote_version=watermark)
+
+
+@cycle_cache
+def export_modified_records(api_url: str,
+                            api_key: str,
+                            id_field: str,
+                            since: float,
+                            alias: str = None) -> dict:
+    '''Export records created or modified since a unix time
+
+    One query per project per sync cycle, using dateRangeBegin set
+    WATERMARK_OVERLAP before since.
+
+    Returns:
+        dictionary of record ID to list of record dictionaries.
+    '''
+    date_range_begin = datetime.datetime.fromtimestamp(since) - \
+        WATERMARK_OVERLAP
+    record_query = {'token': api_key,
+                    'content': 'record',
+                    'format': 'json',
+                    'dateRangeBegin': date_range_begin.strftime(
+                        '%Y-%m-%d %H:%M:%S')}
+
+    records = col.OrderedDict()
+    for record in iter_records_from_redcap(
+            api_url,
+            record_query,
+            (alias, 'modified since', record_query['dateRangeBegin']),
+            alias=alias):
+        records.setdefault(str(record.get(id_field)), []).append(record)
+
+    logger.debug(f'{alias}: {len(records)} records modified since '
+                 f'{record_query["dateRangeBegin"]}')
+    return records
+
+
+def get_modified_subject_records(Lochness: 'Lochness',
+                                 api_url: str,
+                                 api_key: str,
+                                 redcap_instance: str,
+                                 redcap_project: str,
+                                 redcap_subject: str,
+                                 subject: 'Subject' = None) -> List[dict]:
+    '''Return the records of a subject modified since the project watermark
+
+    Key Arguments:
+        Lochness: Lochness config object, obj.
+        api_url: REDCap API url, str.
+        api_key: REDCap API key, str.
+        redcap_instance: name of the redcap field in the keyring,
+                         str. eg) redcap.Pronet
+        redcap_project: name of the redcap project in the keyring, str.
+        redcap_subject: REDCap record ID of the subject, str.
+        subject: lochness subject, for the watermark of its shard.
+
+    Returns:
+        copies of the modified records of the subject in upper or lower case,
+        which may be an empty list, or None if watermark mode is off or the
+        project does not have a watermark yet.
+    '''
+    if not watermark_mode(Lochness):
+        return None
+
+    # the watermark of this cycle is set before anything is exported
+    watermark_key = watermark_project(Lochness, redcap_project, subject)
+    _register_watermark(redcap_instance, watermark_key, time.time())
+
+    watermark = get_watermark(Lochness, redcap_instance, watermark_key)
+    if watermark is None:
+        return None
+
+    records = export_modified_records(api_url, api_key,
+                                      Lochness['redcap_id_colname'],
+                                      watermark, alias=redcap_instance)
+    return [dict(x)
+            for record_id in dict.fromkeys([redcap_subject,
+                                            redcap_subject.lower()])
+            for x in records.get(record_id, [])]
+
+
+def merge_records(records: List[dict],
+                  updates: List[dict],
+                  id_field: str) -> List[dict]:
+    '''Merge updated REDCap records into existing records
+
+    Records are matched by record ID, event and repeat instance. Matching
+    records are replaced in place, and new ones are added at the end.
+    '''
+    def key(record):
+        return (str(record.get(id_field, '')),
+                record.get('redcap_event_name', ''),
+                record.get('redcap_repeat_instrument', ''),
+                str(record.get('redcap_repeat_instance', '')))
+
+    merged = col.OrderedDict((key(x), x) for x in records)
+    for record in updates:
+        merged[key(record)] = record
+    return list(merged.values())
+
+
+def last_pull_time(Lochness: 'Lochness', subject_id: str,
+                   fname: str) -> float:
+    '''Return unix time of the last pull of a REDCap json, or None'''
+    record = state.get(Lochness).get('redcap', subject_id, fname)
+    if record is None or record.remote_version is None:
+        return None
+    return float(record.remote_version)
+
+
+def needs_sync(Lochness: 'Lochness', subject: 'Subject') -> bool:
+    '''Check if REDCap data of a subject may have changed since last pull
+
+    Subjects from UPENN REDCap, subjects without a json file and subjects
+    with a data entry trigger update since their last pull need a sync. In
+    watermark mode, subjects with records modified since the watermark of
+    the project need a sync instead of the ones with data entry trigger
+    updates. Any error is left for sync to report, so the subject is
+    returned as due.
+    '''
+    try:
+        dst_folder = tree.get('surveys',
+                              subject.protected_folder,
+                              processed=False,
+                              BIDS=Lochness['BIDS'],
+                              makedirs=False)
+        det_index = None
+        for redcap_instance, redcap_subject in iterate(subject):
+            # UPENN redcap does not have data entry trigger
+            if 'UPENN' in redcap_instance:
+                return True
+
+            for redcap_project, api_url, api_key in redcap_projects(
+                    Lochness, subject.study, redcap_instance):
+                _redcap_project = re.sub(r'[\W]+', '_',
+                                         redcap_project.strip())
+                fname = f'{redcap_subject}.{_redcap_project}.json'
+                dst = Path(dst_folder) / fname
+                if not dst.is_file():
+                    return True
+
+                # records modified since the watermark of the project
+                modified_records = get_modified_subject_records(
+                        Lochness, api_url, api_key,
+                        redcap_instance, redcap_project, redcap_subject,
+                        subject=subject)
+                if modified_records is not None:
+                    if modified_records:
+                        return True
+                    continue
+
+                if det_index is None:
+                    det_index = get_data_entry_trigger_index(Lochness,
+                                                             subject.study)
+                if check_if_modified(
+                        redcap_subject, dst, det_index,
+                        last_pull_time(Lochness, subject.id, fname)):
+                    return True
+    except Exception as e:
+        logger.debug(f'{subject.study}/{subject.id} REDCap plan: {e}')
+        return True
+
+    return False
+
+
+def plan_sync(Lochness: 'Lochness', subjects: list) -> list:
+    '''Return the subjects whose REDCap data need a sync in this cycle
+
+    Key Arguments:
+        Lochness: Lochness config object, obj.
+        subjects: list of Subject objects.
+
+    Returns:
+        list of Subject objects, in the same order, for which needs_sync is
+        True.
+    '''
+    return [subject for subject in subjects
+            if needs_sync(Lochness, subject)]
+
+
 @net.retry(max_attempts=5)
 def sync(Lochness, subject, dry=False):
 
@@ -661,14 +1078,31 @@ def sync(Lochness, subject, dry=False):
             # check if the data has been updated by checking the redcap data
             # entry trigger db
             # UPENN redcap does not have data download limit, therefore no DET
+            modified_records = None
             if 'UPENN' in redcap_instance:
                 pass
             else:
+                # in watermark mode, only the records modified since the
+                # last successful sync of the project are pulled
                 if dst.is_file():
-                    # load dataframe for redcap data entry trigger
-                    db_df = get_data_entry_trigger_df(Lochness, subject.study)
+                    modified_records = get_modified_subject_records(
+                            Lochness, api_url, api_key,
+                            redcap_instance, redcap_project, redcap_subject,
+                            subject=subject)
 
-                    if check_if_modified(redcap_subject, dst, db_df):
+                if modified_records is not None:
+                    if not modified_records:
+                        logger.debug(f"{subject.study}/{subject.id} "
+                                     "No updates since the watermark")
+                        break
+                elif dst.is_file():
+                    # load redcap data entry trigger, once per sync cycle
+                    det_index = get_data_entry_trigger_index(Lochness,
+                                                             subject.study)
+
+                    if check_if_modified(
+                            redcap_subject, dst, det_index,
+                            last_pull_time(Lochness, subject.id, fname)):
                         pass  # if modified, download REDCap data
                     else:
                         logger.debug(f"{subject.study}/{subject.id} "
@@ -680,28 +1114,10 @@ def sync(Lochness, subject, dry=False):
 
             if 'UPENN' in redcap_instance:
                 # UPENN REDCap is set up with its own record_id, but have added
-                # "session_subid" field to note AMP-SCZ ID
+                # "session_subid" field to note AMP-SCZ ID. The records are
+                # taken from a snapshot of the project pulled once per cycle
                 redcap_subject_sl = redcap_subject.lower()
-                digits = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-                digits_str = [str(x) for x in digits]
-                contains_logic = []
-                for subject_id in [redcap_subject, redcap_subject_sl]:
-                    contains_logic += [
-                            f"contains([session_subid], '{subject_id}_{x}')"
-                            for x in digits_str]
-                    contains_logic += [
-                            f"contains([session_subid], '{subject_id}={x}')"
-                            for x in digits_str]
-
-
-                record_query = {
-                    'token': api_key,
-                    'content': 'record',
-                    'format': 'json',
-                    'filterLogic': f"[session_subid] = '{redcap_subject}' or "
-                                   f"[session_subid] = '{redcap_subject_sl}' or "
-                                   f"{' or '.join(contains_logic)}"
-                }
+                record_query = None
 
             else:
                 id_field = Lochness['redcap_id_colname']
@@ -714,86 +1130,238 @@ def sync(Lochness, subject, dry=False):
                     'records[1]': redcap_subject_sl
                    }
 
+            # records of many subjects are exported together in batch mode
+            batch = record_batch(Lochness, subject, redcap_instance,
+                                 redcap_subject) \
+                if 'UPENN' not in redcap_instance else None
+
+            # the data dictionary, downloaded once per sync cycle, is fetched
+            # before the records are streamed, as the stream holds a slot of
+            # the rate limit of the REDCap instance until it is read
+            data_dictionary = None
+            if deidentify or 'UPENN' not in redcap_instance:
+                data_dictionary = get_data_dictionary(
+                        api_url, api_key, alias=redcap_instance)
+
             # post query to redcap
-            content = post_to_redcap(api_url,
-                                     record_query,
-                                     _debug_tup)
+            pull_time = time.time()
+            if 'UPENN' in redcap_instance:
+                content_dict_list = get_upenn_subject_records(
+                        api_url, api_key, redcap_subject,
+                        alias=redcap_instance)
+            elif modified_records is not None:
+                content_dict_list = modified_records
+            elif batch:
+                content_dict_list = get_subject_records_from_batch(
+                        api_url, api_key, batch, id_field,
+                        (redcap_subject, redcap_subject_sl),
+                        alias=redcap_instance)
+            else:
+                # records are streamed from the response to the json file
+                content_dict_list = iter_records_from_redcap(
+                        api_url,
+                        record_query,
+                        _debug_tup,
+                        alias=redcap_instance)
 
             # check if response body is nothing but a sad empty array
-            if content.strip() == b'[]':
+            records = iter(content_dict_list)
+            first_record = next(records, None)
+            if first_record is None:
                 logger.info(f'no redcap data for {redcap_subject}')
                 continue
+            records = itertools.chain([first_record], records)
 
-            content_dict_list = json.loads(content)
             if deidentify:
-                # get fields that contains PII
-                metadata_query = {'token': api_key,
-                                  'content': 'metadata',
-                                  'format': 'json'}
-                content = post_to_redcap(api_url,
-                                         metadata_query,
-                                         _debug_tup)
-
-                metadata = json.loads(content)
-                for content_dict in content_dict_list:
-                    for field in metadata:
-                        if field['identifier'] == 'y':
-                            try:
-                                content_dict.pop(field['field_name'])
-                            except:
-                                pass
-                                # print("lochness did not pull " \
-                                      # f"{field['field_name']}, which is a " \
-                                      # "deidentified field")
-
-            content = json.dumps(content_dict_list).encode('utf-8')
+                # get fields that contains PII, from the data dictionary
+                identifier_fields = data_dictionary.identifier_fields
+                records = ({key: value for key, value in x.items()
+                            if key not in identifier_fields}
+                           for x in records)
+
+            # merge the modified records into the records saved before
+            if modified_records is not None:
+                with open(dst, 'r') as fp:
+                    records = merge_records(json.load(fp), records, id_field)
+
+            # run sheet rows are collected while the records are written
+            run_sheets = None
+            if 'UPENN' not in redcap_instance:
+                run_sheets = RunSheetExtractor(data_dictionary.field_forms,
+                                               id_field)
+                records = run_sheets.observe(records)
 
             if not dry:
-                if not os.path.exists(dst):
-                    logger.debug(f'saving {dst}')
-                    lochness.atomic_write(dst, content)
-                    # Extract run sheet information
-                    if 'UPENN' in redcap_instance:
-                        continue
-                    get_run_sheets_for_datatypes(api_url, api_key,
-                                                 subject.id, id_field,
-                                                 dst)
-                    # process_and_copy_db(Lochness, subject, dst, proc_dst)
-                    # update_study_metadata(subject, json.loads(content))
-                    
-                else:
-                    # responses are not stored atomically in redcap
-                    crc_src = lochness.crc32(content.decode('utf-8'))
-                    crc_dst = lochness.crc32file(dst)
-
-                    if crc_dst != crc_src:
-                        logger.info('different - crc32: downloading data')
-                        logger.warn(f'file has changed {dst}')
-                        # lochness.backup(dst)
-                        logger.debug(f'saving {dst}')
-                        lochness.atomic_write(dst, content)
-
-                        if 'UPENN' in redcap_instance:
-                            continue
-                        # Extract run sheet information
-                        get_run_sheets_for_datatypes(api_url, api_key,
-                                                     subject.id, id_field,
-                                                     dst)
-                        # process_and_copy_db(Lochness, subject, dst, proc_dst)
-                        # update_study_metadata(subject, json.loads(content))
-                    else:
-                        logger.info('No new update in newly downloaded '
-                                    f'content for {redcap_subject}. '
-                                    'Not saving the data')
-                        # update the dst file's mtime so it can prevent the
-                        # same file being pulled from REDCap
-                        # os.utime(dst)
+                # responses are not stored atomically in redcap, the file is
+                # only replaced when the crc32 of the records has changed.
+                # The crc32 of the existing file is taken from the state
+                # store, unless the file has been modified since.
+                store = state.get(Lochness)
+                existing_dst = dst.is_file()
+                dst_crc = store.local_hash('redcap', subject.id, fname, dst) \
+                    if existing_dst else None
+                logger.debug(f'saving {dst}')
+                changed, crc = write_records_json(records, dst,
+                                                  dst_crc=dst_crc)
+
+                # record the pull in the state store so it can prevent the
+                # same file being pulled from REDCap until the next data
+                # entry trigger update
+                store.put('redcap', subject.id, fname,
+                          remote_version=pull_time,
+                          local_hash=crc, local_path=dst)
+
+                if not changed:
+                    logger.info('No new update in newly downloaded '
+                                f'content for {redcap_subject}. '
+                                'Not saving the data')
+                    continue
+
+                if existing_dst:
+                    logger.info('different - crc32: downloading data')
+                    logger.warn(f'file has changed {dst}')
+
+                if 'UPENN' in redcap_instance:
+                    continue
+
+                # Extract run sheet information
+                get_run_sheets_for_datatypes(
+                        api_url, api_key, subject.id, id_field,
+                        dst, alias=redcap_instance,
+                        run_sheets=run_sheets.run_sheets())
+                # process_and_copy_db(Lochness, subject, dst, proc_dst)
+                # update_study_metadata(subject, content_dict_list)
 
 
 class REDCapError(Exception):
     pass
 
 
+def record_batch(Lochness: 'Lochness',
+                 subject: 'Subject',
+                 redcap_instance: str,
+                 redcap_subject: str) -> tuple:
+    '''Return the batch of REDCap record IDs exported with redcap_subject
+
+    Batch mode is enabled by setting redcap_batch_size in the configuration
+    file, to the number of subjects exported in a single record request. The
+    record IDs of a redcap_instance are read from the study metadata file,
+    sorted and split into batches of redcap_batch_size subjects, each subject
+    contributing its upper and lower case IDs.
+
+    Key Arguments:
+        Lochness: Lochness object.
+        subject: Subject object.
+        redcap_instance: name of the redcap field in the keyring,
+                         str. eg) redcap.Pronet
+        redcap_subject: REDCap record ID of the subject, str.
+
+    Returns:
+        tuple of record IDs, or None if batch mode is not enabled or the
+        subject is not listed in the metadata file.
+    '''
+    batch_size = Lochness.get('redcap_batch_size')
+    if not batch_size or int(batch_size) < 2:
+        return None
+
+    record_ids = metadata_redcap_ids(subject.metadata_csv, redcap_instance)
+    if redcap_subject not in record_ids:
+        return None
+
+    batch_size = int(batch_size)
+    start = record_ids.index(redcap_subject) // batch_size * batch_size
+    batch = []
+    for record_id in record_ids[start:start + batch_size]:
+        batch += [record_id, record_id.lower()]
+    return tuple(dict.fromkeys(batch))
+
+
+@cycle_cache
+def metadata_redcap_ids(metadata_csv: str, redcap_instance: str) -> tuple:
+    '''Sorted REDCap record IDs of a redcap_instance in a study metadata file
+
+    Read once per sync cycle.
+    '''
+    metadata_df = pd.read_csv(metadata_csv).astype(str)
+    if 'REDCap' not in metadata_df.columns:
+        return tuple()
+
+    record_ids = set()
+    for value, subject_id in zip(metadata_df['REDCap'],
+                                 metadata_df['Subject ID']):
+        try:
+            parsed = lochness._parse_redcap(value, subject_id.strip())
+        except lochness.StudyMetadataError:
+            continue
+        record_ids.update(parsed.get(redcap_instance, []))
+
+    return tuple(sorted(record_ids))
+
+
+@cycle_cache
+def export_record_batch(api_url: str,
+                        api_key: str,
+                        record_ids: tuple,
+                        id_field: str,
+                        alias: str = None) -> dict:
+    '''Export records of many subjects in a single request
+
+    The response is split locally by record ID, keeping the order of the
+    records in the REDCap response. The result is kept until the next sync
+    cycle, so every subject of the batch is served by the same request.
+
+    Key Arguments:
+        api_url: REDCap API url, str.
+        api_key: REDCap API key, str.
+        record_ids: REDCap record IDs to export, tuple of str.
+        id_field: name of the record ID field, str.
+        alias: REDCap keyring alias, for the rate limit, str.
+
+    Returns:
+        dictionary of record ID to list of record dictionaries.
+    '''
+    record_query = {'token': api_key,
+                    'content': 'record',
+                    'format': 'json'}
+    for num, record_id in enumerate(record_ids):
+        record_query[f'records[{num}]'] = record_id
+
+    logger.debug(f'Exporting a batch of {len(record_ids)} REDCap records '
+                 f'({alias})')
+    records = col.OrderedDict()
+    for record in iter_records_from_redcap(
+            api_url,
+            record_query,
+            (alias, 'batch', f'{record_ids[0]}..'),
+            alias=alias):
+        records.setdefault(str(record.get(id_field)), []).append(record)
+
+    return records
+
+
+def get_subject_records_from_batch(api_url: str,
+                                   api_key: str,
+                                   record_ids: tuple,
+                                   id_field: str,
+                                   redcap_subjects: tuple,
+                                   alias: str = None) -> List[dict]:
+    '''Return the records of a subject from a batch export
+
+    The records are in the same order as the response to a record request
+    for redcap_subjects alone, so the CRC based change detection works the
+    same way in batch mode. Each record is a copy, which can be modified.
+    '''
+    records = export_record_batch(api_url, api_key, record_ids,
+                                  id_field, alias=alias)
+
+    subject_records = []
+    for record_id, rows in records.items():
+        if record_id in redcap_subjects:
+            subject_records += [dict(x) for x in rows]
+
+    return subject_records
+
+
 def save_redcap_metadata(Lochness, subject):
     # get fields that contains PII
     for redcap_instance, redcap_subject in iterate(subject):
@@ -802,14 +1370,8 @@ def save_redcap_metadata(Lochness, subject):
 
             if 'UPENN' in redcap_instance:
                 continue
-            _debug_tup = (redcap_instance, redcap_project, redcap_subject)
-            metadata_query = {'token': api_key,
-                              'content': 'metadata',
-                              'format': 'csv',
-                              'returnFormat': 'json'}
-            content = post_to_redcap(api_url,
-                                     metadata_query,
-                                     _debug_tup)
+            content = get_data_dictionary(api_url, api_key,
+                                          alias=redcap_instance).content
 
             meta_data_dst = Path(Lochness['phoenix_root']) / 'GENERAL' / \
                     'redcap_metadata.csv'
@@ -823,6 +1385,137 @@ def save_redcap_metadata(Lochness, subject):
                 lochness.atomic_write(meta_data_dst, content)
 
 
+# AMP-SCZ ID in UPENN session_subid, either on its own or followed by a
+# session number, eg) AB00001, ab00001_1 or XX_AB00001=2
+AMPSCZ_ID_RE = re.compile(r'[A-Za-z]{2}\d{5}')
+UPENN_SESSION_RE = re.compile(r'(?=([A-Za-z]{2}\d{5})[_=][1-9])')
+
+
+def upenn_subject_ids(session_subid: str) -> set:
+    '''Return the AMP-SCZ IDs a UPENN session_subid refers to
+
+    Matches the per-subject filter previously sent to the UPENN REDCap: the
+    session_subid is the ID itself, or contains the ID followed by "_" or "="
+    and a session number. IDs are matched in upper or lower case only, and
+    returned in upper case.
+    '''
+    session_subid = str(session_subid)
+    candidates = [x.group(1) for x in UPENN_SESSION_RE.finditer(session_subid)]
+    if AMPSCZ_ID_RE.fullmatch(session_subid):
+        candidates.append(session_subid)
+
+    return set(x.upper() for x in candidates
+               if x == x.upper() or x == x.lower())
+
+
+@cycle_cache
+def get_upenn_snapshot(api_url: str,
+                       api_key: str,
+                       alias: str = None) -> dict:
+    '''Pull all records of the UPENN REDCap once, indexed by AMP-SCZ ID
+
+    The records are grouped by their record ID (the first field of each
+    record), and a record belongs to every AMP-SCZ ID found in the
+    session_subid of any of its rows.
+
+    Key Arguments:
+        api_url: REDCap API url, str.
+        api_key: REDCap API key, str.
+        alias: REDCap keyring alias, for the rate limit, str.
+
+    Returns:
+        dictionary of AMP-SCZ ID to list of records, in the order of the
+        REDCap response.
+    '''
+    record_query = {'token': api_key,
+                    'content': 'record',
+                    'format': 'json'}
+
+    rows_by_record = col.OrderedDict()
+    subject_ids_by_record = col.defaultdict(set)
+    for record in iter_records_from_redcap(api_url,
+                                           record_query,
+                                           (alias, 'snapshot', None),
+                                           alias=alias):
+        record_id = next(iter(record.values()), None)
+        rows_by_record.setdefault(record_id, []).append(record)
+        if record.get('session_subid'):
+            subject_ids_by_record[record_id].update(
+                    upenn_subject_ids(record['session_subid']))
+
+    snapshot = col.defaultdict(list)
+    for record_id, rows in rows_by_record.items():
+        for subject_id in subject_ids_by_record[record_id]:
+            snapshot[subject_id] += rows
+
+    logger.debug(f'{alias} snapshot: {len(rows_by_record)} records for '
+                 f'{len(snapshot)} subjects')
+    return dict(snapshot)
+
+
+def get_upenn_subject_records(api_url: str,
+                              api_key: str,
+                              redcap_subject: str,
+                              alias: str = None) -> List[dict]:
+    '''Return copies of the UPENN records of a subject from the snapshot'''
+    snapshot = get_upenn_snapshot(api_url, api_key, alias=alias)
+    return [dict(x) for x in snapshot.get(redcap_subject.upper(), [])]
+
+
+DataDictionary = col.namedtuple('DataDictionary', [
+    'content',            # data dictionary csv, as exported by REDCap
+    'field_forms',        # field name -> form name, in dictionary order
+    'identifier_fields'   # frozenset of fields marked as identifiers
+])
+
+DD_FIELD_NAME = 'Variable / Field Name'
+DD_FORM_NAME = 'Form Name'
+DD_IDENTIFIER = 'Identifier?'
+
+
+@cycle_cache
+def get_data_dictionary(api_url: str,
+                        api_key: str,
+                        alias: str = None) -> DataDictionary:
+    '''Download and parse the data dictionary of a REDCap project
+
+    The data dictionary is downloaded once per project per sync cycle, and
+    shared by the deidentification of every subject and by
+    save_redcap_metadata.
+
+    Key Arguments:
+        api_url: REDCap API url, str.
+        api_key: REDCap API key of the project, str.
+        alias: REDCap keyring alias, for the rate limit, str.
+
+    Returns:
+        DataDictionary
+    '''
+    metadata_query = {'token': api_key,
+                      'content': 'metadata',
+                      'format': 'csv',
+                      'returnFormat': 'json'}
+    content = post_to_redcap(api_url,
+                             metadata_query,
+                             (alias, 'data dictionary', None),
+                             alias=alias)
+
+    dictionary_df = pd.read_csv(BytesIO(content), dtype=str).fillna('')
+    missing = {DD_FIELD_NAME, DD_FORM_NAME, DD_IDENTIFIER} - \
+        set(dictionary_df.columns)
+    if missing:
+        raise REDCapError(f'data dictionary from {alias} is missing '
+                          f'columns: {sorted(missing)}')
+
+    field_forms = col.OrderedDict(zip(dictionary_df[DD_FIELD_NAME],
+                                      dictionary_df[DD_FORM_NAME]))
+    is_identifier = dictionary_df[DD_IDENTIFIER].str.strip().str.lower() == 'y'
+    identifier_fields = frozenset(dictionary_df.loc[is_identifier,
+                                                    DD_FIELD_NAME])
+
+    return DataDictionary(content, field_forms, identifier_fields)
+
+
 def redcap_projects(Lochness, phoenix_study, redcap_instance):
     '''get redcap api_url and api_key for a phoenix study
 
@@ -879,11 +1572,190 @@ def redcap_projects(Lochness, phoenix_study, redcap_instance):
         yield project, api_url, api_key
 
 
-def post_to_redcap(api_url, data, debug_tup):
-    r = requests.post(api_url, data=data, stream=True, verify=False)
-    if r.status_code != requests.codes.OK:
-        raise REDCapError(f'redcap url {r.url} responded {r.status_code}')
-    content = r.content
+def iter_records_from_redcap(api_url: str,
+                             data: dict,
+                             debug_tup,
+                             alias: str = None,
+                             chunk_size: int = 1024 * 1024) -> Iterator[dict]:
+    '''POST a query to REDCap and yield the records of the JSON response
+
+    The response is parsed as it is streamed, so only one chunk of the
+    response and the record being parsed are held in memory. The length of
+    the response is verified against the content-length header once the
+    response has been read, in the same way as post_to_redcap.
+
+    Key Arguments:
+        api_url: REDCap API url, str.
+        data: query, dict.
+        debug_tup: information about the query shown in errors.
+        alias: REDCap keyring alias, for the rate limit, str.
+        chunk_size: number of bytes read from the response at a time, int.
+
+    Yields:
+        record dictionaries, in the order of the response.
+    '''
+    with ratelimit.get(alias):
+        r = net.post(api_url, data=data, stream=True, verify=False)
+        try:
+            if r.status_code != requests.codes.OK:
+                raise REDCapError(
+                        f'redcap url {r.url} responded {r.status_code}')
+
+            for record in iter_json_array(
+                    r.iter_content(chunk_size=chunk_size), debug_tup):
+                yield record
+
+            # you need the number bytes read before any decoding
+            content_len = r.raw._fp_bytes_read
+        finally:
+            r.close()
+
+    # verify response content integrity
+    if 'content-length' not in r.headers:
+        logger.warn('server did not return a content-length header, '
+                    f'can\'t verify response integrity for {debug_tup}')
+    else:
+        expected_len = int(r.headers['content-length'])
+        if content_len != expected_len:
+            raise REDCapError(
+                    f'content length {content_len} does not match '
+                    f'expected length {expected_len} for {debug_tup}')
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(chunks: Iterable[bytes], debug_tup=None) -> Iterator:
+    '''Incrementally parse a JSON array from chunks of utf-8 bytes
+
+    Raises REDCapError if the content is not a JSON array, eg) an error
+    message from REDCap, or if the array is incomplete.
+    '''
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    expect = '['  # '[', 'value', ',' or None once the array is closed
+
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buffer = buffer[pos:] + text_decoder.decode(chunk or b'',
+                                                    final=final)
+        pos = 0
+
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+
+            if expect is None:
+                raise REDCapError(f'unexpected content after the records '
+                                  f'for {debug_tup}')
+            elif expect == '[':
+                if buffer[pos] != '[':
+                    raise REDCapError(f'REDCap did not return a list of '
+                                      f'records for {debug_tup}: '
+                                      f'{buffer[pos:pos + 200]}')
+                pos += 1
+                expect = 'value'
+            elif buffer[pos] == ']':
+                pos += 1
+                expect = None
+            elif expect == ',':
+                if buffer[pos] != ',':
+                    raise REDCapError(f'malformed JSON from REDCap for '
+                                      f'{debug_tup}')
+                pos += 1
+                expect = 'value'
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise REDCapError(f'malformed JSON from REDCap for '
+                                          f'{debug_tup}')
+                    break  # wait for the rest of the value
+
+                # a number at the end of the buffer may be incomplete
+                if end >= len(buffer) and not final and \
+                        not isinstance(value, (dict, list)):
+                    break
+                pos = end
+                expect = ','
+                yield value
+
+    if expect is not None:
+        raise REDCapError(f'incomplete JSON response from REDCap for '
+                          f'{debug_tup}')
+
+
+def write_records_json(records: Iterable[dict],
+                       dst: Union[Path, str],
+                       dst_crc: str = None) -> tuple:
+    '''Write records as a JSON array, only replacing dst if it has changed
+
+    The records are written one at a time to a temporary file next to dst,
+    in the same format as json.dumps(list(records)), while the crc32 of the
+    content is computed. dst is only replaced when the crc32 differs from the
+    crc32 of the existing file.
+
+    Key Arguments:
+        records: iterable of record dictionaries.
+        dst: path of the JSON file, Path or str.
+        dst_crc: crc32 of the existing dst, if known, str. dst is read to
+                 compute its crc32 otherwise.
+
+    Returns:
+        (changed, crc) where changed is True if dst was written, and False if
+        dst already had the same content, and crc is the crc32 of the
+        records.
+    '''
+    dst = Path(dst)
+    crc = 0
+    with tf.NamedTemporaryFile(dir=dst.parent, prefix='.',
+                               delete=False) as tmp:
+        try:
+            separator = b'['
+            for record in records:
+                content = separator + json.dumps(record).encode('utf-8')
+                crc = zlib.crc32(content, crc)
+                tmp.write(content)
+                separator = b', '
+            content = b']' if separator == b', ' else b'[]'
+            crc = zlib.crc32(content, crc)
+            tmp.write(content)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+
+    crc = format(crc & 0xFFFFFFFF, '08x')
+    if dst_crc is None and dst.is_file():
+        dst_crc = lochness.crc32file(dst)
+    if dst_crc == crc:
+        os.remove(tmp.name)
+        return False, crc
+
+    os.chmod(tmp.name, 0o0644)
+    os.rename(tmp.name, dst)
+    return True, crc
+
+
+def post_to_redcap(api_url, data, debug_tup, alias=None):
+    '''POST a query to REDCap and return the verified response content
+
+    alias is the REDCap keyring alias, eg) redcap.Pronet, whose rate limit
+    from the configuration file is applied to the request.
+    '''
+    with ratelimit.get(alias):
+        r = net.post(api_url, data=data, stream=True, verify=False)
+        if r.status_code != requests.codes.OK:
+            raise REDCapError(f'redcap url {r.url} responded {r.status_code}')
+        content = r.content
 
     # you need the number bytes read before any decoding
     content_len = r.raw._fp_bytes_read
@@ -7,19 +7,21 @@ Usage::
     ./server.py [<port>]
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
 from pathlib import Path
-import pandas as pd
 import re
 import time
-import shutil
-from lochness.utils.checksum import get_sha
+import queue
+import threading
+from lochness.redcap.det_notify import notify
+from lochness.redcap.det_log import get_log
 
 class S(BaseHTTPRequestHandler):
-    def _set_response(self):
-        self.send_response(200)
+    def _set_response(self, code=200):
+        self.send_response(code)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_GET(self):
@@ -27,7 +29,6 @@ class S(BaseHTTPRequestHandler):
                 str(self.path),
                 str(self.headers))
         self._set_response()
-        self.wfile.write(f"GET request for {self.path.encode('utf-8')}")
 
     def do_POST(self):
         # Gets the size of data
@@ -36,40 +37,126 @@ class S(BaseHTTPRequestHandler):
         # <--- Gets the data itself
         post_data = self.rfile.read(content_length)
 
-        if 'redcap' in post_data.decode('utf-8'):
-            save_post_from_redcap(post_data.decode('utf-8'),
-                                  self.db_location)
-            self.n_post += 1
-
         logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                 str(self.path), str(self.headers), post_data.decode('utf-8'))
 
+        # the trigger is acknowledged as soon as it is queued, and written
+        # to disk by the writer thread
+        if 'redcap' in post_data.decode('utf-8'):
+            try:
+                entry = get_entry_from_post(post_data.decode('utf-8'))
+            except AttributeError:
+                logging.warning('POST without the data entry trigger fields')
+                self._set_response(400)
+                return
+            self.writer.put(entry)
+
         self._set_response()
-        # self.wfile.write(f"POST request for {self.path.encode('utf-8')}")
 
-        if self.n_post == self.back_up_after_n_post:
-            back_up_db(self.db_location)
-            self.n_post = 0
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
 
 
-def run(db_location: str = 'db.csv',
-        server_class=HTTPServer,
-        handler_class=S, port=8080):
+class TriggerWriter(object):
+    '''Thread writing the queued data entry triggers to the database
 
-    # register db_location
-    class redcap_handler(handler_class):
-        def __init__(self, *args, **kwargs):
-            self.db_location = db_location
+    The writer takes every trigger queued since its last write, up to
+    max_batch, and appends them to the log with a single write. The sync.py
+    waiting on notify_socket is then notified of their records, and the log
+    is backed up after every back_up_after_n_post triggers. Once the oldest
+    trigger of the log is compact_interval seconds old, the log is compacted
+    (see det_log) and backed up.
+
+    Key Arguments:
+        db_location: data entry trigger database, str.
+        notify_socket: Unix socket of sync.py --det-socket, str.
+        max_batch: maximum number of triggers written together, int.
+        back_up_after_n_post: number of triggers between backups, int.
+        compact_interval: seconds between compactions, float.
+    '''
+    def __init__(self, db_location: str, notify_socket: str = None,
+                 max_batch: int = 1000, back_up_after_n_post: int = 50,
+                 compact_interval: float = 86400):
+        self.db_location = db_location
+        self.notify_socket = notify_socket
+        self.max_batch = max_batch
+        self.back_up_after_n_post = back_up_after_n_post
+        self.compact_interval = compact_interval
+        self.n_post = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='det-writer')
+        self.thread.start()
+
+    def put(self, entry: dict) -> None:
+        self.queue.put(entry)
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            entries = [x for x in batch if x is not None]
+            try:
+                if entries:
+                    self._write(entries)
+            except Exception as e:
+                logging.error(f'failed to save {len(entries)} data entry '
+                              f'triggers: {e}')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(entries) < len(batch):
+                return
+
+    def _write(self, entries: list) -> None:
+        log = get_log(self.db_location)
+        log.append(entries)
+
+        # wake up the sync.py waiting for data entry triggers
+        if self.notify_socket:
+            for record in dict.fromkeys(x['record'] for x in entries):
+                notify(self.notify_socket, record)
+
+        self.n_post += len(entries)
+        first_timestamp = log.first_timestamp()
+        if first_timestamp is not None and \
+                time.time() - first_timestamp >= self.compact_interval:
+            log.compact()
+            log.back_up()
+            self.n_post = 0
+        elif self.n_post >= self.back_up_after_n_post:
+            log.back_up()
             self.n_post = 0
-            self.back_up_after_n_post = 50
-            handler_class.__init__(self, *args, **kwargs)
+
+    def flush(self) -> None:
+        '''wait until every queued trigger is written'''
+        self.queue.join()
+
+    def stop(self) -> None:
+        '''write the queued triggers, and stop the thread'''
+        self.queue.put(None)
+        self.thread.join()
+
+
+def run(db_location: str = 'db.csv',
+        server_class=ThreadingHTTPServer,
+        handler_class=S, port=8080,
+        notify_socket: str = None):
 
     logging.basicConfig(
             level=logging.INFO,
             filename=Path(db_location).parent / 'data_trigger_capture.log')
 
-    server_address = ('', port)
-    httpd = server_class(server_address, redcap_handler)
+    httpd = make_server(db_location, server_class, handler_class, port,
+                        notify_socket)
 
     logging.info(f'** {time.time()}')
     logging.info('Listening to REDCap POST...\n')
@@ -78,77 +165,79 @@ def run(db_location: str = 'db.csv',
     except KeyboardInterrupt:
         pass
     httpd.server_close()
+    httpd.writer.stop()
     logging.info(f'** {time.time()}')
     logging.info('Stopping httpd...\n')
 
 
-def save_post_from_redcap(body: str, db_location: str):
-    '''Listen to redcap and make a record of every modification
-
-    Requirements:
-      - "Data Entry Trigger" from REDCap configuration
+def make_server(db_location: str = 'db.csv',
+                server_class=ThreadingHTTPServer,
+                handler_class=S, port=8080,
+                notify_socket: str = None):
+    '''Return the HTTP server of the data entry triggers, with its writer
 
+    Each connection is handled by its own thread, while a single
+    TriggerWriter (httpd.writer) saves the triggers.
     '''
+    # create the log, importing the triggers of an existing CSV database
+    get_log(db_location)
+    writer = TriggerWriter(db_location, notify_socket)
 
+    # register the writer
+    class redcap_handler(handler_class):
+        def __init__(self, *args, **kwargs):
+            self.writer = writer
+            handler_class.__init__(self, *args, **kwargs)
+
+    # connections waiting to be accepted during a burst of triggers
+    class redcap_server(server_class):
+        request_queue_size = 128
+
+    server_address = ('', port)
+    httpd = redcap_server(server_address, redcap_handler)
+    httpd.writer = writer
+    return httpd
+
+
+def get_entry_from_post(body: str) -> dict:
+    '''Return the data entry trigger of a REDCap POST body
+
+    The time stamp is created in the server (unix time).
+    '''
     body = re.sub("%3A", ":", body)
     body = re.sub("%2F", "/", body)
     body = re.sub("%3F", "?", body)
     body = re.sub("%3D", "=", body)
-    
-    columns = ['timestamp', 'project_url', 'project_id',
-               'redcap_username', 'record', 'instrument']
-    if Path(db_location).is_file():
-        db_df = pd.read_csv(db_location, index_col=0)
-
-    else:
-        db_df = pd.DataFrame(columns=columns)
-
-    redcap_url = get_info_from_post_body('redcap_url', body)
-    project_url = get_info_from_post_body('project_url', body)
-    project_id = get_info_from_post_body('project_id', body)
-    redcap_username = get_info_from_post_body('username', body)
-    record = get_info_from_post_body('record', body)
-    instrument = get_info_from_post_body('instrument', body)
-
-    # here the time stamp is created in the server (unix time)
-    df_tmp = pd.DataFrame({
-        'timestamp': [time.time()],
-        'redcap_url': redcap_url,
-        'project_url': project_url,
-        'project_id': project_id,
-        'redcap_username': redcap_username,
-        'record': record,
-        'instrument': instrument})
-
-    db_df = pd.concat([db_df, df_tmp])
-    db_df[columns].to_csv(db_location)
 
+    return {
+        'timestamp': time.time(),
+        'redcap_url': get_info_from_post_body('redcap_url', body),
+        'project_url': get_info_from_post_body('project_url', body),
+        'project_id': get_info_from_post_body('project_id', body),
+        'redcap_username': get_info_from_post_body('username', body),
+        'record': get_info_from_post_body('record', body),
+        'instrument': get_info_from_post_body('instrument', body)}
 
-def get_info_from_post_body(var_name, body):
-    pattern_catcher = '([A-Za-z%0-9:\./?\=_]+)'
-    return re.search(f'{var_name}={pattern_catcher}', body).group(1)
 
+def save_post_from_redcap(body: str, db_location: str):
+    '''Listen to redcap and make a record of every modification
 
-def back_up_db(db_location) -> None:
-    ''''Back up the db file'''
+    Each trigger is appended to the log of the database (see det_log), so
+    saving a trigger does not depend on the number of triggers saved before.
 
-    db_dir = Path(db_location).parent
-    db_backup_file = db_dir / f".back_{Path(db_location).name}"
+    Requirements:
+      - "Data Entry Trigger" from REDCap configuration
 
-    if db_backup_file.is_file():
-        with open(db_location, 'rb') as f:
-            db_file_sha256 = get_sha(db_location)
+    Returns:
+        REDCap record ID of the data entry trigger, str.
+    '''
+
+    entry = get_entry_from_post(body)
+    get_log(db_location).append([entry])
 
-        with open(db_backup_file, 'rb') as f:
-            back_up_file_sha256 = get_sha(db_backup_file)
+    return entry['record']
 
-        if db_file_sha256 == back_up_file_sha256:
-            print('No back up')
-            pass
-        else:
-            print('backing up')
-            shutil.copy(db_location, db_backup_file)
-    else:
-        shutil.copy(db_location, db_backup_file)
 
-    return True
+def get_info_from_post_body(var_name, body):
+    pattern_catcher = '([A-Za-z%0-9:\./?\=_]+)'
+    return re.search(f'{var_name}={pattern_catcher}', body).group(1)
@@ -0,0 +1,437 @@
+'''Append-only log of the REDCap data entry triggers
+
+Each data entry trigger is a line of JSON appended to the log, instead of the
+whole CSV database being read and written again for every trigger. Appends
+from concurrent threads are group committed: the thread which gets to write
+takes every line queued so far, and writes them with a single write and
+fsync, while the others wait for their lines to be committed.
+
+The log is kept next to the CSV database of the configuration file, eg)
+data_entry_trigger_database.jsonl for data_entry_trigger_database.csv.
+Triggers saved in the CSV database by earlier versions are imported into the
+log when it is created, and the CSV database can still be exported from the
+log for other tools.
+
+Compaction moves the triggers of the log to a dated, compressed history
+segment, and keeps the latest trigger of every (project, record, instrument)
+in a small table read by sync together with the log.
+
+    data_entry_trigger_database.jsonl           triggers since compaction
+    data_entry_trigger_database.latest.jsonl    latest trigger per record
+    data_entry_trigger_database_history/
+        data_entry_trigger_database.20240101T000000Z.jsonl.gz
+
+Backups are incremental: history segments never change once written, so
+only new segments are copied, and each copy is verified with a hash of the
+whole file.
+'''
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import logging
+import datetime
+import threading
+import contextlib
+import collections as col
+from pathlib import Path
+from typing import Iterator, Iterable, List
+
+import pandas as pd
+
+from lochness.utils.checksum import get_sha
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['timestamp', 'project_url', 'project_id',
+           'redcap_username', 'record', 'instrument']
+
+
+class DetLogError(Exception):
+    pass
+
+
+def log_path(db_location: str) -> Path:
+    '''path of the log kept for a data entry trigger CSV database'''
+    db_location = Path(db_location)
+    if db_location.suffix == '.jsonl':
+        return db_location
+    return db_location.with_suffix('.jsonl')
+
+
+def latest_path(db_location: str) -> Path:
+    '''path of the table of the latest trigger per record'''
+    path = log_path(db_location)
+    return path.with_name(f'{path.stem}.latest.jsonl')
+
+
+def history_dir(db_location: str) -> Path:
+    '''directory of the compressed history segments'''
+    path = log_path(db_location)
+    return path.with_name(f'{path.stem}_history')
+
+
+def default_backup_dir(db_location: str) -> Path:
+    path = log_path(db_location)
+    return path.with_name(f'.back_{path.stem}')
+
+
+def database_path(db_location: str) -> Path:
+    '''Return the log if it exists, else the CSV database, or None'''
+    for path in log_path(db_location), Path(db_location):
+        if path.is_file():
+            return path
+    return None
+
+
+class DetLog(object):
+    '''Append-only data entry trigger log
+
+    Key Arguments:
+        path: path of the log, str.
+        csv_path: CSV database imported into the log when the log does not
+                  exist yet, str.
+    '''
+    def __init__(self, path: str, csv_path: str = None):
+        self.path = Path(path)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_batch = 1
+        self._committed = 0
+        self._writing = False
+        self._waiters = col.Counter()
+        self._errors = dict()
+
+        if not self.path.is_file():
+            self._create(csv_path)
+
+    def _create(self, csv_path: str = None) -> None:
+        '''create the log, with the triggers of the CSV database if any'''
+        entries = []
+        if csv_path is not None and Path(csv_path).is_file():
+            entries = list(read_csv(csv_path))
+            logger.info(f'importing {len(entries)} data entry triggers from '
+                        f'{csv_path} to {self.path}')
+
+        _replace(self.path, entries)
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.path, 'a') as fp:
+            fp.write(''.join(lines))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def append(self, entries: List[dict]) -> None:
+        '''Append entries to the log, returning once they are on disk
+
+        Raises:
+            DetLogError: when the entries could not be written.
+        '''
+        with self._cond:
+            self._pending.extend(to_line(x) for x in entries)
+            batch = self._pending_batch
+            self._waiters[batch] += 1
+            while self._committed < batch:
+                if self._writing:
+                    self._cond.wait()
+                    continue
+
+                # write the lines of every thread waiting so far
+                self._writing = True
+                lines, self._pending = self._pending, []
+                writing = self._pending_batch
+                self._pending_batch += 1
+                self._cond.release()
+                try:
+                    self._write(lines)
+                    error = None
+                except OSError as e:
+                    error = e
+                finally:
+                    self._cond.acquire()
+                    self._writing = False
+                    self._committed = writing
+                    if error is not None:
+                        self._errors[writing] = error
+                    self._cond.notify_all()
+
+            # the error of a batch is kept until its last waiter saw it
+            self._waiters[batch] -= 1
+            if self._waiters[batch]:
+                error = self._errors.get(batch)
+            else:
+                del self._waiters[batch]
+                error = self._errors.pop(batch, None)
+            if error is not None:
+                raise DetLogError(f'failed to write {self.path}: {error}')
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        '''hold off appends for the duration of the block'''
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+    def first_timestamp(self) -> float:
+        '''time stamp of the oldest trigger in the log, or None'''
+        for entry in read_entries(self.path):
+            return entry.get('timestamp')
+        return None
+
+    def compact(self, now: float = None) -> Path:
+        '''Move the triggers of the log to a new history segment
+
+        The latest trigger of every (project, record, instrument) is kept in
+        the latest table, and the log starts again empty. If compaction is
+        interrupted before the log is emptied, its triggers are written to
+        the history again by the next compaction.
+
+        Returns:
+            path of the history segment, or None if the log was empty.
+        '''
+        now = time.time() if now is None else now
+        with self._exclusive():
+            entries = list(read_entries(self.path))
+            if not entries:
+                return None
+
+            stamp = datetime.datetime.utcfromtimestamp(now) \
+                .strftime('%Y%m%dT%H%M%SZ')
+            segment = history_dir(self.path) / \
+                f'{self.path.stem}.{stamp}.jsonl.gz'
+            num = 1
+            while segment.exists():
+                segment = segment.with_name(
+                        f'{self.path.stem}.{stamp}_{num}.jsonl.gz')
+                num += 1
+            segment.parent.mkdir(parents=True, exist_ok=True)
+            _replace(segment, entries)
+
+            latest = read_latest(latest_path(self.path))
+            for entry in entries:
+                keep_latest(latest, entry)
+            _replace(latest_path(self.path), latest.values())
+            _replace(self.path, [])
+
+        logger.info(f'{len(entries)} data entry triggers moved to {segment}')
+        return segment
+
+    def back_up(self, backup_dir: str = None) -> List[Path]:
+        '''Back up the history segments, the latest table and the log
+
+        Only the segments which are not in the backup yet are copied, and
+        the copy of the log is appended to when the log only grew since the
+        previous backup.
+
+        Key Arguments:
+            backup_dir: directory of the backup, str. Defaults to
+                        .back_<name of the log> next to the log.
+
+        Returns:
+            list of the backup files written.
+
+        Raises:
+            DetLogError: when a backup file does not match its source.
+        '''
+        backup_dir = Path(backup_dir or default_backup_dir(self.path))
+        written = []
+
+        # history segments never change, so they are copied without holding
+        # off appends
+        if history_dir(self.path).is_dir():
+            for segment in sorted(history_dir(self.path).iterdir()):
+                dst = backup_dir / history_dir(self.path).name / segment.name
+                if segment.suffix == '.gz' and not dst.is_file():
+                    _back_up_file(segment, dst)
+                    written.append(dst)
+
+        with self._exclusive():
+            for path in latest_path(self.path), self.path:
+                if path.is_file() and \
+                        _back_up_file(path, backup_dir / path.name):
+                    written.append(backup_dir / path.name)
+
+        return written
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_log(db_location: str) -> DetLog:
+    '''return the (shared) log of a data entry trigger database'''
+    path = log_path(db_location)
+    with _logs_lock:
+        if path not in _logs:
+            _logs[path] = DetLog(path, db_location)
+        return _logs[path]
+
+
+def to_line(entry: dict) -> str:
+    return json.dumps(entry, default=str) + '\n'
+
+
+def _replace(path: Path, entries: Iterable[dict]) -> None:
+    '''write entries to path atomically, compressed for .gz'''
+    path = Path(path)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(tmp, 'wt') as fp:
+        fp.writelines(to_line(x) for x in entries)
+    with open(tmp, 'rb') as fp:
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def _sha_of_head(path: Path, size: int) -> str:
+    '''sha256 hexdigest of the first size bytes of a file'''
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while size > 0:
+            data = f.read(min(size, 65536))
+            if not data:
+                break
+            sha256.update(data)
+            size -= len(data)
+    return sha256.hexdigest()
+
+
+def _back_up_file(src: Path, dst: Path) -> bool:
+    '''Bring dst up to date with src, verified with a hash of both files
+
+    Returns:
+        False if dst was already up to date.
+    '''
+    src_sha = get_sha(src)
+    src_size = src.stat().st_size
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    dst_size = dst.stat().st_size if dst.is_file() else None
+    if dst_size == src_size and get_sha(dst) == src_sha:
+        return False
+
+    if dst_size is not None and dst_size < src_size and \
+            _sha_of_head(src, dst_size) == get_sha(dst):
+        # src only grew since the previous backup
+        with open(src, 'rb') as fsrc, open(dst, 'ab') as fdst:
+            fsrc.seek(dst_size)
+            shutil.copyfileobj(fsrc, fdst)
+    else:
+        tmp = dst.with_name(f'.{dst.name}.tmp')
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    if get_sha(dst) != src_sha:
+        raise DetLogError(f'backup {dst} does not match {src}')
+    return True
+
+
+def entry_key(entry: dict) -> tuple:
+    '''(project, record, instrument) of an entry'''
+    return tuple(str(entry.get(x)) for x in
+                 ('project_id', 'record', 'instrument'))
+
+
+def keep_latest(latest: dict, entry: dict) -> None:
+    '''update the latest entry of the (project, record, instrument)'''
+    key = entry_key(entry)
+    previous = latest.get(key)
+    if previous is None or \
+            (entry.get('timestamp') or 0) >= (previous.get('timestamp') or 0):
+        latest[key] = entry
+
+
+def read_latest(path: str) -> dict:
+    '''read a latest table as (project, record, instrument) -> entry'''
+    latest = {}
+    if Path(path).is_file():
+        for entry in read_entries(path):
+            keep_latest(latest, entry)
+    return latest
+
+
+def read_current(path: str) -> Iterator[dict]:
+    '''Read the latest table and the log, everything sync needs
+
+    Key Arguments:
+        path: path of the log, str.
+    '''
+    yield from read_latest(latest_path(path)).values()
+    yield from read_entries(path)
+
+
+def read_history(db_location: str) -> Iterator[dict]:
+    '''read every trigger, from the history segments and the log'''
+    path = log_path(db_location)
+    if history_dir(path).is_dir():
+        for segment in sorted(history_dir(path).glob('*.jsonl.gz')):
+            yield from read_entries(segment)
+    yield from read_entries(path)
+
+
+def read_entries(path: str) -> Iterator[dict]:
+    '''Read the entries of a log, or of a compressed history segment
+
+    A line which is not complete, eg) after a crash while writing, is
+    skipped.
+    '''
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as fp:
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f'skipping incomplete line in {path}')
+
+
+def read_csv(csv_path: str) -> Iterator[dict]:
+    '''read the triggers of a CSV database as log entries'''
+    db_df = pd.read_csv(csv_path, index_col=0)
+    db_df = db_df.where(pd.notnull(db_df), None)
+    for row in db_df.to_dict('records'):
+        if row.get('record') is not None:
+            row['record'] = str(row['record'])
+        yield row
+
+
+def entries_to_df(entries: Iterable[dict]) -> pd.DataFrame:
+    db_df = pd.DataFrame(list(entries))
+    for column in COLUMNS:
+        if column not in db_df.columns:
+            db_df[column] = None
+    return db_df
+
+
+def read_df(path: str) -> pd.DataFrame:
+    '''Read a log as the dataframe of the CSV database
+
+    Only the latest trigger of each record and instrument is kept for the
+    triggers which were moved to the history.
+    '''
+    return entries_to_df(read_current(path))
+
+
+def export_csv(db_location: str, csv_path: str = None) -> Path:
+    '''Export every trigger of the log and its history as the CSV database
+
+    Key Arguments:
+        db_location: data entry trigger database, str.
+        csv_path: path of the CSV, str. Defaults to the CSV database.
+
+    Returns:
+        path of the CSV.
+    '''
+    csv_path = Path(csv_path or Path(db_location).with_suffix('.csv'))
+    tmp = csv_path.with_name(f'.{csv_path.name}.tmp')
+    entries_to_df(read_history(db_location))[COLUMNS].to_csv(tmp)
+    os.replace(tmp, csv_path)
+    return csv_path
@@ -0,0 +1,132 @@
+'''Push REDCap data entry triggers to a running sync.py over a Unix socket
+
+listen_to_redcap.py sends the record ID of every data entry trigger it saves
+to a Unix datagram socket, where sync.py --continuous waits in between its
+cycles. Notifications are best effort: the data entry trigger database is
+always written first, so a notification that is lost, eg) because sync.py is
+not running, is picked up by the next regular cycle.
+'''
+import os
+import json
+import time
+import socket
+import select
+import logging
+from pathlib import Path
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_BYTES = 4096
+DEFAULT_BATCH_SECONDS = 5
+
+
+class DetSocketError(Exception):
+    pass
+
+
+def notify(socket_path: str, record: str,
+           project_id: str = None, instrument: str = None) -> bool:
+    '''Send a record ID to the sync.py listening on socket_path
+
+    Key Arguments:
+        socket_path: path of the Unix socket of sync.py, str.
+        record: REDCap record ID, str.
+        project_id: REDCap project ID, str.
+        instrument: REDCap instrument, str.
+
+    Returns:
+        True if the notification was sent, False if no sync.py is listening
+        or its queue is full.
+    '''
+    message = json.dumps({'record': record,
+                          'project_id': project_id,
+                          'instrument': instrument}).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        try:
+            sock.sendto(message, str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError,
+                BlockingIOError) as e:
+            logger.debug(f'sync.py was not notified of {record}: {e}')
+            return False
+    return True
+
+
+class Listener(object):
+    '''Unix datagram socket receiving the data entry triggers
+
+    Key Arguments:
+        socket_path: path of the socket, str. A socket left behind by a
+                     process which is no longer running is replaced.
+        batch_seconds: once a notification arrived, seconds to wait for more
+                       before returning them together, float.
+    '''
+    def __init__(self, socket_path: str,
+                 batch_seconds: float = DEFAULT_BATCH_SECONDS):
+        self.socket_path = Path(socket_path)
+        self.batch_seconds = batch_seconds
+        self._remove_stale_socket()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.socket_path))
+        logger.info(f'waiting for data entry triggers on {self.socket_path}')
+
+    def _remove_stale_socket(self) -> None:
+        if not self.socket_path.exists():
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.connect(str(self.socket_path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                self.socket_path.unlink()
+                return
+        raise DetSocketError(f'{self.socket_path} is used by another process')
+
+    def _receive(self) -> set:
+        data = self.sock.recv(MAX_MESSAGE_BYTES)
+        try:
+            record = json.loads(data.decode('utf-8'))['record']
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f'ignoring malformed notification: {data[:100]}')
+            return set()
+        return {str(record)} if record else set()
+
+    def _readable(self, timeout: float) -> bool:
+        return bool(select.select([self.sock], [], [], max(timeout, 0))[0])
+
+    def wait(self, timeout: float) -> set:
+        '''Wait up to timeout seconds for data entry triggers
+
+        Returns:
+            set of record IDs, empty if nothing arrived before the timeout.
+        '''
+        records = set()
+        if not self._readable(timeout):
+            return records
+
+        batch_end = time.monotonic() + self.batch_seconds
+        while True:
+            records |= self._receive()
+            if not self._readable(batch_end - time.monotonic()):
+                return records
+
+    def close(self) -> None:
+        self.sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def select_subjects(subjects: Iterable['Subject'], records: set) -> list:
+    '''return the IDs of the subjects with any of the REDCap record IDs'''
+    return [subject.id for subject in subjects
+            if any(redcap_id in records
+                   for redcap_ids in subject.redcap.values()
+                   for redcap_id in redcap_ids)]
@@ -1,4 +1,5 @@
 import lochness
+import logging
 import pandas as pd
 from pathlib import Path
 import json
@@ -8,6 +9,11 @@ from datetime import date
 from typing import List
 import re
 import sys
+import lochness.tree as tree
+import concurrent.futures as cf
+import threading
+
+logger = logging.getLogger(__name__)
 
 
 class PiiTableError(Exception):
@@ -52,6 +58,110 @@ def read_pii_mapping_to_dict(pii_table_loc: str) -> pd.DataFrame:
     return pii_string_process_dict
 
 
+class PiiEngine(object):
+    '''Compiled PII processing rules of a PII table
+
+    All pii_label_strings are compiled into a single regular expression,
+    which returns the first pii_label_string of the table found in a field
+    name, in the same order as testing each pii_label_string in turn. Tables
+    which can not be combined are matched one pii_label_string at a time.
+    The process for each field name is memoized, so each field of a data
+    dictionary is only matched once.
+
+    Key Arguments:
+        pii_str_proc_dict: pii_label_string -> process, from
+                           read_pii_mapping_to_dict, dict.
+    '''
+    def __init__(self, pii_str_proc_dict: dict):
+        self.pii_str_proc_dict = dict(pii_str_proc_dict)
+        self._processes = list(self.pii_str_proc_dict.values())
+        self._decisions = {}
+        self._regex = self._combined_regex() \
+            if self.pii_str_proc_dict else None
+
+    def _combined_regex(self):
+        '''Return the combined regular expression, or False if it can't be
+
+        Patterns with their own groups (eg. backreferences) would be
+        renumbered in a combined expression, and inline global flags, eg.
+        (?i), can only start an expression and would apply to every pattern,
+        so tables with them are matched one pattern at a time.
+        '''
+        patterns = [re.compile(x) for x in self.pii_str_proc_dict]
+        if any(x.groups or x.flags & ~re.UNICODE for x in patterns):
+            return False
+        try:
+            return re.compile('^(?:' + '|'.join(
+                fr'(?=[\s\S]*?(?P<_p{num}>{pii_label_string}))'
+                for num, pii_label_string in enumerate(
+                    self.pii_str_proc_dict)) + ')')
+        except re.error:
+            return False
+
+    def process_for(self, field_name: str) -> str:
+        '''Return the process for a field name, or None'''
+        try:
+            return self._decisions[field_name]
+        except KeyError:
+            pass
+
+        process = None
+        if self._regex:
+            match = self._regex.match(field_name)
+            if match:
+                process = self._processes[int(match.lastgroup[2:])]
+        elif self._regex is False:
+            for pii_label_string, _process in \
+                    self.pii_str_proc_dict.items():
+                if re.search(pii_label_string, field_name):
+                    process = _process
+                    break
+
+        self._decisions[field_name] = process
+        return process
+
+    def process_value(self, field_value, process: str, subject_id: str):
+        '''process a single value, flagging values which can not be'''
+        try:
+            return process_pii_string(field_value, process, subject_id)
+        except:
+            return 'check_process_pii_string'
+
+    def process_record(self, record: dict, subject_id: str) -> dict:
+        '''Return a copy of a record with PII fields processed'''
+        processed_record = {}
+        for field_name, field_value in record.items():
+            process = self.process_for(field_name)
+            if process is not None:
+                field_value = self.process_value(field_value, process,
+                                                 subject_id)
+            processed_record[field_name] = field_value
+        return processed_record
+
+    def process_df(self, df: pd.DataFrame, subject_id: str) -> pd.DataFrame:
+        '''Return a copy of a dataframe with PII columns processed'''
+        df = df.copy()
+        for field_name in df.columns:
+            process = self.process_for(field_name)
+            if process is not None:
+                df[field_name] = df[field_name].map(
+                        lambda x: self.process_value(x, process, subject_id))
+        return df
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_pii_engine(pii_str_proc_dict: dict) -> PiiEngine:
+    '''return the (memoized) PiiEngine of a PII table'''
+    key = tuple(pii_str_proc_dict.items())
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = PiiEngine(pii_str_proc_dict)
+        return _engines[key]
+
+
 def load_raw_return_proc_json(json_loc: str,
                               pii_str_proc_dict: dict,
                               subject_id: str) -> List[dict]:
@@ -59,23 +169,9 @@ def load_raw_return_proc_json(json_loc: str,
     with open(json_loc, 'r') as f:
         raw_json = json.load(f)  # list of dicts
 
-    processed_json = []
-    for instrument in raw_json:
-        processed_instrument = {}
-        for field_name, field_value in instrument.items():
-            for pii_label_string, process in pii_str_proc_dict.items():
-                if re.search(pii_label_string, field_name):
-                    try:
-                        new_value = process_pii_string(field_value,
-                                                       process,
-                                                       subject_id)
-                    except:
-                        new_value = 'check_process_pii_string'
-                    processed_instrument[field_name] = new_value
-                    break
-                else:
-                    processed_instrument[field_name] = field_value
-        processed_json.append(processed_instrument)
+    engine = get_pii_engine(pii_str_proc_dict)
+    processed_json = [engine.process_record(instrument, subject_id)
+                      for instrument in raw_json]
 
     processed_content = json.dumps(processed_json).encode()
 
@@ -85,6 +181,9 @@ def load_raw_return_proc_json(json_loc: str,
 def get_shuffle_dict_for_type(string_type: string, input_str: str) -> dict:
     '''Return strings randomised using random mapping of given string_type
 
+    Each character of string_type is mapped to a random character of
+    string_type, and the mapping is applied with a single str.translate.
+
     Key Arguments:
         string_type: string types, eg) string.digits or string.ascii_lowercase
         input_str: str
@@ -94,17 +193,10 @@ def get_shuffle_dict_for_type(string_type: string, input_str: str) -> dict:
     '''
     system_random = random.SystemRandom()
 
-    from_alphabet = ''.join(
-            system_random.choice(string_type) for i in range(26))
     to_alphabet = ''.join(
-            system_random.choice(string_type) for i in range(26))
-    old_2_new_dict = dict(zip(from_alphabet,
-                              to_alphabet))
-
-    for old, new in old_2_new_dict.items():
-        input_str = re.sub(old, new, input_str)
+            system_random.choice(string_type) for i in range(len(string_type)))
 
-    return input_str
+    return input_str.translate(str.maketrans(string_type, to_alphabet))
 
 
 def process_pii_string(pii_string: str, process: str, subject_id: str) -> str:
@@ -175,22 +267,8 @@ def load_raw_return_proc_csv(csv_loc: str,
     # load csv in PROTECTED/survey/raw
     raw_df_subject = pd.read_csv(csv_loc)
 
-    for field_name in raw_df_subject.columns:
-        field_value = raw_df_subject.loc[0][field_name]
-        for pii_label_string, process in pii_str_proc_dict.items():
-            if re.search(pii_label_string, field_name):
-                try:
-                    new_value = process_pii_string(field_value,
-                                                   process,
-                                                   subject_id)
-                except:
-                    new_value = 'check_process_pii_string'
-                raw_df_subject.loc[0, field_name] = new_value
-                break
-            else:
-                raw_df_subject.loc[0, field_name] = field_value
-
-    return raw_df_subject
+    engine = get_pii_engine(pii_str_proc_dict)
+    return engine.process_df(raw_df_subject, subject_id)
 
 
 def process_and_copy_db(Lochness, subject, raw_input, proc_dst):
@@ -222,6 +300,67 @@ def process_and_copy_db(Lochness, subject, raw_input, proc_dst):
 
 
 
+def process_study_surveys(Lochness, study: str, workers: int = None) -> int:
+    '''Process PII of all survey files of a study, across processes
+
+    Every json and csv file in the raw surveys directory of the subjects of
+    the study is processed with the PII table of the configuration file, and
+    saved to the processed surveys directory under GENERAL.
+
+    Key Arguments:
+        Lochness: Lochness object.
+        study: name of the study, str. eg) PronetLA
+        workers: number of processes, int. Defaults to the number of CPUs.
+
+    Returns:
+        number of files processed, int.
+    '''
+    pii_table_loc = get_PII_table_loc(Lochness, study)
+    if pii_table_loc == False or pii_table_loc == '':
+        return 0
+
+    pii_str_proc_dict = read_pii_mapping_to_dict(pii_table_loc)
+    if pii_str_proc_dict == {}:
+        return 0
+
+    tasks = []
+    for subject in lochness.read_phoenix_metadata(Lochness, [study]):
+        raw_folder = tree.get('surveys', subject.protected_folder,
+                              processed=False, BIDS=Lochness['BIDS'],
+                              makedirs=False)
+        proc_folder = tree.get('surveys', subject.general_folder,
+                               processed=True, BIDS=Lochness['BIDS'],
+                               makedirs=False)
+        for raw_input in sorted(Path(raw_folder).glob('*')):
+            if raw_input.suffix in ('.json', '.csv'):
+                tasks.append((str(raw_input),
+                              str(Path(proc_folder) / raw_input.name),
+                              subject.id))
+
+    logger.debug(f'processing PII of {len(tasks)} survey files for {study}')
+    with cf.ProcessPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(_process_survey_file, tasks,
+                          [pii_str_proc_dict] * len(tasks),
+                          chunksize=max(1, len(tasks) // 64)):
+            pass
+
+    return len(tasks)
+
+
+def _process_survey_file(task: tuple, pii_str_proc_dict: dict) -> None:
+    '''process PII of a single survey file, in a worker process'''
+    raw_input, proc_dst, subject_id = task
+    Path(proc_dst).parent.mkdir(parents=True, exist_ok=True)
+    if raw_input.endswith('json'):
+        processed_content = load_raw_return_proc_json(
+                raw_input, pii_str_proc_dict, subject_id)
+        lochness.atomic_write(proc_dst, processed_content)
+    else:
+        processed_df = load_raw_return_proc_csv(
+                raw_input, pii_str_proc_dict, subject_id)
+        processed_df.to_csv(proc_dst, index=False)
+
+
 def get_PII_table_loc(Lochness, study):
     ''' get study specific deidentify flag with a safe default '''
     value = Lochness.get('pii_table', False)
@@ -1,5 +1,11 @@
+import re
 import time
+import logging
 import datetime as dt
+import collections as col
+import lochness.state as state
+
+logger = logging.getLogger(__name__)
 
 format = '%Y-%m-%dT%H:%M:%S'
 
@@ -20,3 +26,251 @@ def until(future):
     if seconds >= 0:
         time.sleep(seconds)
 
+
+# sources whose state store records are only updated when new data is saved
+NEW_DATA_SOURCES = ['xnat', 'daris', 'box', 'mindlamp']
+
+MINDLAMP_DATE_RE = re.compile(r'_(\d{4}_\d{2}_\d{2})\.json$')
+
+
+def activity_signals(Lochness: 'Lochness', subject: 'Subject',
+                     det_index: dict = None) -> dict:
+    '''Return unix times of the recent activity of a subject
+
+    Signals are the latest REDCap data entry trigger of the subject, the
+    latest day with MindLAMP data, the last time new XNAT, DaRIS, Box or
+    MindLAMP data was saved, and the consent date. Missing signals are left
+    out.
+
+    Key Arguments:
+        Lochness: Lochness object.
+        subject: Subject object.
+        det_index: REDCap record ID -> latest data entry trigger timestamp,
+                   of the study of the subject, dict.
+
+    Returns:
+        dictionary of signal name to unix time.
+    '''
+    signals = {}
+    store = state.get(Lochness)
+
+    redcap_ids = [redcap_id
+                  for ids in (getattr(subject, 'redcap', None) or {}).values()
+                  for redcap_id in ids]
+    det_times = [det_index[x] for redcap_id in redcap_ids
+                 for x in (redcap_id, redcap_id.lower())
+                 if det_index and x in det_index]
+    if det_times:
+        signals['data_entry_trigger'] = float(max(det_times))
+
+    mindlamp_days = [MINDLAMP_DATE_RE.search(x.object_id)
+                     for x in store.records('mindlamp', subject.id)]
+    mindlamp_days = [x.group(1) for x in mindlamp_days if x]
+    if mindlamp_days:
+        signals['mindlamp'] = dt.datetime.strptime(
+                max(mindlamp_days), '%Y_%m_%d').replace(
+                        tzinfo=dt.timezone.utc).timestamp()
+
+    new_data = [store.last_update(source, subject.id)
+                for source in NEW_DATA_SOURCES]
+    new_data = [x for x in new_data if x is not None]
+    if new_data:
+        signals['new_data'] = max(new_data)
+
+    try:
+        signals['consent'] = dt.datetime.strptime(
+                subject.consent, '%Y-%m-%d').timestamp()
+    except (TypeError, ValueError):
+        pass
+
+    return signals
+
+
+def prioritize(Lochness: 'Lochness', subjects: list) -> list:
+    '''Order subjects by their most recent activity, latest first
+
+    Subjects are ranked by the latest of their activity_signals, so the
+    subjects who just had a visit, entered data or consented are synced
+    before the ones who have been inactive for a long time. Subjects without
+    any signal keep their order, after all the others.
+    '''
+    import lochness.redcap as REDCap
+
+    det_indices = {}
+    last_activity = {}
+    for subject in subjects:
+        try:
+            if subject.study not in det_indices:
+                det_indices[subject.study] = \
+                    REDCap.get_data_entry_trigger_index(Lochness,
+                                                        subject.study)
+            signals = activity_signals(Lochness, subject,
+                                       det_indices[subject.study])
+        except Exception as e:
+            logger.debug(f'no activity signals for {subject.id}: {e}')
+            signals = {}
+        last_activity[id(subject)] = max(signals.values()) \
+            if signals else None
+
+    # sorted is stable, so subjects with the same activity keep their order
+    return sorted(subjects,
+                  key=lambda x: (last_activity[id(x)] is None,
+                                 -(last_activity[id(x)] or 0)))
+
+
+Window = col.namedtuple('Window', ['days', 'start', 'end'])
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+class ScheduleError(Exception):
+    pass
+
+
+def parse_window(text: str) -> Window:
+    '''Parse a time window, eg) Mon-Fri 01:00-05:00, Sat,Sun 00:00-06:00
+
+    Days are optional (every day by default), and a window ending before its
+    start runs past midnight, eg) 22:00-02:00.
+    '''
+    match = re.match(r'^\s*(?:([A-Za-z,\-]+)\s+)?'
+                     r'(\d{1,2}:\d{2})\s*-\s*(\d{1,2}:\d{2})\s*$', text)
+    if not match:
+        raise ScheduleError(f'invalid schedule window: {text}')
+    days_text, start, end = match.groups()
+
+    days = set()
+    try:
+        for part in (days_text or 'mon-sun').lower().split(','):
+            first, _, last = part.partition('-')
+            first = WEEKDAYS.index(first[:3])
+            last = WEEKDAYS.index(last[:3]) if last else first
+            days.update(x % 7 for x in range(first, first + 1 +
+                                             (last - first) % 7))
+        start = dt.datetime.strptime(start, '%H:%M').time()
+        end = dt.datetime.strptime(end, '%H:%M').time()
+    except ValueError:
+        raise ScheduleError(f'invalid schedule window: {text}')
+    return Window(frozenset(days), start, end)
+
+
+def in_window(window: Window, now: dt.datetime) -> bool:
+    '''True if now is in the window'''
+    now_time = now.time()
+    if window.start <= window.end:
+        return now.weekday() in window.days and \
+            window.start <= now_time < window.end
+    # windows past midnight belong to the day they start
+    if now_time >= window.start:
+        return now.weekday() in window.days
+    return (now.weekday() - 1) % 7 in window.days and now_time < window.end
+
+
+def next_window_start(window: Window, now: dt.datetime) -> dt.datetime:
+    '''return the next time the window opens after now'''
+    for days in range(8):
+        day = (now + dt.timedelta(days=days)).date()
+        start = dt.datetime.combine(day, window.start)
+        if day.weekday() in window.days and start > now:
+            return start
+
+
+class SourceSchedule(object):
+    '''Poll interval and optional time windows of a single source
+
+    The interval is required, otherwise a source would be due again as soon
+    as it ran, and the sync loop would not sleep for as long as its window
+    is open.
+    '''
+    def __init__(self, interval: float, windows: list = None):
+        try:
+            self.interval = float(interval)
+        except (TypeError, ValueError):
+            raise ScheduleError(f'invalid schedule interval: {interval}')
+        if self.interval <= 0:
+            raise ScheduleError(f'invalid schedule interval: {interval}')
+        self.windows = [parse_window(x) for x in windows or []]
+
+    def is_due(self, last_run: float, now: dt.datetime) -> bool:
+        if last_run is not None and \
+                now.timestamp() - last_run < self.interval:
+            return False
+        return not self.windows or any(in_window(x, now)
+                                       for x in self.windows)
+
+    def next_due(self, last_run: float, now: dt.datetime) -> dt.datetime:
+        '''return the earliest time the source is due at or after now'''
+        due = now if last_run is None else max(
+                now, dt.datetime.fromtimestamp(last_run + self.interval))
+        if not self.windows or any(in_window(x, due) for x in self.windows):
+            return due
+        return min(next_window_start(x, due) for x in self.windows)
+
+
+class Schedule(object):
+    '''Per-source schedule of the continuous sync, from config.yml
+
+        schedule:
+            mindlamp:
+                interval: 3600
+            xnat:
+                interval: 86400
+                windows:
+                    - Mon-Fri 01:00-05:00
+
+    Sources without an entry are due every cycle, and sources without an
+    interval are polled every poll_interval within their windows. The time
+    each source last ran is kept in the state store, so a restart does not
+    poll every source again.
+    '''
+    def __init__(self, Lochness: 'Lochness'):
+        self.Lochness = Lochness
+        self.schedules = {}
+        for source, values in (Lochness.get('schedule') or {}).items():
+            values = dict(values or {})
+            unknown = set(values) - {'interval', 'windows'}
+            if unknown:
+                raise ScheduleError(f'unknown schedule fields for {source}: '
+                                    f'{unknown}')
+            if not values.get('interval'):
+                values['interval'] = Lochness.get('poll_interval')
+            self.schedules[source] = SourceSchedule(**values)
+
+    def last_run(self, source: str) -> float:
+        record = state.get(self.Lochness).get('schedule', '', source)
+        if record is None or record.remote_version is None:
+            return None
+        return float(record.remote_version)
+
+    def due(self, sources: list, now: dt.datetime = None) -> list:
+        '''return the sources which are due now'''
+        now = now or dt.datetime.now()
+        return [x for x in sources
+                if x not in self.schedules or
+                self.schedules[x].is_due(self.last_run(x), now)]
+
+    def mark_run(self, sources: list, started: float) -> None:
+        '''Record that sources ran in a cycle started at unix time
+
+        Only the sources which completed should be marked, so a source which
+        failed, or was skipped by its circuit breaker, is due again in the
+        next cycle rather than an interval later.
+        '''
+        store = state.get(self.Lochness)
+        for source in sources:
+            store.put('schedule', '', source, remote_version=started)
+
+    def sleep_seconds(self, sources: list, poll_interval: float,
+                      now: dt.datetime = None) -> float:
+        '''Return the seconds to sleep before the next cycle
+
+        Sources without a schedule are polled every poll_interval, and the
+        loop wakes up earlier when a scheduled source is due before that.
+        '''
+        now = now or dt.datetime.now()
+        seconds = [float(poll_interval)] \
+            if any(x not in self.schedules for x in sources) else []
+        seconds += [max(0, (self.schedules[x].next_due(self.last_run(x), now)
+                            - now).total_seconds())
+                    for x in sources if x in self.schedules]
+        return min(seconds) if seconds else float(poll_interval)
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import functools
+import logging
+import threading
+import collections as col
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+Shard = col.namedtuple('Shard', ['index', 'count'])
+
+PRIMARY_SHARD = 1
+LEASE_DIR = '.lochness_leases'
+DEFAULT_LEASE_TTL = 900
+STALE_LOCK_SECONDS = 60
+
+
+class ShardError(ValueError):
+    pass
+
+
+def parse(value: str) -> Shard:
+    '''parse a K/N shard argument, eg) 2/3 for the second of three nodes'''
+    try:
+        index, count = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise ShardError(f'shard should be K/N, eg) 1/3: {value}')
+    if not 1 <= index <= count:
+        raise ShardError(f'shard K/N should have 1 <= K <= N: {value}')
+    return Shard(index, count)
+
+
+def shard_of(study: str, subject_id: str, count: int) -> int:
+    '''Return the shard (1 to count) of a subject
+
+    The shard only depends on the study and subject ID, so every node agrees
+    on it regardless of the order or number of subjects.
+    '''
+    digest = hashlib.sha1(f'{study}/{subject_id}'.encode()).hexdigest()
+    return int(digest, 16) % count + 1
+
+
+def select(subjects: list, shards: list, count: int) -> list:
+    '''return the subjects which belong to any of shards'''
+    shards = set(shards)
+    return [x for x in subjects if shard_of(x.study, x.id, count) in shards]
+
+
+def is_primary(node_shard: Shard, shards: list) -> bool:
+    '''Return True if this node runs the steps shared by every subject
+
+    eg) initializing the metadata and the Lochness to Lochness transfer,
+    which only the node holding PRIMARY_SHARD runs. Always True when the
+    subjects are not sharded.
+    '''
+    return node_shard is None or PRIMARY_SHARD in shards
+
+
+class Leases(object):
+    '''Lease files shared by the sync nodes of a PHOENIX directory
+
+    Each node holds the lease of its own shard, renewed in the background
+    every third of the lease ttl. A node takes over the shards whose lease
+    expired, eg) of a node that died or stopped, and gives a shard back as
+    soon as its lease is renewed by another node, such as the original node
+    coming back. A shard without any lease file may belong to a node which
+    is just starting, so it is only taken over once this node has been
+    running for a whole ttl. Lease updates are serialized by an exclusive
+    lock file per shard.
+
+    Key Arguments:
+        lease_dir: directory of the lease files, str.
+        shard: Shard of this node.
+        ttl: seconds before a lease which is not renewed expires, float.
+        node: name of this node, defaults to hostname:pid, str.
+    '''
+    def __init__(self, lease_dir: str, shard: Shard,
+                 ttl: float = DEFAULT_LEASE_TTL, node: str = None):
+        self.lease_dir = Path(lease_dir)
+        self.shard = shard
+        self.ttl = float(ttl)
+        self.node = node or f'{socket.gethostname()}:{os.getpid()}'
+        self.held = set()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._renewer = None
+        self._stopped = threading.Event()
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, index: int) -> Path:
+        return self.lease_dir / f'shard_{index}_of_{self.shard.count}.lease'
+
+    def read(self, index: int) -> dict:
+        '''return the lease of a shard, or None'''
+        try:
+            with open(self._path(index), 'r') as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, index: int, expires: float = None) -> None:
+        path = self._path(index)
+        tmp = path.with_name(f'.{path.name}.{self.node}.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump({'node': self.node,
+                       'expires': time.time() + self.ttl
+                       if expires is None else expires}, fp)
+        os.replace(tmp, path)
+
+    def _locked(self, index: int) -> bool:
+        '''take the lock file of a shard, removing stale locks'''
+        lock = self._path(index).with_suffix('.lock')
+        try:
+            if time.time() - lock.stat().st_mtime > STALE_LOCK_SECONDS:
+                lock.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _unlock(self, index: int) -> None:
+        try:
+            self._path(index).with_suffix('.lock').unlink()
+        except FileNotFoundError:
+            pass
+
+    def _claim(self, index: int, force: bool = False) -> bool:
+        '''Take the lease of a shard if it is ours or expired
+
+        A shard which was never leased is only taken once this node has
+        been running for a whole ttl. force takes the lease from another node
+        even if it has not expired.
+        '''
+        if not self._locked(index):
+            return False
+        try:
+            lease = self.read(index)
+            if force or (lease is not None and lease['node'] == self.node):
+                claim = True
+            elif lease is None:
+                claim = time.time() - self.started >= self.ttl
+            else:
+                claim = lease['expires'] < time.time()
+            if not claim:
+                return False
+            if lease is not None and lease['node'] != self.node:
+                logger.info(f'taking over shard {index}/'
+                            f'{self.shard.count} from {lease["node"]}')
+            self._write(index)
+            return True
+        finally:
+            self._unlock(index)
+
+    def acquire(self) -> list:
+        '''Renew our own lease and take over expired ones
+
+        Returns:
+            sorted list of the shards held by this node.
+        '''
+        with self._lock:
+            # a node always takes its own shard back
+            held = {self.shard.index} \
+                if self._claim(self.shard.index, force=True) else set()
+            for index in range(1, self.shard.count + 1):
+                if index != self.shard.index and self._claim(index):
+                    held.add(index)
+            self.held = held
+        self._start_renewer()
+        logger.info(f'holding shards {sorted(held)} of {self.shard.count}')
+        return sorted(held)
+
+    def renew(self) -> None:
+        '''renew the leases held, dropping those taken by another node'''
+        with self._lock:
+            for index in sorted(self.held):
+                lease = self.read(index)
+                if lease is not None and lease['node'] != self.node and \
+                        index != self.shard.index:
+                    logger.info(f'shard {index}/{self.shard.count} was '
+                                f'taken by {lease["node"]}')
+                    self.held.discard(index)
+                    continue
+                if not self._claim(index, force=index == self.shard.index):
+                    self.held.discard(index)
+
+    def holds(self, index: int) -> bool:
+        '''True while this node holds the lease of a shard'''
+        with self._lock:
+            return index in self.held
+
+    def while_held(self, index: int, func):
+        '''Wrap a sync function to skip subjects of a shard given back
+
+        eg) when the node of the shard comes back in the middle of a sync
+        cycle, the subjects of the shard which are still waiting are left to
+        it.
+        '''
+        @functools.wraps(func)
+        def sync(Lochness, subject, dry=False):
+            if not self.holds(index):
+                logger.info(f'skipping {subject.study}/{subject.id}, shard '
+                            f'{index}/{self.shard.count} was taken back')
+                return
+            return func(Lochness, subject, dry=dry)
+        return sync
+
+    def _start_renewer(self) -> None:
+        if self._renewer is not None:
+            return
+
+        def renew():
+            while not self._stopped.wait(self.ttl / 3):
+                try:
+                    self.renew()
+                except OSError as e:
+                    logger.warning(f'failed to renew shard leases: {e}')
+
+        self._renewer = threading.Thread(target=renew, daemon=True,
+                                         name='lochness-leases')
+        self._renewer.start()
+
+    def release(self) -> None:
+        '''Stop renewing, and expire the leases held by this node, so the
+        other nodes can take its shards over right away'''
+        self._stopped.set()
+        with self._lock:
+            for index in self.held:
+                lease = self.read(index)
+                if lease is not None and lease['node'] == self.node:
+                    self._write(index, expires=0)
+            self.held = set()
+
+
+def configure(Lochness: 'Lochness', shard: Shard) -> None:
+    '''register the shard of this node in the Lochness object'''
+    Lochness['shard'] = shard
+
+
+def lease_dir(Lochness: 'Lochness') -> Path:
+    '''directory of the shard lease files, under PHOENIX'''
+    return Path(Lochness['phoenix_root']) / LEASE_DIR
+
+
+_leases = None
+
+
+def get_leases(Lochness: 'Lochness', shard: Shard) -> Leases:
+    '''return the (shared) Leases of this process'''
+    global _leases
+    if _leases is None:
+        _leases = Leases(lease_dir(Lochness), shard,
+                         ttl=Lochness.get('shard_lease_ttl',
+                                          DEFAULT_LEASE_TTL))
+    return _leases
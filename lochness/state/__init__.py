@@ -0,0 +1,205 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections as col
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+Record = col.namedtuple('Record', ['subject', 'object_id', 'remote_version',
+                                   'local_hash', 'local_size', 'local_mtime',
+                                   'updated_at'])
+
+TABLE_SCHEMA = '''CREATE TABLE IF NOT EXISTS {table} (
+    subject TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    remote_version TEXT,
+    local_hash TEXT,
+    local_size INTEGER,
+    local_mtime REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (subject, object_id)
+) WITHOUT ROWID'''
+
+
+class StateStore(object):
+    '''Incremental sync state, persisted in a single SQLite database
+
+    There is one table per source (eg. xnat, box, mindlamp), keyed by the
+    subject and the id of the remote object (eg. XNAT experiment label or Box
+    file id). Each row holds the version of the remote object that was last
+    downloaded (etag, sha1, archived date or mtime) and the hash of the local
+    copy, so a source module can tell whether an object is unchanged with a
+    single indexed lookup.
+
+    Connections are kept per thread, so a store can be shared by the sync
+    workers.
+    '''
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._local = threading.local()
+        self._tables = set()
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _table(self, source: str) -> str:
+        '''return the table name for a source, creating it if needed'''
+        if not re.match(r'^[a-z_][a-z0-9_]*$', source):
+            raise StateError(f'invalid source name for the state store: '
+                             f'{source}')
+        if source not in self._tables:
+            with self._lock:
+                self._connection().execute(TABLE_SCHEMA.format(table=source))
+                self._tables.add(source)
+        return source
+
+    def get(self, source: str, subject: str, object_id: str) -> Record:
+        '''return the stored record of a remote object, or None'''
+        table = self._table(source)
+        row = self._connection().execute(
+                f'SELECT subject, object_id, remote_version, local_hash, '
+                f'local_size, local_mtime, updated_at FROM {table} '
+                f'WHERE subject = ? AND object_id = ?',
+                (subject, str(object_id))).fetchone()
+        return Record(*row) if row else None
+
+    def is_current(self, source: str, subject: str, object_id: str,
+                   remote_version: str) -> bool:
+        '''True if the stored remote version matches remote_version'''
+        record = self.get(source, subject, object_id)
+        return record is not None and \
+            record.remote_version == str(remote_version)
+
+    def put(self, source: str, subject: str, object_id: str,
+            remote_version: str = None, local_hash: str = None,
+            local_path: str = None) -> None:
+        '''Insert or replace the record of a remote object
+
+        When local_path is given, its size and mtime are stored alongside the
+        local hash.
+        '''
+        table = self._table(source)
+        local_size, local_mtime = None, None
+        if local_path is not None:
+            stat = os.stat(local_path)
+            local_size, local_mtime = stat.st_size, stat.st_mtime
+        remote_version = None if remote_version is None \
+            else str(remote_version)
+        self._connection().execute(
+                f'INSERT OR REPLACE INTO {table} (subject, object_id, '
+                f'remote_version, local_hash, local_size, local_mtime, '
+                f'updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (subject, str(object_id), remote_version, local_hash,
+                 local_size, local_mtime, time.time()))
+
+    def local_hash(self, source: str, subject: str, object_id: str,
+                   local_path: str) -> str:
+        '''Return the stored hash of a local file, if it is still valid
+
+        The stored hash is only returned when local_path still has the size
+        and mtime recorded with it, so the file does not need to be read
+        again to know its hash.
+        '''
+        record = self.get(source, subject, object_id)
+        if record is None or record.local_hash is None:
+            return None
+        try:
+            stat = os.stat(local_path)
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime) != (record.local_size,
+                                             record.local_mtime):
+            return None
+        return record.local_hash
+
+    def records(self, source: str, subject: str) -> list:
+        '''return the stored records of every remote object of a subject'''
+        table = self._table(source)
+        rows = self._connection().execute(
+                f'SELECT subject, object_id, remote_version, local_hash, '
+                f'local_size, local_mtime, updated_at FROM {table} '
+                f'WHERE subject = ?', (subject,)).fetchall()
+        return [Record(*row) for row in rows]
+
+    def last_update(self, source: str, subject: str) -> float:
+        '''unix time of the latest record update of a subject, or None'''
+        table = self._table(source)
+        row = self._connection().execute(
+                f'SELECT MAX(updated_at) FROM {table} WHERE subject = ?',
+                (subject,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, source: str, subject: str, object_id: str) -> None:
+        '''forget a remote object, so it is downloaded again'''
+        table = self._table(source)
+        self._connection().execute(
+                f'DELETE FROM {table} WHERE subject = ? AND object_id = ?',
+                (subject, str(object_id)))
+
+
+class StateError(Exception):
+    pass
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+LOCAL_STATE_DIR = '~/.lochness'
+
+
+def state_db_path(Lochness: 'Lochness') -> Path:
+    '''Return the location of the state database
+
+    Defaults to .lochness_state.db next to the PHOENIX root, so it is never
+    picked up by the lochness to lochness transfer. Sharded nodes
+    (Lochness['shard']) usually share the PHOENIX mount over NFS, where
+    SQLite locking is not safe, so they default to a database on the local
+    disk of the node, under LOCAL_STATE_DIR, and refuse a state_db on the
+    shared mount.
+    '''
+    phoenix_root = Path(os.path.expanduser(Lochness['phoenix_root']))
+    shared_default = phoenix_root.parent / '.lochness_state.db'
+
+    if Lochness.get('state_db'):
+        path = Path(os.path.expanduser(Lochness['state_db']))
+    elif Lochness.get('shard'):
+        digest = hashlib.sha1(
+                str(phoenix_root.resolve()).encode()).hexdigest()[:12]
+        path = Path(os.path.expanduser(LOCAL_STATE_DIR)) / \
+            f'state_{digest}.db'
+    else:
+        return shared_default
+
+    if Lochness.get('shard'):
+        resolved = path.resolve()
+        if resolved == shared_default.resolve() or \
+                phoenix_root.resolve() in resolved.parents:
+            raise StateError(f'state_db {path} is on the PHOENIX directory '
+                             'shared by the sync nodes. Set state_db to a '
+                             'path on the local disk of each node')
+    return path
+
+
+def get(Lochness: 'Lochness') -> StateStore:
+    '''return the (shared) state store for the Lochness configuration'''
+    path = state_db_path(Lochness)
+    with _stores_lock:
+        if str(path) not in _stores:
+            logger.debug(f'opening sync state store {path}')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _stores[str(path)] = StateStore(str(path))
+        return _stores[str(path)]
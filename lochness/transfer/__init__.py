@@ -14,6 +14,8 @@ import tarfile
 import shutil
 import logging
 from lochness import keyring
+import lochness.deadline as deadline
+from lochness.shard import LEASE_DIR
 
 from typing import List, Tuple
 
@@ -49,11 +51,13 @@ def get_updated_files(phoenix_root: str,
         find_command = f'find {phoenix_root} ' \
                        f'-path {phoenix_root}/PROTECTED -prune -o ' \
                        f'\( -type f ' \
+                       f'! -path "*/{LEASE_DIR}/*" ' \
                        f'-newermt "{date_time_start}" ' \
                        f'! -newermt "{date_time_end}" \)'
     else:
         find_command = f'find {phoenix_root} ' \
                        f'-type f ' \
+                       f'! -path "*/{LEASE_DIR}/*" ' \
                        f'-newermt "{date_time_start}" ' \
                        f'! -newermt "{date_time_end}"'
 
@@ -275,10 +279,7 @@ def lochness_to_lochness_transfer_rsync(Lochness, general_only: bool = True):
             {source_directory}/ \
             {rsync_id}@{rsync_server}:{phoenix_path_rsync}'
 
-    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    proc.wait()
-
-    outs, _ = proc.communicate()
+    deadline.run(command, stdout=subprocess.PIPE)
 
 
 def send_file_to_s3_phoenix(Lochness, source_file: Path) -> None:
@@ -300,7 +301,7 @@ def send_file_to_s3_phoenix(Lochness, source_file: Path) -> None:
     command = f"aws s3 cp \
             {source_file} s3://{s3_bucket_name}/{target_path} \
             --exclude '*.mp3' --exclude '.checksum*'"
-    command_out = os.popen(command).read()
+    command_out = deadline.run(command, stdout=subprocess.PIPE).stdout
 
     # update s3 log
     now = datetime.now()
@@ -349,7 +350,7 @@ def lochness_to_lochness_transfer_s3(Lochness,
                 {metadata_dir} \
                 s3://{s3_bucket_name}/{s3_phoenix_metadata} \
                 --exclude='*' --include='*metadata.csv'"
-        os.popen(command).read()
+        deadline.run(command, stdout=subprocess.PIPE)
 
     for datatype in ['mri', 'surveys', 'phone',
                      'actigraphy', 'eeg', 'interviews']:
@@ -382,9 +383,11 @@ def lochness_to_lochness_transfer_s3(Lochness,
             s3_sync_stdout = Path(Lochness['phoenix_root']) / 'aws_s3_sync_stdouts.log'
             now = datetime.now()
             current_time = now.strftime("%Y-%m-%d %H:%M:%S")
+            command_out = deadline.run(command,
+                                       stdout=subprocess.PIPE).stdout
             with open(s3_sync_stdout, 'a') as fp:
                 command_str = '\n'.join([f'{current_time} {x}' for x in
-                                         os.popen(command).read().split('\n')
+                                         command_out.split('\n')
                                          if 'upload' in x]) + '\n'
                 fp.write(command_str)
 
@@ -567,10 +570,12 @@ def lochness_to_lochness_transfer_s3_protected(Lochness,
 
                 now = datetime.now()
                 current_time = now.strftime("%Y-%m-%d %H:%M:%S")
+                command_out = deadline.run(command,
+                                           stdout=subprocess.PIPE).stdout
                 with open(s3_sync_stdout, 'a') as fp:
                     command_str = '\n'.join(
                             [f'{current_time} {x}' for x in
-                             os.popen(command).read().split('\n')
+                             command_out.split('\n')
                              if 'upload' in x]) + '\n'
                     fp.write(command_str)
 
@@ -605,10 +610,11 @@ def lochness_to_lochness_transfer_s3_protected(Lochness,
 
         now = datetime.now()
         current_time = now.strftime("%Y-%m-%d %H:%M:%S")
+        command_out = deadline.run(command, stdout=subprocess.PIPE).stdout
         with open(s3_sync_stdout, 'a') as fp:
             command_str = '\n'.join(
                     [f'{current_time} {x}' for x in
-                     os.popen(command).read().split('\n')
+                     command_out.split('\n')
                      if 'upload' in x]) + '\n'
             fp.write(command_str)
 
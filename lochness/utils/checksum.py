@@ -1,12 +1,12 @@
 import hashlib
 
 def get_sha(file_loc: str) -> str:
-    '''return sha256 hexdigest of a file'''
+    '''return sha256 hexdigest of a file, reading the whole file in chunks'''
     BUF_SIZE = 65536
     sha256 = hashlib.sha256()
 
     with open(file_loc, 'rb') as f:
-        data = f.read(BUF_SIZE)
-        sha256.update(data)
+        for data in iter(lambda: f.read(BUF_SIZE), b''):
+            sha256.update(data)
 
     return sha256.hexdigest()
@@ -17,7 +17,7 @@ from lochness.utils.path_checker import check_file_path_df, print_deviation, \
         ampscz_id_validate, ampscz_penn_validate
 from lochness.config import load
 from lochness.email import send_detail
-from lochness.redcap import post_to_redcap
+from lochness.redcap import iter_records_from_redcap
 tz = timezone('EST')
 
 
@@ -77,10 +77,8 @@ def check_list_all_penn_cnb_subjects(
         'fields[1]': 'session_siteid',
     }
 
-    content = post_to_redcap(api_url, record_query, '')
-    content_dict_list = json.loads(content)
-
-    df = pd.DataFrame(content_dict_list)
+    df = pd.DataFrame.from_records(
+            iter_records_from_redcap(api_url, record_query, ''))
     if len(df) > 1:
         df.columns = ['site_orig', 'subject']
 
@@ -123,10 +121,8 @@ def check_list_all_redcap_subjects(project_name: str,
         'events[1]': 'screening_arm_2',
     }
 
-    content = post_to_redcap(api_url, record_query, '')
-    content_dict_list = json.loads(content)
-
-    df = pd.DataFrame(content_dict_list)
+    df = pd.DataFrame.from_records(
+            iter_records_from_redcap(api_url, record_query, ''))
     if len(df) > 1:
         df.columns = ['subject', '_', 'consent_date']
 
@@ -9,6 +9,9 @@ import collections as col
 from pathlib import Path
 import lochness.net as net
 import lochness.tree as tree
+import lochness.state as state
+import lochness.ratelimit as ratelimit
+import lochness.deadline as deadline
 import lochness.config as config
 from lochness.cleaner import is_transferred_and_removed
 
@@ -68,6 +71,9 @@ def sync_old(Lochness, subject, dry=False):
                                             FOLDER=dst))
 
                 if not dry:
+                    # yaxil downloads can not be interrupted, so the
+                    # deadline is checked before each experiment
+                    deadline.check(f'xnat {subject.id}')
                     tmpdir = tf.mkdtemp(dir=dirname, prefix='.')
                     os.chmod(tmpdir, 0o0755)
                     yaxil.download(auth, experiment.label,
@@ -95,8 +101,9 @@ def sync(Lochness, subject, dry=False):
         xnat_uid) returns nothing preventing the execution of inner loop
         '''
         _xnat_uids= xnat_uids + [(x[0], x[1].lower()) for x in xnat_uids]
+        store = state.get(Lochness)
         for xnat_uid in _xnat_uids:
-            for experiment in experiments(auth, xnat_uid):
+            for experiment in experiments(auth, xnat_uid, alias=alias):
                 logger.info(experiment)
                 dirname = tree.get('mri',
                                    subject.protected_folder,
@@ -104,11 +111,20 @@ def sync(Lochness, subject, dry=False):
                                    BIDS=Lochness['BIDS'])
                 dst = os.path.join(dirname, f'{experiment.label.upper()}.zip')
 
+                # same archived date as the last download, which is still
+                # there (the record does not count once the file is gone)
+                archieved_date = experiment.archived_date
+                if os.path.exists(dst) and store.is_current(
+                        'xnat', subject.id, experiment.label.upper(),
+                        archieved_date):
+                    continue
+
                 # do not re-download already transferred & removed data
                 if is_transferred_and_removed(Lochness, dst):
                     continue
 
-                archieved_date = experiment.archived_date
+                # fall back to the archived date file written by older
+                # versions, and record it in the state store
                 archieved_date_log = os.path.join(
                         dirname, f'.{experiment.label.upper()}')
                 if os.path.exists(dst):
@@ -118,6 +134,9 @@ def sync(Lochness, subject, dry=False):
 
                         if archieved_date == archieved_date_prev:
                             # same archieved date
+                            store.put('xnat', subject.id,
+                                      experiment.label.upper(),
+                                      remote_version=archieved_date)
                             continue
 
                 message = 'downloading {PROJECT}/{LABEL} to {FOLDER}'
@@ -126,14 +145,20 @@ def sync(Lochness, subject, dry=False):
                                             FOLDER=dst))
 
                 if not dry:
-                    yaxil.download(auth, experiment.label,
-                                   project=experiment.project,
-                                   scan_ids=['ALL'], out_file=dst,
-                                   in_mem=False, attempts=3,
-                                   out_format='native', extract=False)
+                    # yaxil downloads can not be interrupted, so the
+                    # deadline is checked before each experiment
+                    deadline.check(f'xnat {subject.id}')
+                    with ratelimit.get(alias):
+                        yaxil.download(auth, experiment.label,
+                                       project=experiment.project,
+                                       scan_ids=['ALL'], out_file=dst,
+                                       in_mem=False, attempts=3,
+                                       out_format='native', extract=False)
                     save_experiment_file(dirname, auth.url, experiment)
                     with open(archieved_date_log, 'w') as fp:
                         fp.write(archieved_date)
+                    store.put('xnat', subject.id, experiment.label.upper(),
+                              remote_version=archieved_date)
 
 
 def check_consistency(d, experiment):
@@ -174,13 +199,14 @@ def save_experiment_file(d, url, experiment, extract=False):
     os.rename(fo.name, experiment_file)
 
 
-def experiments(auth, uid):
+def experiments(auth, uid, alias=None):
     '''generator for mr session ids'''
     try:
         project, subject = uid
         logger.info('searching xnat for {0}'.format(uid))
-        xnat_subject = yaxil.subjects(auth, subject, project)
-        xnat_subject = next(xnat_subject)
+        with ratelimit.get(alias):
+            xnat_subject = yaxil.subjects(auth, subject, project)
+            xnat_subject = next(xnat_subject)
     except yaxil.exceptions.AccessionError as e:
         logger.info('Accession Error for {0}'.format(uid))
         return
@@ -188,6 +214,9 @@ def experiments(auth, uid):
         logger.info('no xnat subject registered for {0}'.format(uid))
         return
 
-    for experiment in yaxil.experiments(auth, subject=xnat_subject):
+    with ratelimit.get(alias):
+        xnat_experiments = list(yaxil.experiments(auth, subject=xnat_subject))
+
+    for experiment in xnat_experiments:
         yield experiment
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from lochness.redcap import data_trigger_capture
+from lochness.redcap import det_log
 import sys
 import argparse
 
@@ -22,15 +23,45 @@ def parse_args(args):
     argparser.add_argument(
             "--port", "-p",
             type=int,
-            required=True,
             default=8080,
             help='port number to listen')
-    
+
+    argparser.add_argument(
+            "--export_csv", "-ec",
+            action='store_true',
+            help='Export the data entry trigger log to the CSV database, '
+                 'and exit')
+
+    argparser.add_argument(
+            "--compact", "-cp",
+            action='store_true',
+            help='Move the data entry trigger log to the compressed history, '
+                 'back it up, and exit. Only run this when no listener is '
+                 'writing to the database, which compacts its log daily')
+
+    argparser.add_argument(
+            "--notify_socket", "-ns",
+            type=str,
+            default=None,
+            help='Unix socket of sync.py --det-socket, notified of the '
+                 'record ID of every data entry trigger')
+
     return argparser.parse_args(args)
 
 
 if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
 
+    if args.export_csv:
+        det_log.export_csv(args.database_csv)
+        sys.exit(0)
+
+    if args.compact:
+        log = det_log.get_log(args.database_csv)
+        log.compact()
+        log.back_up()
+        sys.exit(0)
+
     data_trigger_capture.run(args.database_csv,
-                             port=args.port)
+                             port=args.port,
+                             notify_socket=args.notify_socket)
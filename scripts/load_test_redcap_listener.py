@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+from lochness.redcap import data_trigger_capture
+from lochness.redcap import det_log
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import tempfile as tf
+import threading
+import requests
+import argparse
+import time
+import sys
+
+
+BODY = ('redcap_url=https%3A%2F%2Fredcap.server%2Fredcap%2F&'
+        'project_url=https%3A%2F%2Fredcap.server%2Fredcap%2F'
+        'redcap_v10.0.30%2Findex.php%3Fpid%3D26709&'
+        'project_id=26709&username=load_test&record={record}&'
+        'instrument=inclusionexclusion_checklist&'
+        'inclusionexclusion_checklist_complete=0')
+
+
+def parse_args(args):
+    '''Parse inputs coming from the terminal'''
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Fire synthetic REDCap data entry triggers at a '
+                    'listen_to_redcap.py instance',
+        epilog="DPACC")
+
+    argparser.add_argument(
+            "--url", "-u",
+            type=str,
+            default=None,
+            help='URL of a running listener. A local listener is started '
+                 'on --port with a temporary database when not given')
+
+    argparser.add_argument(
+            "--port", "-p",
+            type=int,
+            default=8080,
+            help='port number of the local listener')
+
+    argparser.add_argument(
+            "--n_triggers", "-n",
+            type=int,
+            default=5000,
+            help='number of data entry triggers to send')
+
+    argparser.add_argument(
+            "--concurrency", "-c",
+            type=int,
+            default=50,
+            help='number of triggers sent at the same time')
+
+    return argparser.parse_args(args)
+
+
+def start_local_listener(port: int, db_location: str):
+    '''start a listener in a background thread'''
+    httpd = data_trigger_capture.make_server(db_location, port=port)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def fire(url: str, n_triggers: int, concurrency: int) -> list:
+    '''Send the triggers, returning the latency (or None when failed)'''
+    local = threading.local()
+
+    def send(num):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.monotonic()
+        try:
+            response = local.session.post(
+                    url, data=BODY.format(record=f'LT{num:05d}'), timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            return None
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(send, range(n_triggers)))
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+
+    httpd = None
+    if args.url is None:
+        tmpdir = tf.mkdtemp(prefix='det_load_test_')
+        db_location = Path(tmpdir) / 'data_entry_trigger_database.csv'
+        httpd = start_local_listener(args.port, db_location)
+        args.url = f'http://localhost:{args.port}/'
+        print(f'local listener saving to {db_location}')
+
+    start = time.monotonic()
+    latencies = fire(args.url, args.n_triggers, args.concurrency)
+    seconds = time.monotonic() - start
+
+    ok = [x for x in latencies if x is not None]
+    print(f'{len(ok)} / {args.n_triggers} triggers acknowledged in '
+          f'{seconds:.1f} s ({len(ok) / seconds:.0f} per second)')
+    if ok:
+        print(f'latency: median {percentile(ok, 0.5) * 1000:.1f} ms, '
+              f'p99 {percentile(ok, 0.99) * 1000:.1f} ms, '
+              f'max {max(ok) * 1000:.1f} ms')
+
+    if httpd is not None:
+        httpd.shutdown()
+        httpd.server_close()
+        httpd.writer.stop()
+        n_saved = len(list(det_log.read_entries(
+            det_log.log_path(db_location))))
+        print(f'{n_saved} triggers saved to the log')
+        if n_saved != len(ok):
+            sys.exit(1)
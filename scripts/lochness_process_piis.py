@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+from lochness import config
+from lochness.redcap.process_piis import process_study_surveys
+import argparse
+import logging
+import sys
+import os
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def parse_args(args):
+    '''Parse inputs coming from the terminal'''
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Process PII of the raw surveys of all subjects of '
+                    'studies, using the pii_table of the configuration file',
+        epilog="DPACC")
+
+    argparser.add_argument(
+            "--config", "-c",
+            type=str,
+            required=True,
+            help='Configuration file')
+
+    argparser.add_argument(
+            "--archive-base", "-a",
+            type=str,
+            default=None,
+            help='Base output directory')
+
+    argparser.add_argument(
+            "--studies", "-s",
+            nargs='+',
+            required=True,
+            help='Studies to process, eg) PronetLA PronetYA')
+
+    argparser.add_argument(
+            "--workers", "-w",
+            type=int,
+            default=None,
+            help='Number of processes. Defaults to the number of CPUs')
+
+    return argparser.parse_args(args)
+
+
+def load_config(config_loc: str, archive_base: str = None) -> dict:
+    '''Load the configuration file, without the keyring'''
+    with open(os.path.expanduser(config_loc), 'rb') as fp:
+        Lochness = config._read_config_file(fp)
+
+    if archive_base:
+        Lochness['phoenix_root'] = archive_base
+    Lochness['phoenix_root'] = os.path.expanduser(Lochness['phoenix_root'])
+    Lochness.setdefault('BIDS', False)
+
+    return Lochness
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(sys.argv[1:])
+    Lochness = load_config(args.config, args.archive_base)
+
+    for study in args.studies:
+        n_files = process_study_surveys(Lochness, study, args.workers)
+        logger.info(f'{study}: PII processed in {n_files} survey files')
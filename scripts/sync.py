@@ -2,6 +2,7 @@
 
 import os
 import sys
+import copy
 import time
 import lochness
 import logging
@@ -15,6 +16,7 @@ import lochness.xnat as XNAT
 import lochness.beiwe as Beiwe
 import lochness.redcap as REDCap
 from lochness.redcap import save_redcap_metadata
+import lochness.redcap.det_notify as det_notify
 import lochness.mindlamp as Mindlamp
 import lochness.dropbox as Dropbox
 import lochness.box as Box
@@ -22,6 +24,12 @@ import lochness.mediaflux as Mediaflux
 import lochness.daris as Daris
 import lochness.rpms as RPMS
 import lochness.scheduler as scheduler
+import lochness.executor as executor
+import lochness.net as net
+import lochness.deadline as deadline
+import lochness.shard as shard
+import lochness.state as state
+from lochness.functools import new_cycle
 import lochness.icognition as iCognition
 import lochness.onlinescoring as OnlineScoring
 from lochness.transfer import lochness_to_lochness_transfer_sftp
@@ -80,6 +88,27 @@ def main():
                         help='Subjects to sync')
     parser.add_argument('--fork', action='store_true',
                         help='Daemonize the process')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of subject x source sync jobs to run '
+                             'concurrently (default: 1, run in series)')
+    parser.add_argument('--max-per-source', type=int, default=None,
+                        help='Maximum number of concurrent sync jobs for a '
+                             'single source (default: --workers)')
+    parser.add_argument('--shard', type=shard.parse,
+                        help='Only sync the K-th of N shards of the subjects, '
+                             'when N nodes share the same PHOENIX e.g., 2/3')
+    parser.add_argument('--shard-leases', action='store_true',
+                        help='Hold the shard with a lease file under PHOENIX '
+                             'and take over the shards of nodes whose lease '
+                             'expired (requires --shard)')
+    parser.add_argument('--prioritize', action='store_true',
+                        help='Sync the subjects with the most recent '
+                             'activity first')
+    parser.add_argument('--det-socket',
+                        help='Unix socket where listen_to_redcap.py '
+                             '--notify_socket pushes data entry triggers, to '
+                             'sync REDCap right away for their subjects '
+                             '(requires --continuous)')
     parser.add_argument('--until', type=scheduler.parse,
                         help='Pause execution until specified date e.g., '
                              '2017-01-01T15:00:00')
@@ -112,6 +141,10 @@ def main():
                         help='Remove old files which are already transferred '
                              'to s3 from PHOENIX directory')
     args = parser.parse_args()
+    if args.shard_leases and not args.shard:
+        parser.error('--shard-leases requires --shard')
+    if args.det_socket and not args.continuous:
+        parser.error('--det-socket requires --continuous')
 
     # configure logging for this application
     lochness.configure_logging(logger, args)
@@ -133,6 +166,15 @@ def main():
     # register log-file path
     Lochness['log_file'] = str(args.log_file)
 
+    # register the shard of this node, whose state database has to be on
+    # its local disk
+    if args.shard:
+        shard.configure(Lochness, args.shard)
+        try:
+            logger.info(f'state database: {state.state_db_path(Lochness)}')
+        except state.StateError as e:
+            parser.error(str(e))
+
     # fork the current process if necessary
     if args.fork:
         logger.info('forking the current process')
@@ -147,6 +189,10 @@ def main():
 
     # run downloader once, or continuously
     if args.continuous:
+        schedule = scheduler.Schedule(Lochness)
+        listener = None
+        if args.det_socket and 'redcap' in source_names(args):
+            listener = det_notify.Listener(args.det_socket)
         while True:
             # remove already transferred files
             if args.remove_old_files:
@@ -156,7 +202,14 @@ def main():
                         removed_df_loc=Lochness['removed_df_loc'],
                         removed_phoenix_root=Lochness['removed_phoenix_root'])
 
-            do(args, Lochness)
+            # only the sources which are due in their schedule are synced,
+            # while the Lochness to Lochness transfer runs every cycle
+            cycle_start = time.time()
+            due_sources = schedule.due(source_names(args))
+            logger.info(f'sources due in this cycle: {due_sources}')
+            completed = do(args, Lochness, due_sources)
+            if completed:
+                schedule.mark_run(completed, cycle_start)
 
             email_dates_file = Path(Lochness['phoenix_root']).parent / \
                     '.email_tmp.txt'
@@ -185,9 +238,14 @@ def main():
                 with open(email_dates_file, 'w') as fp:
                     fp.write(str(date.today()))
 
-            poll_interval = int(Lochness['poll_interval'])
-            logger.info(f'sleeping for {poll_interval} seconds')
-            time.sleep(Lochness['poll_interval'])
+            sleep_seconds = schedule.sleep_seconds(
+                    source_names(args), int(Lochness['poll_interval']))
+            logger.info(f'sleeping for {sleep_seconds:.0f} seconds')
+            if listener is None:
+                time.sleep(sleep_seconds)
+            else:
+                wait_for_data_entry_triggers(args, Lochness, listener,
+                                             sleep_seconds)
     else:
         # remove already transferred files
         if args.remove_old_files:
@@ -206,14 +264,137 @@ def main():
                 check_source(Lochness)
 
 
-def do(args, Lochness):
+def source_names(args) -> list:
+    '''names of the sources synced, eg) redcap, as used in config.yml'''
+    if args.hdd:
+        return ['hdd']
+    return sorted(set(executor.source_name(x) for x in args.source))
+
+
+def args_for_sources(args, sources: list):
+    '''return a copy of args which only syncs the given sources'''
+    cycle_args = copy.copy(args)
+    if args.hdd:
+        if 'hdd' not in sources:
+            cycle_args.hdd = []
+            cycle_args.source = []
+            cycle_args.input_sources = []
+        return cycle_args
+    cycle_args.source = [x for x in args.source
+                         if executor.source_name(x) in sources]
+    cycle_args.input_sources = [
+            x for x in args.input_sources
+            if executor.source_name(SOURCES[x]) in sources]
+    return cycle_args
+
+
+def args_for_subjects(args, subject_ids: list):
+    '''Return a copy of args which only syncs REDCap for the given subjects
+
+    Metadata initialization and the Lochness to Lochness transfer are left
+    for the next regular cycle.
+    '''
+    cycle_args = args_for_sources(args, ['redcap'])
+    cycle_args.subject = subject_ids
+    cycle_args.input_sources = []
+    cycle_args.lochness_sync_send = False
+    return cycle_args
+
+
+def wait_for_data_entry_triggers(args, Lochness, listener, seconds):
+    '''Sleep for seconds, syncing REDCap as soon as data entry triggers of
+    listen_to_redcap.py arrive at the listener'''
+    wake_up = time.monotonic() + seconds
+    while True:
+        records = listener.wait(wake_up - time.monotonic())
+        if records:
+            subject_ids = det_notify.select_subjects(
+                    lochness.read_phoenix_metadata(Lochness, args.studies),
+                    records)
+            logger.info(f'data entry triggers for records {sorted(records)}'
+                        f', syncing REDCap for subjects {subject_ids}')
+            if subject_ids:
+                do(args_for_subjects(args, subject_ids), Lochness)
+        if time.monotonic() >= wake_up:
+            return
+
+
+def do(args, Lochness, due_sources: list = None):
+    '''Sync the sources, and transfer the new files to another Lochness
+
+    Key Arguments:
+        args: arguments of sync.py.
+        Lochness: Lochness object.
+        due_sources: names of the sources to sync, eg) ['redcap'], when only
+                     the sources due in their schedule are synced. Files of
+                     every source are still transferred. Defaults to all
+                     sources of args.
+
+    Returns:
+        names of the synced sources none of whose jobs failed or were
+        skipped by a circuit breaker, list of str.
+    '''
+    # forget remote data cached during the previous sync cycle
+    new_cycle()
+    net.new_cycle()
+
     # Lochness to Lochness transfer on the receiving side
     if args.lochness_sync_receive:
         lochness_to_lochness_transfer_receive_sftp(Lochness)
-        return True  # break the do function here for the receiving side
-
+        return []  # break the do function here for the receiving side
+
+    # subjects are sharded across sync nodes, and the steps shared by every
+    # subject are only run by the node holding the primary shard
+    shards, leases = None, None
+    if args.shard:
+        shards = [args.shard.index]
+        if args.shard_leases:
+            leases = shard.get_leases(Lochness, args.shard)
+            shards = leases.acquire()
+    primary = shard.is_primary(args.shard, shards)
+
+    sync_args = args if due_sources is None \
+        else args_for_sources(args, due_sources)
+
+    # sources are sorted by name so the job order does not depend on the
+    # order of the set used to build args.source
+    modules = sorted(sync_args.hdd if sync_args.hdd else sync_args.source,
+                     key=executor.source_name)
+    results = pull(sync_args, Lochness, modules, shards, leases, primary) \
+        if modules else []
+    completed = completed_sources(source_names(sync_args), results)
+
+    # transfer new files after all sync attempts are done, from the node of
+    # the primary shard, which sends the files of every shard
+    if not primary:
+        return completed
+
+    # aws and rsync commands are killed once the transfer deadline passes
+    try:
+        with deadline.limit(deadline.configured(Lochness, 'transfer')):
+            transfer(args, Lochness)
+    except deadline.DeadlineExceeded as e:
+        logger.warning(f'lochness to lochness transfer stopped: {e}')
+
+    return completed
+
+
+def completed_sources(sources: list, results: list) -> list:
+    '''return the sources none of whose jobs failed or were skipped'''
+    failed = set(x.source.split('.')[0] for x in results if not x.ok)
+    return [x for x in sources if x not in failed]
+
+
+def pull(args, Lochness, modules: list, shards: list, leases,
+         primary: bool) -> list:
+    '''Sync each subject from each source module, on the executor
+
+    Returns:
+        executor.Result of each sync job, list.
+    '''
     # initialize (overwrite) metadata.csv using either REDCap or RPMS database
-    if 'redcap' in args.input_sources or 'rpms' in args.input_sources:
+    if primary and \
+            ('redcap' in args.input_sources or 'rpms' in args.input_sources):
         upenn_redcap = True if 'upenn' in args.input_sources else False
         # for ProNET and PRESCIENT, single REDCap and RPMS repo has
         # information from multiple site
@@ -223,8 +404,9 @@ def do(args, Lochness):
                                      multiple_site, upenn_redcap)
 
     n = 0
+    subjects = []
     for subject in lochness.read_phoenix_metadata(Lochness, args.studies):
-        if n == 0:
+        if n == 0 and primary:
             save_redcap_metadata(Lochness, subject)
 
         if args.subject:
@@ -237,14 +419,64 @@ def do(args, Lochness):
                         f'study={subject.study}')
             continue
 
-        if args.hdd:
-            for Module in args.hdd:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
-        else:
-            for Module in args.source:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
+        subjects.append(subject)
         n += 1
 
+    # subjects of the other shards are synced by the other nodes
+    if args.shard:
+        n_subjects = len(subjects)
+        subjects = shard.select(subjects, shards, args.shard.count)
+        logger.info(f'syncing {len(subjects)} out of {n_subjects} subjects '
+                    f'for shards {shards} of {args.shard.count}')
+
+    # subjects with recent visits, data entry or new data go first
+    if args.prioritize:
+        subjects = scheduler.prioritize(Lochness, subjects)
+
+    # REDCap is only visited for subjects with data entry trigger updates
+    # since their last pull
+    if REDCap in modules:
+        redcap_due = set((x.study, x.id)
+                         for x in REDCap.plan_sync(Lochness, subjects))
+        logger.info(f'REDCap sync for {len(redcap_due)} out of '
+                    f'{len(subjects)} subjects')
+
+    jobs = []
+    for subject in subjects:
+        for Module in modules:
+            if Module is REDCap and \
+                    (subject.study, subject.id) not in redcap_due:
+                continue
+            func = Module.sync
+            # shards taken over from another node may be taken back
+            if leases is not None:
+                subject_shard = shard.shard_of(subject.study, subject.id,
+                                               args.shard.count)
+                if subject_shard != args.shard.index:
+                    func = leases.while_held(subject_shard, func)
+            jobs.append(executor.Job(executor.source_name(Module),
+                                     func, subject))
+
+    results = executor.run(jobs, Lochness,
+                           workers=args.workers,
+                           max_per_source=args.max_per_source,
+                           dry=args.dry)
+    for line in executor.summarize(results).split('\n'):
+        logger.info(line)
+    for line in net.summarize().splitlines():
+        logger.info(line)
+
+    # move REDCap watermarks forward only if every REDCap sync succeeded,
+    # and never after a sync of selected subjects, or when a shard was taken
+    # back during the cycle
+    if REDCap in modules:
+        shards_lost = leases is not None and \
+            not set(shards) <= set(leases.held)
+        REDCap.commit_watermarks(
+                Lochness,
+                not args.subject and not shards_lost and
+                all(x.ok for x in results if x.source == 'redcap'))
+
     # anonymize PII
 
     #if Lochness['s3_selective_sync']:
@@ -256,7 +488,11 @@ def do(args, Lochness):
     #    dpanonymize.lock_lochness(
     #            Lochnesss, pii_table_loc=Lochness['pii_table'])
 
-    # transfer new files after all sync attempts are done
+    return results
+
+
+def transfer(args, Lochness):
+    '''Lochness to Lochness transfer on the sender side'''
     if args.lochness_sync_send:
         if args.s3:
             # for data under GENERAL
@@ -272,7 +508,7 @@ def do(args, Lochness):
 
             # save details of transferred files under PHOENIX/s3_log.csv
             create_s3_transfer_table(Lochness)
-                
+
         elif args.rsync:
             lochness_to_lochness_transfer_rsync(Lochness)
         else:
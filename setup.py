@@ -36,5 +36,6 @@ setup(
              'scripts/lochness_create_template.py',
              'scripts/phoenix_generator.py',
              'scripts/lochness_check_config.py',
+             'scripts/lochness_process_piis.py',
              'scripts/sync.py']
 )
@@ -0,0 +1,37 @@
+import collections as col
+from pathlib import Path
+
+import lochness.box as box
+import lochness.state as state
+
+
+BoxFile = col.namedtuple('BoxFile', ['id', 'sha1'])
+
+
+def test_removed_file_is_downloaded_again(tmp_path, monkeypatch):
+    downloads = []
+
+    def _save(box_file_object, box_fullpath, local_fullfile, key, compress):
+        downloads.append(box_fullpath)
+        Path(local_fullfile).write_text(box_file_object.sha1)
+
+    monkeypatch.setattr(box, '_save', _save)
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'removed_df_loc': str(tmp_path / 'removed_files.csv')}
+    out_base = tmp_path / 'PHOENIX' / 'PROTECTED' / 'StudyA' / 'raw'
+    box_file = BoxFile('12345', 'sha1')
+
+    def save():
+        box.save(Lochness, box_file, ('root', 'AB00001.mp4'), str(out_base),
+                 subject_id='AB00001')
+
+    save()
+    assert state.get(Lochness).is_current('box', 'AB00001', '12345', 'sha1')
+    save()
+    assert downloads == ['root/AB00001.mp4']
+
+    # the state record does not count once the file is gone
+    (out_base / 'AB00001.mp4').unlink()
+    save()
+    assert downloads == ['root/AB00001.mp4'] * 2
+    assert (out_base / 'AB00001.mp4').is_file()
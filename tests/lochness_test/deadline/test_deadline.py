@@ -0,0 +1,74 @@
+import time
+import subprocess
+import collections as col
+
+import pytest
+
+import lochness.deadline as deadline
+from lochness import executor
+
+
+def test_limit_is_thread_local_and_nested():
+    assert deadline.remaining() is None
+    with deadline.limit(100):
+        assert 99 < deadline.remaining() <= 100
+        with deadline.limit(1000):
+            # a nested block can not push the deadline back
+            assert deadline.remaining() <= 100
+        with deadline.limit(10):
+            assert deadline.remaining() <= 10
+        assert deadline.remaining() > 10
+        assert deadline.timeout(5) == 5
+    assert deadline.remaining() is None
+    assert deadline.timeout(5) == 5
+
+
+def test_expired():
+    with deadline.limit(0.01):
+        time.sleep(0.02)
+        assert deadline.expired()
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.check()
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.run('echo hello')
+
+
+def test_run_kills_command_on_timeout(tmp_path):
+    marker = tmp_path / 'marker'
+    start = time.time()
+    with deadline.limit(0.5):
+        with pytest.raises(deadline.DeadlineExceeded):
+            # the child of the shell is killed along with the shell
+            deadline.run(f'sleep 2 && touch {marker}')
+    assert time.time() - start < 2
+    time.sleep(2)
+    assert not marker.exists()
+
+
+def test_run_returns_output():
+    result = deadline.run('echo hello', stdout=subprocess.PIPE)
+    assert result.returncode == 0
+    assert result.stdout == 'hello\n'
+
+
+def test_configured():
+    Lochness = {'deadlines': {'default': 60, 'mediaflux': 600}}
+    assert deadline.configured(Lochness, 'mediaflux') == 600
+    assert deadline.configured(Lochness, 'box') == 60
+    assert deadline.configured({}, 'box') is None
+
+
+def test_executor_records_timeouts():
+    executor.breakers.reset()
+    FakeSubject = col.namedtuple('FakeSubject', ['study', 'id'])
+
+    def sync(Lochness, subject, dry=False):
+        if subject.id == 'subject_1':
+            time.sleep(0.2)
+
+    jobs = [executor.Job('box', sync, FakeSubject('StudyA', f'subject_{x}'))
+            for x in range(3)]
+    results = executor.run(jobs, {'deadlines': {'box': 0.1}}, workers=2)
+    assert [x.timed_out for x in results] == [False, True, False]
+    assert '1 timed out' in executor.summarize(results)
+    executor.breakers.reset()
@@ -0,0 +1,92 @@
+import collections as col
+
+import pytest
+
+from lochness import executor
+
+
+FakeSubject = col.namedtuple('FakeSubject', ['study', 'id', 'box'])
+
+
+@pytest.fixture(autouse=True)
+def reset_breakers():
+    executor.breakers.reset()
+    yield
+    executor.breakers.reset()
+
+
+def get_jobs(sync, aliases, n_subjects=10):
+    return [executor.Job('box', sync,
+                         FakeSubject('StudyA', f'subject_{num}',
+                                     {alias: ['1'] for alias in aliases}))
+            for num in range(n_subjects)]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_breaker_opens_after_consecutive_failures(workers):
+    calls = []
+
+    def sync(Lochness, subject, dry=False):
+        calls.append(subject.id)
+        raise ConnectionError('box is down')
+
+    Lochness = {'circuit_breaker_threshold': 3}
+    results = executor.run(get_jobs(sync, ['box.StudyA']), Lochness,
+                           workers=workers, max_per_source=1)
+    assert len(calls) == 3
+    assert sum(x.skipped for x in results) == 7
+    assert executor.breakers.state('box', 'box.StudyA') == executor.OPEN
+    assert '3 failed, 7 skipped (circuit open)' in \
+        executor.summarize(results)
+
+    # a single probe on the next run, which fails again
+    calls.clear()
+    results = executor.run(get_jobs(sync, ['box.StudyA']), Lochness,
+                           workers=workers, max_per_source=1)
+    assert len(calls) == 1
+    assert sum(x.skipped for x in results) == 9
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_breaker_closes_after_successful_probe(workers):
+    down = [True]
+
+    def sync(Lochness, subject, dry=False):
+        if down[0]:
+            raise ConnectionError('box is down')
+
+    Lochness = {'circuit_breaker_threshold': 2}
+    executor.run(get_jobs(sync, ['box.StudyA']), Lochness, workers=workers)
+    assert executor.breakers.state('box', 'box.StudyA') == executor.OPEN
+
+    down[0] = False
+    results = executor.run(get_jobs(sync, ['box.StudyA']), Lochness,
+                           workers=workers)
+    assert all(x.ok for x in results)
+    assert executor.breakers.state('box', 'box.StudyA') == executor.CLOSED
+
+
+def test_breakers_are_per_alias():
+    def sync(Lochness, subject, dry=False):
+        if list(subject.box) == ['box.StudyA']:
+            raise ConnectionError('box is down')
+
+    Lochness = {'circuit_breaker_threshold': 2}
+    jobs = get_jobs(sync, ['box.StudyA'], 4) + get_jobs(sync, ['box.StudyB'])
+    results = executor.run(jobs, Lochness)
+    assert [x.skipped for x in results[:4]] == [False, False, True, True]
+    assert all(x.ok for x in results[4:])
+
+    # subjects with an alias which is still closed are not skipped
+    results = executor.run(get_jobs(sync, ['box.StudyA', 'box.StudyB']),
+                           Lochness)
+    assert not any(x.skipped for x in results)
+
+
+def test_breaker_disabled():
+    def sync(Lochness, subject, dry=False):
+        raise ConnectionError('box is down')
+
+    results = executor.run(get_jobs(sync, ['box.StudyA']),
+                           {'circuit_breaker_threshold': 0})
+    assert not any(x.skipped for x in results)
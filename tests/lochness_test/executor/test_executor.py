@@ -0,0 +1,81 @@
+import time
+import threading
+import collections as col
+
+import lochness
+from lochness import executor
+
+
+FakeSubject = col.namedtuple('FakeSubject', ['study', 'id'])
+
+
+def get_jobs(funcs_by_source, n_subjects=4):
+    jobs = []
+    for num in range(n_subjects):
+        subject = FakeSubject('StudyA', f'subject_{num}')
+        for source, func in funcs_by_source.items():
+            jobs.append(executor.Job(source, func, subject))
+    return jobs
+
+
+def test_run_in_series():
+    calls = []
+
+    def sync(Lochness, subject, dry=False):
+        calls.append(subject.id)
+
+    results = executor.run(get_jobs({'box': sync}), {})
+    assert calls == [f'subject_{x}' for x in range(4)]
+    assert all(x.ok for x in results)
+
+
+def test_run_captures_errors():
+    def sync(Lochness, subject, dry=False):
+        if subject.id == 'subject_2':
+            raise ValueError('failed')
+
+    results = executor.run(get_jobs({'box': sync, 'xnat': sync}), {},
+                           workers=4)
+    failed = [(x.source, x.subject) for x in results if not x.ok]
+    assert failed == [('box', 'subject_2'), ('xnat', 'subject_2')]
+    assert 'failed' in lochness.attempt.warnings
+
+
+def test_run_caps_in_flight_jobs_per_source():
+    lock = threading.Lock()
+    in_flight = col.Counter()
+    max_in_flight = col.Counter()
+
+    def make_sync(source):
+        def sync(Lochness, subject, dry=False):
+            with lock:
+                in_flight[source] += 1
+                max_in_flight[source] = max(max_in_flight[source],
+                                            in_flight[source])
+            time.sleep(0.01)
+            with lock:
+                in_flight[source] -= 1
+        return sync
+
+    jobs = get_jobs({'box': make_sync('box'), 'xnat': make_sync('xnat')},
+                    n_subjects=10)
+    results = executor.run(jobs, {}, workers=6, max_per_source=2)
+    assert len(results) == 20
+    assert max_in_flight['box'] <= 2
+    assert max_in_flight['xnat'] <= 2
+
+
+def test_summarize_is_deterministic():
+    results = [
+        executor.Result('xnat', 'StudyA', 'subject_2', False, 3.0),
+        executor.Result('box', 'StudyA', 'subject_1', True, 1.0),
+        executor.Result('xnat', 'StudyA', 'subject_1', False, 2.0)]
+
+    summary = executor.summarize(results)
+    assert summary == executor.summarize(list(reversed(results)))
+    assert summary.split('\n') == [
+        'sync summary: 3 jobs, 2 failed',
+        '  box: 1 ok, 0 failed',
+        '  xnat: 0 ok, 2 failed',
+        '    failed StudyA/subject_1',
+        '    failed StudyA/subject_2']
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from lochness.functools import cycle_cache, new_cycle
+
+
+def test_cycle_cache_kept_until_new_cycle():
+    calls = []
+
+    @cycle_cache
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(2) == 4
+    assert double(2) == 4
+    assert double(x=2) == 4
+    assert double(3) == 6
+    assert calls == [2, 2, 3]
+
+    new_cycle()
+    assert double(2) == 4
+    assert calls == [2, 2, 3, 2]
+
+
+def test_cycle_cache_does_not_cache_exceptions():
+    calls = []
+
+    @cycle_cache
+    def fail_once(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        fail_once(1)
+    assert fail_once(1) == 1
+    assert fail_once(1) == 1
+    assert calls == [1, 1]
+
+
+def test_cycle_cache_single_call_for_concurrent_callers():
+    calls = []
+
+    @cycle_cache
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.05)
+        return x
+
+    threads = [threading.Thread(target=slow, args=(1,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
@@ -0,0 +1,96 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import pytest
+
+import lochness.net as net
+import lochness.icognition as iCognition
+from lochness.functools import new_cycle
+
+
+LOGIN_PATH = '/admin/application/login/login.php'
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''iCognition server with expiring logins'''
+    protocol_version = 'HTTP/1.1'
+    sessions = dict()
+    logins = 0
+
+    def send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers['content-length'])
+        user = parse_qs(self.rfile.read(length).decode())['username'][0]
+        if not self.path.startswith(LOGIN_PATH):
+            self.send(404)
+            return
+        Handler.logins += 1
+        token = f'{user}-{Handler.logins}'
+        Handler.sessions[token] = user
+        self.send(200, headers=[('Set-Cookie', f'session={token}; Path=/')])
+
+    def do_GET(self):
+        if self.path.startswith(LOGIN_PATH):
+            self.send(200, b'login page')
+            return
+        cookie = self.headers.get('cookie', '')
+        token = cookie.split('session=')[-1] if cookie else None
+        if token not in Handler.sessions:
+            self.send(302, headers=[('Location', LOGIN_PATH)])
+            return
+        self.send(200, Handler.sessions[token].encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.sessions = dict()
+    Handler.logins = 0
+    net.configure({})
+    new_cycle()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+    net.configure({})
+    new_cycle()
+
+
+def get_logged_in(server, user):
+    return net.get_logged_in(server + '/data', iCognition.login_url(server),
+                             user, {'username': user, 'password': 'pw'})
+
+
+def test_logins_of_users_on_one_host_are_kept_apart(server):
+    for user in 'user1', 'user2', 'user1':
+        r = get_logged_in(server, user)
+        assert r.content == user.encode()
+    # one login per user in a cycle
+    assert Handler.logins == 2
+
+
+def test_expired_login_is_renewed(server):
+    assert get_logged_in(server, 'user1').ok
+
+    Handler.sessions.clear()
+    r = get_logged_in(server, 'user1')
+    assert r.content == b'user1'
+    assert Handler.logins == 2
+
+
+def test_failed_login_raises(server):
+    with pytest.raises(net.LoginError):
+        net.get_logged_in(server + '/data', server + '/missing', 'user1',
+                          {'username': 'user1'})
@@ -0,0 +1,199 @@
+import collections as col
+from datetime import datetime
+from pathlib import Path
+
+import pytz
+import pytest
+
+import lochness.mindlamp as mindlamp
+import lochness.state as state
+
+
+Subject = col.namedtuple('Subject', ['study', 'id', 'mindlamp', 'consent',
+                                     'protected_folder'])
+
+
+class FakeEvents(object):
+    '''MindLAMP events API, newest first, from _from to (including) to'''
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda x: -x['timestamp'])
+        self.calls = 0
+
+    def all_by_participant(self, subject_id, _from=None, to=None,
+                           _limit=None):
+        self.calls += 1
+        events = [x for x in self.events
+                  if _from <= x['timestamp'] <= to][:_limit]
+        return {'data': events}
+
+
+class FakeLAMP(object):
+    def __init__(self, activity_events, sensor_events):
+        self.ActivityEvent = FakeEvents(activity_events)
+        self.SensorEvent = FakeEvents(sensor_events)
+
+    def connect(self, *args):
+        pass
+
+
+def get_days():
+    ct_utc_00 = datetime.now(pytz.timezone('UTC')).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+    consent = datetime(2020, 1, 1, tzinfo=pytz.timezone('UTC'))
+    return list(mindlamp.day_windows(ct_utc_00, 5, consent))
+
+
+def get_lamp(empty_days=(1,)):
+    activity, sensor = [], []
+    for num, day in enumerate(get_days()):
+        if num in empty_days:  # a day without any data
+            continue
+        for offset in 1, 1000, 3600 * 1000:
+            activity.append({'timestamp': day.from_ts + offset,
+                             'static_data': {}, 'activity': f'a{offset}'})
+            sensor.append({'timestamp': day.from_ts + offset,
+                           'sensor': 'lamp.gps', 'data': {'x': offset}})
+    return FakeLAMP(activity, sensor)
+
+
+def sync(tmp_path, monkeypatch, range_query, lamp=None):
+    Lochness = {
+        'phoenix_root': str(tmp_path / 'PHOENIX'),
+        'BIDS': True,
+        'mindlamp_days_to_pull': 5,
+        'mindlamp_range_query': range_query,
+        'keyring': {'mindlamp.StudyA': {'URL': 'https://lamp',
+                                        'ACCESS_KEY': 'access',
+                                        'SECRET_KEY': 'secret'}}}
+    subject = Subject('StudyA', 'AB00001', {'mindlamp.StudyA': ['U1234']},
+                      '2020-01-01',
+                      str(tmp_path / 'PHOENIX/PROTECTED/StudyA/AB00001'))
+    lamp = lamp or get_lamp()
+    monkeypatch.setattr(mindlamp, 'LAMP', lamp)
+    mindlamp.sync(Lochness, subject)
+    return Lochness, subject, lamp
+
+
+def saved_files(Lochness):
+    root = Path(Lochness['phoenix_root'])
+    return {x.relative_to(root): x.read_bytes()
+            for x in root.glob('**/*') if x.is_file() and x.name != '.log'}
+
+
+def state_rows(Lochness, subject):
+    return sorted((x.object_id, x.local_hash) for x in
+                  state.get(Lochness).records('mindlamp', subject.id))
+
+
+def test_range_query_saves_the_same_files(tmp_path, monkeypatch):
+    per_day = sync(tmp_path / 'per_day', monkeypatch, False)
+    by_range = sync(tmp_path / 'range', monkeypatch, True)
+
+    assert per_day[2].ActivityEvent.calls == 5
+    assert by_range[2].ActivityEvent.calls == 1
+    assert by_range[2].SensorEvent.calls == 1
+
+    files = saved_files(per_day[0])
+    assert len([x for x in files if x.name.startswith('.check_sum')]) == 8
+    assert saved_files(by_range[0]) == files
+    assert state_rows(*by_range[:2]) == state_rows(*per_day[:2])
+
+
+def test_range_query_skips_days_already_pulled(tmp_path, monkeypatch):
+    sync(tmp_path, monkeypatch, True, get_lamp(empty_days=()))
+    Lochness, subject, lamp = sync(tmp_path, monkeypatch, True,
+                                   get_lamp(empty_days=()))
+
+    # only the last two days are pulled again
+    days = get_days()
+    assert lamp.SensorEvent.calls == 1
+    assert mindlamp.get_events_range_lamp(
+            lamp, 'sensor', 'U1234', days[-2].from_ts, days[-1].to_ts) == \
+        [x for x in lamp.SensorEvent.events
+         if x['timestamp'] >= days[-2].from_ts]
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 4, 100])
+def test_range_query_pages(page_size):
+    lamp = get_lamp()
+    days = get_days()
+    events = mindlamp.get_events_range_lamp(
+            lamp, 'activity', 'U1234', days[0].from_ts, days[-1].to_ts,
+            page_size=page_size)
+    assert events == lamp.ActivityEvent.events
+
+
+@pytest.mark.parametrize('range_query', [False, True])
+def test_removed_file_is_pulled_again(tmp_path, monkeypatch, range_query):
+    Lochness, subject, _ = sync(tmp_path, monkeypatch, range_query)
+    files = saved_files(Lochness)
+    old_file = sorted(x for x in files if x.suffix == '.json' and
+                      not x.name.startswith('.'))[0]
+    (Path(Lochness['phoenix_root']) / old_file).unlink()
+
+    sync(tmp_path, monkeypatch, range_query)
+    assert saved_files(Lochness) == files
+
+
+@pytest.mark.parametrize('range_query', [False, True])
+def test_late_data_of_empty_days_is_pulled(tmp_path, monkeypatch,
+                                           range_query):
+    sync(tmp_path, monkeypatch, range_query)
+
+    # the empty day is checked again along with the last two days
+    Lochness, _, lamp = sync(tmp_path, monkeypatch, range_query)
+    assert lamp.ActivityEvent.calls == (2 if range_query else 3)
+
+    # data of the empty day uploaded late is saved
+    sync(tmp_path, monkeypatch, range_query, get_lamp(empty_days=()))
+    day = get_days()[1]
+    assert (Path(Lochness['phoenix_root']) / 'PROTECTED/StudyA/raw/AB00001/'
+            f'phone/U1234_StudyA_activity_{day.date_str}.json').is_file()
+    assert saved_files(Lochness) == \
+        saved_files(sync(tmp_path / 'full', monkeypatch, range_query,
+                         get_lamp(empty_days=()))[0])
+
+
+def test_range_query_per_run_of_missing_days(tmp_path, monkeypatch):
+    Lochness, subject, _ = sync(tmp_path, monkeypatch, True)
+    files = saved_files(Lochness)
+    days = get_days()
+    (Path(Lochness['phoenix_root']) / next(
+        x for x in files if x.name ==
+        f'U1234_StudyA_sensor_{days[0].date_str}.json')).unlink()
+
+    # days[0] and the empty days[1], and the last two days, without days[2]
+    _, _, lamp = sync(tmp_path, monkeypatch, True)
+    assert lamp.SensorEvent.calls == 2
+    assert saved_files(Lochness) == files
+
+
+def test_day_runs():
+    days = [(x, None, '') for x in get_days()]
+    runs = list(mindlamp.day_runs(days[:2] + days[3:]))
+    assert runs == [days[:2], days[3:]]
+    assert list(mindlamp.day_runs([])) == []
+
+
+def test_range_query_pages_past_events_at_one_timestamp():
+    # five events at a single time stamp, across the pages of two events
+    events = [{'timestamp': 5000, 'activity': f'a{num}', 'static_data': {}}
+              for num in range(5)] + \
+        [{'timestamp': ts, 'activity': 'b', 'static_data': {}}
+         for ts in (1000, 2000, 9000, 9500)]
+    lamp = FakeLAMP(events, [])
+    assert mindlamp.get_events_range_lamp(
+            lamp, 'activity', 'U1234', 0, 10000, page_size=2) == \
+        lamp.ActivityEvent.events
+
+
+def test_partition_events():
+    days = get_days()[1:4]
+    midnight = days[1].from_ts
+    events = [{'timestamp': days[2].to_ts}, {'timestamp': days[2].from_ts + 1},
+              {'timestamp': midnight}, {'timestamp': midnight - 1},
+              {'timestamp': days[0].from_ts - 1}]
+    buckets = mindlamp.partition_events(events, days)
+    assert buckets == [[events[2], events[3]],
+                       [events[2]],
+                       [events[0], events[1]]]
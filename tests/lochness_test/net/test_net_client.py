@@ -0,0 +1,86 @@
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import lochness.net as net
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def do_GET(self):
+        Handler.connections.add(self.client_address)
+        body = b'x' * 100
+        self.send_response(200 if self.path == '/ok' else 404)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.connections = set()
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_session_is_reused_per_host(server):
+    client = net.Client(pool_size=2)
+    assert client.session(server + '/ok') is client.session(server + '/a')
+    assert client.session(server) is not \
+        client.session('https://example.com/api/')
+
+    for _ in range(3):
+        assert client.get(server + '/ok').status_code == 200
+    # keep-alive: a single connection for the three requests
+    assert len(Handler.connections) == 1
+    client.close()
+
+
+def test_metrics(server):
+    client = net.Client()
+    client.get(server + '/ok')
+    client.get(server + '/missing')
+    client.get(server + '/ok', stream=True).close()
+
+    metrics = client.metrics()[server]
+    assert metrics.requests == 3
+    assert metrics.errors == 1
+    assert metrics.bytes == 300
+    assert metrics.max_latency >= metrics.mean_latency > 0
+
+    client.reset_metrics()
+    assert client.metrics() == {}
+    client.close()
+
+
+def test_configure():
+    net.configure({'http': {'pool_size': 4, 'read_timeout': 60}})
+    assert net.client().pool_size == 4
+    assert net.client().timeout == (net.DEFAULT_CONNECT_TIMEOUT, 60)
+
+    with pytest.raises(net.NetConfigError):
+        net.configure({'http': {'pool': 4}})
+
+    net.configure({})
+    assert net.client().pool_size == net.DEFAULT_POOL_SIZE
+
+
+def test_session_per_key(server):
+    client = net.Client()
+    assert client.session(server, 'user1') is client.session(server + '/ok',
+                                                             'user1')
+    assert client.session(server, 'user1') is not \
+        client.session(server, 'user2')
+    assert client.session(server) is not client.session(server, 'user1')
+    assert client.get(server + '/ok', session_key='user1').status_code == 200
+    client.close()
@@ -0,0 +1,120 @@
+import requests
+import pytest
+
+import lochness.net as net
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def http_error(status_code, headers=None):
+    return net.RetryableHTTPError(
+            f'responded {status_code}',
+            response=Response(status_code, headers))
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    net.configure({})
+    net.new_cycle()
+    yield
+    net.configure({})
+    net.new_cycle()
+
+
+def test_returns_value_after_retries():
+    sleeps = []
+    errors = [requests.exceptions.ConnectionError('refused'),
+              requests.exceptions.ReadTimeout('timeout'),
+              http_error(503)]
+
+    @net.retry(max_attempts=5, source='redcap', sleep=sleeps.append)
+    def f():
+        if errors:
+            raise errors.pop(0)
+        return 'data'
+
+    assert f() == 'data'
+    assert len(sleeps) == 3
+    assert all(1 <= x <= 60 for x in sleeps)
+
+    stats = net.retry_stats()['redcap']
+    assert stats.retries == 3
+    assert stats.backoff == pytest.approx(sum(sleeps))
+    assert stats.failures == 0
+
+
+def test_other_errors_are_not_retried():
+    sleeps = []
+
+    @net.retry(max_attempts=5, sleep=sleeps.append)
+    def f():
+        raise http_error(404)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        f()
+
+    @net.retry(max_attempts=5, sleep=sleeps.append)
+    def g():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        g()
+    assert sleeps == []
+
+
+def test_maximum_retries():
+    calls = []
+
+    @net.retry(max_attempts=3, source='xnat', sleep=lambda x: None)
+    def f():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError()
+
+    with pytest.raises(net.RetryError):
+        f()
+    assert len(calls) == 3
+    assert net.retry_stats()['xnat'].failures == 1
+
+
+def test_retry_after():
+    sleeps = []
+    errors = [http_error(429, {'retry-after': '120'})]
+
+    @net.retry(max_attempts=2, cap=5, sleep=sleeps.append)
+    def f():
+        if errors:
+            raise errors.pop(0)
+
+    f()
+    assert sleeps == [120]
+
+    assert net.retry_after(http_error(503, {'retry-after':
+        'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+    assert net.retry_after(http_error(503)) is None
+
+
+def test_retry_budget():
+    net.configure({'retry_budget': {'default': 1000, 'box': 100}})
+    sleeps = []
+
+    @net.retry(max_attempts=10, source='box', sleep=sleeps.append)
+    def f():
+        raise http_error(429, {'retry-after': '40'})
+
+    with pytest.raises(net.RetryError, match='budget'):
+        f()
+    assert sleeps == [40, 40]
+    assert net.retry_stats()['box'].backoff == 80
+
+    # the budget is back in the next cycle
+    net.new_cycle()
+    assert net.retry_stats() == {}
+
+
+def test_source_of_function():
+    import lochness.redcap as REDCap
+    assert net._source_of(REDCap.sync) == 'redcap'
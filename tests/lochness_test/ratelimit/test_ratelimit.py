@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from lochness import ratelimit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_burst_then_wait():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(2, burst=3, clock=clock, sleep=clock.sleep)
+
+    for _ in range(3):
+        assert bucket.acquire() == 0
+
+    # fourth token has to wait for half a second at 2 tokens per second
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert clock.now == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_up_to_burst():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(1, burst=2, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 100
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(1)
+
+
+def test_token_bucket_rejects_bad_rate():
+    with pytest.raises(ratelimit.RateLimitConfigError):
+        ratelimit.TokenBucket(0)
+
+
+def test_limiter_caps_in_flight():
+    limiter = ratelimit.Limiter('box.StudyA', max_in_flight=2)
+    lock = threading.Lock()
+    counts = {'now': 0, 'max': 0}
+
+    def call():
+        with limiter:
+            with lock:
+                counts['now'] += 1
+                counts['max'] = max(counts['max'], counts['now'])
+            time.sleep(0.01)
+            with lock:
+                counts['now'] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counts['max'] == 2
+
+
+def test_configure_and_get():
+    ratelimit.configure({'rate_limits': {
+        'redcap.Pronet': {'rate': 5, 'burst': 10, 'max_in_flight': 4},
+        'box': {'rate': 10}}})
+
+    redcap = ratelimit.get('redcap.Pronet')
+    assert redcap.bucket.rate == 5
+    assert redcap.max_in_flight == 4
+
+    # aliases without their own entry share the source level limiter
+    assert ratelimit.get('box.PronetLA') is ratelimit.get('box.PronetYA')
+    assert ratelimit.get('box.PronetLA').bucket.rate == 10
+
+    # unconfigured aliases are not limited
+    assert ratelimit.get('mindlamp.PronetLA').bucket is None
+    assert ratelimit.get(None).bucket is None
+
+    ratelimit.configure({})
+    assert ratelimit.get('redcap.Pronet').bucket is None
+
+
+def test_configure_rejects_unknown_fields():
+    with pytest.raises(ratelimit.RateLimitConfigError):
+        ratelimit.configure({'rate_limits': {'box': {'rpm': 10}}})
+
+
+def test_waited_is_counted_across_threads():
+    class Bucket(object):
+        def acquire(self):
+            return 0.5
+
+    limiter = ratelimit.Limiter('box.StudyA', rate=1)
+    limiter.bucket = Bucket()
+
+    def enter():
+        for _ in range(1000):
+            with limiter:
+                pass
+
+    threads = [threading.Thread(target=enter) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert limiter.waited == 4000
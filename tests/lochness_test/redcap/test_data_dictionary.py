@@ -0,0 +1,54 @@
+import pytest
+
+import lochness.redcap as REDCap
+from lochness.functools import new_cycle
+
+DATA_DICTIONARY = b'''"Variable / Field Name","Form Name","Section Header","Field Type","Field Label","Identifier?"
+chric_record_id,informed_consent,,text,"Record ID",
+chric_name,informed_consent,,text,"Name",y
+chric_consent_date,informed_consent,,text,"Consent date",
+chric_phone,contact,,text,"Phone",Y
+chric_age,demographics,,text,"Age",
+'''
+
+
+@pytest.fixture
+def fake_post(monkeypatch):
+    queries = []
+
+    def post_to_redcap(api_url, data, debug_tup, alias=None):
+        queries.append(data)
+        return DATA_DICTIONARY
+
+    new_cycle()
+    monkeypatch.setattr(REDCap, 'post_to_redcap', post_to_redcap)
+    return queries
+
+
+def test_data_dictionary_downloaded_once_per_cycle(fake_post):
+    for _ in range(3):
+        dictionary = REDCap.get_data_dictionary('url', 'key',
+                                                alias='redcap.Pronet')
+    assert len(fake_post) == 1
+    assert dictionary.content == DATA_DICTIONARY
+    assert dictionary.identifier_fields == {'chric_name', 'chric_phone'}
+    assert list(dictionary.field_forms) == [
+            'chric_record_id', 'chric_name', 'chric_consent_date',
+            'chric_phone', 'chric_age']
+    assert dictionary.field_forms['chric_age'] == 'demographics'
+
+    # another project has its own data dictionary
+    REDCap.get_data_dictionary('url', 'other_key', alias='redcap.Pronet')
+    assert len(fake_post) == 2
+
+    new_cycle()
+    REDCap.get_data_dictionary('url', 'key', alias='redcap.Pronet')
+    assert len(fake_post) == 3
+
+
+def test_data_dictionary_missing_columns(monkeypatch):
+    new_cycle()
+    monkeypatch.setattr(REDCap, 'post_to_redcap',
+                        lambda *args, **kwargs: b'field_name,form_name\na,b\n')
+    with pytest.raises(REDCap.REDCapError):
+        REDCap.get_data_dictionary('url', 'key')
@@ -0,0 +1,105 @@
+import os
+import time
+from pathlib import Path
+
+import pandas as pd
+
+import lochness.redcap as REDCap
+from lochness import tree
+from lochness.functools import new_cycle
+
+
+class FakeSubject(object):
+    def __init__(self, phoenix_root, study, subject_id, redcap):
+        self.study = study
+        self.id = subject_id
+        self.protected_folder = str(
+                Path(phoenix_root) / 'PROTECTED' / study / subject_id)
+        self.redcap = redcap
+
+
+def write_det_db(db_loc, rows):
+    pd.DataFrame(rows, columns=['timestamp', 'project_url', 'project_id',
+                                'redcap_username', 'record', 'instrument']
+                 ).to_csv(db_loc)
+
+
+def det_Lochness(tmp_path):
+    db_loc = tmp_path / 'det.csv'
+    return {
+        'phoenix_root': str(tmp_path / 'PHOENIX'),
+        'BIDS': True,
+        'redcap': {'StudyA': {'data_entry_trigger_csv': str(db_loc)}},
+        'keyring': {
+            'lochness': {'REDCAP': {'StudyA': {'redcap.Pronet': ['Pronet']}}},
+            'redcap.Pronet': {'URL': 'https://redcap',
+                              'API_TOKEN': {'Pronet': 'key'}}}}
+
+
+def test_data_entry_trigger_index(tmp_path):
+    new_cycle()
+    Lochness = det_Lochness(tmp_path)
+    db_loc = Lochness['redcap']['StudyA']['data_entry_trigger_csv']
+    assert REDCap.get_data_entry_trigger_index(Lochness, 'StudyA') == {}
+
+    write_det_db(db_loc, [[10.0, 'url', 1, 'user', 'AB00001', 'form_a'],
+                          [30.0, 'url', 1, 'user', 'AB00001', 'form_b'],
+                          [20.0, 'url', 1, 'user', 'AB00002', 'form_a']])
+    index = REDCap.get_data_entry_trigger_index(Lochness, 'StudyA')
+    assert index == {'AB00001': 30.0, 'AB00002': 20.0}
+
+    # re-read when the database changes within the cycle
+    write_det_db(db_loc, [[10.0, 'url', 1, 'user', 'AB00001', 'form_a'],
+                          [40.0, 'url', 1, 'user', 'AB00003', 'form_a']])
+    index = REDCap.get_data_entry_trigger_index(Lochness, 'StudyA')
+    assert index == {'AB00001': 10.0, 'AB00003': 40.0}
+
+
+def test_check_if_modified_with_index(tmp_path):
+    existing_json = tmp_path / 'AB00001.Pronet.json'
+    existing_json.write_text('[]')
+    os.utime(existing_json, (100, 100))
+
+    assert REDCap.check_if_modified('AB00001', existing_json,
+                                    {'AB00001': 200.0})
+    assert not REDCap.check_if_modified('AB00001', existing_json,
+                                        {'AB00001': 50.0})
+    assert not REDCap.check_if_modified('AB00002', existing_json,
+                                        {'AB00001': 200.0})
+    # pulled after the last DET update, without a change in the json
+    assert not REDCap.check_if_modified('AB00001', existing_json,
+                                        {'AB00001': 200.0},
+                                        last_pull_time=300.0)
+
+    df = pd.DataFrame({'record': ['AB00001', 'AB00001'],
+                       'timestamp': [50.0, 200.0]})
+    assert REDCap.check_if_modified('AB00001', existing_json, df)
+
+
+def test_plan_sync(tmp_path):
+    new_cycle()
+    Lochness = det_Lochness(tmp_path)
+    db_loc = Lochness['redcap']['StudyA']['data_entry_trigger_csv']
+
+    subjects = [FakeSubject(Lochness['phoenix_root'], 'StudyA', x,
+                            {'redcap.Pronet': [x]})
+                for x in ['AB00001', 'AB00002', 'AB00003']]
+
+    # AB00001 and AB00002 have been pulled before, AB00003 never
+    for subject in subjects[:2]:
+        dst_folder = tree.get('surveys', subject.protected_folder,
+                              processed=False, BIDS=True, makedirs=True)
+        dst = Path(dst_folder) / f'{subject.id}.Pronet.json'
+        dst.write_text('[]')
+        os.utime(dst, (100, 100))
+
+    write_det_db(db_loc, [[200.0, 'url', 1, 'user', 'AB00001', 'form_a'],
+                          [50.0, 'url', 1, 'user', 'AB00002', 'form_a']])
+
+    due = REDCap.plan_sync(Lochness, subjects)
+    assert [x.id for x in due] == ['AB00001', 'AB00003']
+
+    # UPENN REDCap has no data entry trigger
+    subjects[1].redcap['redcap.UPENN'] = ['AB00002']
+    due = REDCap.plan_sync(Lochness, subjects)
+    assert [x.id for x in due] == ['AB00001', 'AB00002', 'AB00003']
@@ -0,0 +1,176 @@
+import threading
+
+import pandas as pd
+
+import lochness.redcap as REDCap
+from lochness.redcap import det_log
+from lochness.functools import new_cycle
+
+
+def entry(timestamp, record, instrument='form_a'):
+    return {'timestamp': timestamp, 'project_url': 'url', 'project_id': 1,
+            'redcap_username': 'user', 'record': record,
+            'instrument': instrument}
+
+
+def test_append_and_index(tmp_path):
+    new_cycle()
+    db_loc = tmp_path / 'det.csv'
+    Lochness = {'redcap': {'StudyA': {'data_entry_trigger_csv': str(db_loc)}}}
+
+    log = det_log.DetLog(det_log.log_path(db_loc), db_loc)
+    log.append([entry(10.0, 'AB00001'), entry(30.0, 'AB00001', 'form_b')])
+    log.append([entry(20.0, 'AB00002')])
+
+    assert REDCap.data_entry_trigger_path(Lochness, 'StudyA') == \
+        tmp_path / 'det.jsonl'
+    assert REDCap.get_data_entry_trigger_index(Lochness, 'StudyA') == \
+        {'AB00001': 30.0, 'AB00002': 20.0}
+    db_df = REDCap.get_data_entry_trigger_df(Lochness, 'StudyA')
+    assert db_df['record'].tolist() == ['AB00001', 'AB00001', 'AB00002']
+
+    # a line cut by a crash is skipped
+    with open(tmp_path / 'det.jsonl', 'a') as fp:
+        fp.write('{"timestamp": 40.0, "rec')
+    assert len(list(det_log.read_entries(tmp_path / 'det.jsonl'))) == 3
+
+
+def test_csv_is_imported_and_exported(tmp_path):
+    db_loc = tmp_path / 'det.csv'
+    pd.DataFrame([[10.0, 'url', 1, 'user', 'AB00001', 'form_a']],
+                 columns=det_log.COLUMNS).to_csv(db_loc)
+
+    log = det_log.DetLog(det_log.log_path(db_loc), db_loc)
+    log.append([entry(20.0, 'AB00002')])
+    assert [x['record'] for x in det_log.read_entries(log.path)] == \
+        ['AB00001', 'AB00002']
+
+    det_log.export_csv(db_loc)
+    db_df = pd.read_csv(db_loc, index_col=0)
+    assert db_df.columns.tolist() == det_log.COLUMNS
+    assert db_df['record'].tolist() == ['AB00001', 'AB00002']
+    assert db_df['timestamp'].tolist() == [10.0, 20.0]
+
+
+def test_concurrent_appends_are_group_committed(tmp_path, monkeypatch):
+    log = det_log.DetLog(tmp_path / 'det.jsonl')
+    writes = []
+    write = log._write
+
+    def slow_write(lines):
+        writes.append(len(lines))
+        threading.Event().wait(0.01)
+        write(lines)
+
+    monkeypatch.setattr(log, '_write', slow_write)
+    threads = [threading.Thread(target=log.append,
+                                args=([entry(float(x), f'AB{x:05d}')],))
+               for x in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = [x['record'] for x in det_log.read_entries(log.path)]
+    assert sorted(records) == [f'AB{x:05d}' for x in range(50)]
+    assert sum(writes) == 50
+    assert len(writes) < 50
+
+
+def test_every_failed_append_raises(tmp_path, monkeypatch):
+    log = det_log.DetLog(tmp_path / 'det.jsonl')
+    write = log._write
+    fail = threading.Event()
+    fail.set()
+
+    def failing_write(lines):
+        threading.Event().wait(0.01)
+        if fail.is_set():
+            raise OSError('disk full')
+        write(lines)
+
+    monkeypatch.setattr(log, '_write', failing_write)
+    errors = []
+
+    def append(x):
+        try:
+            log.append([entry(float(x), f'AB{x:05d}')])
+        except det_log.DetLogError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=append, args=(x,)) for x in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every batch failed, and each of its waiters raised
+    assert len(errors) == 50
+    assert log._errors == {} and not log._waiters
+
+    fail.clear()
+    log.append([entry(60.0, 'AB00060')])
+    assert [x['record'] for x in det_log.read_entries(log.path)] == \
+        ['AB00060']
+
+
+def test_compaction(tmp_path):
+    new_cycle()
+    db_loc = tmp_path / 'det.csv'
+    Lochness = {'redcap': {'StudyA': {'data_entry_trigger_csv': str(db_loc)}}}
+    log = det_log.DetLog(det_log.log_path(db_loc))
+    log.append([entry(10.0, 'AB00001'), entry(30.0, 'AB00001'),
+                entry(20.0, 'AB00001', 'form_b'), entry(5.0, 'AB00002')])
+    assert log.first_timestamp() == 10.0
+
+    segment = log.compact(now=86400)
+    assert segment == tmp_path / 'det_history' / \
+        'det.19700102T000000Z.jsonl.gz'
+    assert log.first_timestamp() is None
+    assert log.compact() is None
+    latest = det_log.read_latest(det_log.latest_path(db_loc))
+    assert sorted(x['timestamp'] for x in latest.values()) == \
+        [5.0, 20.0, 30.0]
+
+    log.append([entry(40.0, 'AB00002')])
+    assert REDCap.get_data_entry_trigger_index(Lochness, 'StudyA') == \
+        {'AB00001': 30.0, 'AB00002': 40.0}
+
+    # the history is kept in the segments
+    assert log.compact(now=86400) == tmp_path / 'det_history' / \
+        'det.19700102T000000Z_1.jsonl.gz'
+    assert [x['timestamp'] for x in det_log.read_history(db_loc)] == \
+        [10.0, 30.0, 20.0, 5.0, 40.0]
+    det_log.export_csv(db_loc)
+    assert len(pd.read_csv(db_loc, index_col=0)) == 5
+
+
+def test_incremental_backup(tmp_path):
+    log = det_log.DetLog(tmp_path / 'det.jsonl')
+    backup_dir = tmp_path / '.back_det'
+    log.append([entry(10.0, 'AB00001')])
+    assert log.back_up() == [backup_dir / 'det.jsonl']
+    assert log.back_up() == []
+
+    # the copy of the log is appended to
+    log.append([entry(20.0, 'AB00002')])
+    inode = (backup_dir / 'det.jsonl').stat().st_ino
+    assert log.back_up() == [backup_dir / 'det.jsonl']
+    assert (backup_dir / 'det.jsonl').stat().st_ino == inode
+    assert (backup_dir / 'det.jsonl').read_bytes() == log.path.read_bytes()
+
+    # only new segments are copied
+    first = log.compact(now=0)
+    assert log.back_up() == [backup_dir / 'det_history' / first.name,
+                             backup_dir / 'det.latest.jsonl',
+                             backup_dir / 'det.jsonl']
+    log.append([entry(30.0, 'AB00003')])
+    second = log.compact(now=1)
+    assert log.back_up() == [backup_dir / 'det_history' / second.name,
+                             backup_dir / 'det.latest.jsonl']
+
+    # a damaged backup is replaced
+    (backup_dir / 'det.latest.jsonl').write_text('damaged\n' * 100)
+    assert log.back_up() == [backup_dir / 'det.latest.jsonl']
+    assert (backup_dir / 'det.latest.jsonl').read_bytes() == \
+        det_log.latest_path(log.path).read_bytes()
@@ -0,0 +1,66 @@
+import time
+import threading
+import collections as col
+
+import pytest
+
+from lochness.redcap import det_notify
+from lochness.redcap.data_trigger_capture import save_post_from_redcap
+
+
+Subject = col.namedtuple('Subject', ['id', 'redcap'])
+
+
+def test_notify_without_listener(tmp_path):
+    assert not det_notify.notify(tmp_path / 'det.sock', 'AB00001')
+
+
+def test_listener_receives_records(tmp_path):
+    socket_path = tmp_path / 'det.sock'
+    with det_notify.Listener(socket_path, batch_seconds=0.5) as listener:
+        assert listener.wait(0.1) == set()
+
+        assert det_notify.notify(socket_path, 'AB00001', '123', 'consent')
+        assert listener.wait(1) == {'AB00001'}
+
+        # notifications arriving together are returned together
+        def send():
+            for record in 'AB00002', 'AB00003':
+                time.sleep(0.1)
+                det_notify.notify(socket_path, record)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        assert listener.wait(1) == {'AB00002', 'AB00003'}
+        thread.join()
+
+        with pytest.raises(det_notify.DetSocketError):
+            det_notify.Listener(socket_path)
+
+    assert not socket_path.exists()
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    socket_path = tmp_path / 'det.sock'
+    listener = det_notify.Listener(socket_path)
+    listener.sock.close()
+
+    with det_notify.Listener(socket_path) as listener:
+        assert det_notify.notify(socket_path, 'AB00001')
+        assert listener.wait(1) == {'AB00001'}
+
+
+def test_select_subjects():
+    subjects = [Subject('AB00001', {'redcap.Pronet': ['AB00001']}),
+                Subject('AB00002', {'redcap.Pronet': ['ab2', 'AB00002']}),
+                Subject('AB00003', {})]
+    assert det_notify.select_subjects(subjects, {'ab2', 'AB00003'}) == \
+        ['AB00002']
+
+
+def test_save_post_returns_record(tmp_path):
+    body = 'redcap_url=https%3A%2F%2Fredcap.server%2F&' \
+           'project_url=https%3A%2F%2Fredcap.server%2Fredcap%2F&' \
+           'project_id=123&username=admin&record=AB00001&' \
+           'instrument=inclusionexclusion_criteria_review'
+    assert save_post_from_redcap(body, tmp_path / 'db.csv') == 'AB00001'
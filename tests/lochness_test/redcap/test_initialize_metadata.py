@@ -0,0 +1,69 @@
+import json
+
+import pandas as pd
+
+import lochness.redcap as REDCap
+from lochness.functools import new_cycle
+
+RECORDS = [
+    {'chric_record_id': 'LA00002', 'redcap_event_name': 'screening_arm_1',
+     'chric_consent_date': '2021-01-02', 'chrdbb_lamp_id': ''},
+    {'chric_record_id': 'LA00002', 'redcap_event_name': 'baseline_arm_1',
+     'chric_consent_date': '', 'chrdbb_lamp_id': 'U1234'},
+    {'chric_record_id': 'LA00001', 'redcap_event_name': 'screening_arm_1',
+     'chric_consent_date': '2021-01-01', 'chrdbb_lamp_id': ''},
+    {'chric_record_id': 'LA00003', 'redcap_event_name': 'screening_arm_1',
+     'chric_consent_date': '', 'chrdbb_lamp_id': ''},
+    {'chric_record_id': 'YA00001', 'redcap_event_name': 'screening_arm_1',
+     'chric_consent_date': '2021-03-01', 'chrdbb_lamp_id': ''},
+    {'chric_record_id': 'test_record', 'redcap_event_name': 'screening_arm_1',
+     'chric_consent_date': '2021-03-01', 'chrdbb_lamp_id': ''},
+]
+
+
+def test_initialize_metadata_single_query(tmp_path, monkeypatch):
+    new_cycle()
+    queries = []
+
+    def iter_records_from_redcap(api_url, data, debug_tup, alias=None):
+        queries.append(data)
+        return iter(json.loads(json.dumps(RECORDS)))
+
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap',
+                        iter_records_from_redcap)
+
+    studies = ['PronetLA', 'PronetYA', 'PronetBA']
+    Lochness = {
+        'phoenix_root': str(tmp_path),
+        'keyring': {
+            'lochness': {'REDCAP': {x: {'redcap.Pronet': ['Pronet']}
+                                    for x in studies}},
+            'redcap.Pronet': {'URL': 'https://redcap',
+                              'API_TOKEN': {'Pronet': 'key'}}}}
+    for study in studies:
+        (tmp_path / 'GENERAL' / study).mkdir(parents=True)
+        REDCap.initialize_metadata(Lochness, study, 'chric_record_id',
+                                   'chric_consent_date')
+
+    assert len(queries) == 1
+    assert 'filterLogic' not in queries[0]
+
+    df = pd.read_csv(tmp_path / 'GENERAL' / 'PronetLA' /
+                     'PronetLA_metadata.csv')
+    assert list(df.columns) == ['Active', 'Consent', 'Subject ID', 'Study',
+                                'REDCap', 'Box', 'XNAT', 'Mindlamp']
+    assert df['Subject ID'].tolist() == ['LA00001', 'LA00002']
+    assert df['Consent'].tolist() == ['2021-01-01', '2021-01-02']
+    assert df['REDCap'].tolist()[0] == \
+        'redcap.Pronet:LA00001;redcap.UPENN:LA00001'
+    assert df['XNAT'].tolist()[1] == 'xnat.PronetLA:*:LA00002'
+    assert df['Mindlamp'].isnull().tolist() == [True, False]
+    assert df['Mindlamp'].tolist()[1] == 'mindlamp.PronetLA:U1234'
+
+    df = pd.read_csv(tmp_path / 'GENERAL' / 'PronetYA' /
+                     'PronetYA_metadata.csv')
+    assert df['Subject ID'].tolist() == ['YA00001']
+    assert 'Mindlamp' not in df.columns
+
+    assert not (tmp_path / 'GENERAL' / 'PronetBA' /
+                'PronetBA_metadata.csv').exists()
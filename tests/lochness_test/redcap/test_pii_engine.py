@@ -0,0 +1,206 @@
+import io
+import re
+import json
+import string
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from lochness.redcap.process_piis import PiiEngine
+from lochness.redcap.process_piis import get_pii_engine
+from lochness.redcap.process_piis import process_pii_string
+from lochness.redcap.process_piis import get_shuffle_dict_for_type
+from lochness.redcap.process_piis import load_raw_return_proc_csv
+from lochness.redcap.process_piis import load_raw_return_proc_json
+from lochness.redcap.process_piis import process_study_surveys
+
+
+PII_DICT = {'address': 'remove',
+            'name': 'replace_with_subject_id',
+            'phone': 'random_number',
+            'patient_name': 'remove'}
+
+
+def test_first_pii_label_string_in_table_order_wins():
+    engine = PiiEngine(PII_DICT)
+    # 'patient_name' also matches 'name', which comes first in the table
+    assert engine.process_for('patient_name') == 'replace_with_subject_id'
+    # order in the field name does not matter
+    assert engine.process_for('name_address') == 'remove'
+    assert engine.process_for('home_phone') == 'random_number'
+    assert engine.process_for('chrdemo_age') is None
+
+    # decisions are memoized
+    assert engine._decisions['home_phone'] == 'random_number'
+
+
+def test_regex_pii_label_strings():
+    engine = PiiEngine({'^chr.*_date$': 'remove', r'(\w)\1': 'remove'})
+    assert engine._regex is False  # numbered backreference
+    assert engine.process_for('chrdemo_date') == 'remove'
+    assert engine.process_for('aa') == 'remove'
+    assert engine.process_for('chrdemo_dates') is None
+
+    engine = PiiEngine({'^chr.*_date$': 'remove'})
+    assert engine._regex
+    assert engine.process_for('chrdemo_date') == 'remove'
+    assert engine.process_for('xchrdemo_date') is None
+
+
+def test_inline_flags_in_pii_label_strings(tmp_path):
+    pii_dict = {'address': 'remove', '(?i)name': 'replace_with_subject_id'}
+    engine = PiiEngine(pii_dict)
+    assert engine._regex is False  # global flags only start an expression
+    assert engine.process_for('Patient_NAME') == 'replace_with_subject_id'
+    assert engine.process_for('ADDRESS') is None
+
+    # flags scoped to a group do not need the fallback
+    engine = PiiEngine({'address': 'remove', '(?i:name)': 'remove'})
+    assert engine._regex
+    assert engine.process_for('NAME') == 'remove'
+    assert engine.process_for('ADDRESS') is None
+
+    records = [{'NAME': 'john', 'age': '30'}]
+    json_loc = tmp_path / 'raw.json'
+    json_loc.write_text(json.dumps(records))
+    processed = json.loads(
+            load_raw_return_proc_json(json_loc, pii_dict, 'AB00001'))
+    assert processed == [{'NAME': 'AB00001', 'age': '30'}]
+
+
+def test_process_record_keeps_other_fields():
+    engine = PiiEngine(PII_DICT)
+    record = {'address': '1 main st', 'age': '30', 'name': 'john'}
+    assert engine.process_record(record, 'AB00001') == {
+            'address': '', 'age': '30', 'name': 'AB00001'}
+    assert record['name'] == 'john'
+
+
+def test_shuffle_keeps_string_type():
+    shuffled = get_shuffle_dict_for_type(string.digits, '393jfi')
+    assert len(shuffled) == 6
+    assert shuffled[:3].isdigit()
+    assert shuffled[3:] == 'jfi'
+
+
+def test_load_raw_return_proc_json_and_csv(tmp_path):
+    records = [{'address': 'a', 'age': '1'}, {'address': 'b', 'age': '2'}]
+    json_loc = tmp_path / 'raw.json'
+    json_loc.write_text(json.dumps(records))
+    processed = json.loads(
+            load_raw_return_proc_json(json_loc, PII_DICT, 'AB00001'))
+    assert processed == [{'address': '', 'age': '1'},
+                         {'address': '', 'age': '2'}]
+
+    csv_loc = tmp_path / 'raw.csv'
+    pd.DataFrame(records).to_csv(csv_loc, index=False)
+    df = load_raw_return_proc_csv(csv_loc, PII_DICT, 'AB00001')
+    # every row is processed
+    assert df['address'].tolist() == ['', '']
+    assert df['age'].tolist() == [1, 2]
+
+
+def test_process_study_surveys(tmp_path):
+    pii_table = tmp_path / 'pii_table.csv'
+    pd.DataFrame({'pii_label_string': list(PII_DICT),
+                  'process': list(PII_DICT.values())}).to_csv(
+                          pii_table, index=False)
+
+    phoenix_root = tmp_path / 'PHOENIX'
+    metadata = phoenix_root / 'GENERAL' / 'StudyA' / 'StudyA_metadata.csv'
+    metadata.parent.mkdir(parents=True)
+    pd.DataFrame({'Active': [1, 1],
+                  'Consent': ['2021-01-01', '2021-01-01'],
+                  'Subject ID': ['AB00001', 'AB00002'],
+                  'REDCap': ['redcap.StudyA:AB00001',
+                             'redcap.StudyA:AB00002']}).to_csv(
+                                     metadata, index=False)
+
+    for subject_id in 'AB00001', 'AB00002':
+        raw = phoenix_root / 'PROTECTED' / 'StudyA' / 'raw' / subject_id / \
+                'surveys'
+        raw.mkdir(parents=True)
+        (raw / f'{subject_id}.StudyA.json').write_text(
+                json.dumps([{'name': 'john', 'age': '30'}]))
+
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'pii_table': str(pii_table),
+                'BIDS': True}
+    assert process_study_surveys(Lochness, 'StudyA', workers=2) == 2
+
+    for subject_id in 'AB00001', 'AB00002':
+        proc = phoenix_root / 'GENERAL' / 'StudyA' / 'processed' / \
+                subject_id / 'surveys' / f'{subject_id}.StudyA.json'
+        assert json.loads(proc.read_text()) == [{'name': subject_id,
+                                                 'age': '30'}]
+
+
+def previous_process_record(instrument, pii_str_proc_dict, subject_id):
+    '''the per field loop used before PiiEngine, as a reference'''
+    processed_instrument = {}
+    for field_name, field_value in instrument.items():
+        for pii_label_string, process in pii_str_proc_dict.items():
+            if re.search(pii_label_string, field_name):
+                try:
+                    new_value = process_pii_string(field_value, process,
+                                                   subject_id)
+                except:
+                    new_value = 'check_process_pii_string'
+                processed_instrument[field_name] = new_value
+                break
+            else:
+                processed_instrument[field_name] = field_value
+    return processed_instrument
+
+
+def test_same_output_format_as_before(tmp_path):
+    pii_dict = dict(PII_DICT, date='change_date')
+    records = [{'name': 'john', 'age': '30', 'address': 'a',
+                'consent_date': '2021-01-02', 'visit_date': 'unknown'},
+               {'name': 'jane', 'age': '31', 'address': 'b',
+                'consent_date': '2021-02-03', 'visit_date': '2021-02-04'}]
+
+    json_loc = tmp_path / 'raw.json'
+    json_loc.write_text(json.dumps(records))
+    assert load_raw_return_proc_json(json_loc, pii_dict, 'AB00001') == \
+        json.dumps([previous_process_record(x, pii_dict, 'AB00001')
+                    for x in records]).encode()
+
+    # csv files have the same columns and first row as before, and the
+    # other rows are now processed the same way as the first one
+    csv_loc = tmp_path / 'raw.csv'
+    pd.DataFrame(records).to_csv(csv_loc, index=False)
+    df = load_raw_return_proc_csv(csv_loc, pii_dict, 'AB00001')
+    previous = [previous_process_record(x, pii_dict, 'AB00001')
+                for x in pd.read_csv(csv_loc).to_dict('records')]
+    lines = df.to_csv(index=False).splitlines()
+    expected = pd.DataFrame(previous).to_csv(index=False).splitlines()
+    assert lines == expected
+    assert df['name'].tolist() == ['AB00001', 'AB00001']
+
+
+def test_shuffle_maps_the_whole_alphabet():
+    for string_type in string.ascii_lowercase, string.ascii_uppercase:
+        shuffled = get_shuffle_dict_for_type(string_type, string_type)
+        assert len(shuffled) == len(string_type)
+        assert set(shuffled) <= set(string_type)
+
+    # the same character is always mapped to the same character
+    shuffled = get_shuffle_dict_for_type(string.digits, '1212')
+    assert shuffled[0] == shuffled[2] and shuffled[1] == shuffled[3]
+
+
+def test_pii_engine_shared_across_threads():
+    pii_dict = {f'label_{num}': 'remove' for num in range(50)}
+    engines = []
+
+    def get():
+        engines.append(get_pii_engine(pii_dict))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, engines))) == 1
@@ -8,7 +8,6 @@ from lochness.redcap import sync, initialize_metadata
 from lochness.redcap import get_run_sheets_for_datatypes, post_to_redcap, \
         deidentify_flag, iterate, redcap_projects
 from lochness.redcap.data_trigger_capture import save_post_from_redcap
-from lochness.redcap.data_trigger_capture import back_up_db
 
 import sys
 lochness_root = Path(lochness.__path__[0]).parent
@@ -0,0 +1,75 @@
+import json
+
+import pandas as pd
+
+import lochness.redcap as REDCap
+from lochness.functools import new_cycle
+
+
+class FakeSubject(object):
+    def __init__(self, metadata_csv):
+        self.metadata_csv = metadata_csv
+
+
+def test_record_batch(tmp_path):
+    new_cycle()
+    metadata_csv = tmp_path / 'metadata.csv'
+    pd.DataFrame({
+        'Active': [1, 1, 1, 1],
+        'Subject ID': ['AB00001', 'AB00002', 'AB00003', 'AB00004'],
+        'REDCap': ['redcap.Pronet:AB00003', 'redcap.Pronet:AB00001',
+                   'redcap.Pronet:AB00002', 'redcap.UPENN:AB00004'],
+        'Consent': ['2021-01-01'] * 4}).to_csv(metadata_csv, index=False)
+    subject = FakeSubject(str(metadata_csv))
+
+    # batch mode disabled by default
+    assert REDCap.record_batch({}, subject, 'redcap.Pronet', 'AB00001') \
+            is None
+
+    Lochness = {'redcap_batch_size': 2}
+    assert REDCap.record_batch(Lochness, subject, 'redcap.Pronet',
+                               'AB00002') == \
+            ('AB00001', 'ab00001', 'AB00002', 'ab00002')
+    assert REDCap.record_batch(Lochness, subject, 'redcap.Pronet',
+                               'AB00003') == ('AB00003', 'ab00003')
+    assert REDCap.record_batch(Lochness, subject, 'redcap.Pronet',
+                               'AB00004') is None
+
+
+def test_subject_records_from_a_single_batch_request(monkeypatch):
+    new_cycle()
+    response = [
+        {'chric_record_id': 'AB00001', 'chric_consent_date': '2021-01-01'},
+        {'chric_record_id': 'AB00001', 'chric_consent_date': ''},
+        {'chric_record_id': 'ab00002', 'chric_consent_date': '2021-02-01'},
+    ]
+    queries = []
+
+    def iter_records_from_redcap(api_url, data, debug_tup, alias=None):
+        queries.append(data)
+        return iter(json.loads(json.dumps(response)))
+
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap',
+                        iter_records_from_redcap)
+    batch = ('AB00001', 'ab00001', 'AB00002', 'ab00002')
+
+    records = REDCap.get_subject_records_from_batch(
+            'url', 'key', batch, 'chric_record_id', ('AB00001', 'ab00001'))
+    assert records == response[:2]
+
+    # records can be deidentified without changing the batch
+    records[0].pop('chric_consent_date')
+    records = REDCap.get_subject_records_from_batch(
+            'url', 'key', batch, 'chric_record_id', ('AB00001', 'ab00001'))
+    assert records == response[:2]
+
+    records = REDCap.get_subject_records_from_batch(
+            'url', 'key', batch, 'chric_record_id', ('AB00002', 'ab00002'))
+    assert records == response[2:]
+
+    assert len(queries) == 1
+    assert queries[0]['records[3]'] == 'ab00002'
+
+    records = REDCap.get_subject_records_from_batch(
+            'url', 'key', batch, 'chric_record_id', ('AB00005', 'ab00005'))
+    assert records == []
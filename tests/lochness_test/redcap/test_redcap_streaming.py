@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import lochness
+
+from lochness.redcap import iter_json_array, write_records_json, REDCapError
+
+RECORDS = [{'chric_record_id': 'AB00001', 'note': 'café – "quoted"'},
+           {'chric_record_id': 'AB00002', 'values': [1, 2.5, None, True]},
+           {'chric_record_id': 'AB00003', 'nested': {'a': '}]'}}]
+
+
+def chunked(content, size):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 100000])
+def test_iter_json_array_any_chunk_size(size):
+    content = json.dumps(RECORDS, indent=1, ensure_ascii=False) \
+        .encode('utf-8')
+    assert list(iter_json_array(chunked(content, size))) == RECORDS
+
+    assert list(iter_json_array(chunked(b' [ ] ', size))) == []
+    assert list(iter_json_array(chunked(b'[1, 23, 456]', size))) == \
+        [1, 23, 456]
+
+
+def test_iter_json_array_errors():
+    with pytest.raises(REDCapError):
+        list(iter_json_array([b'{"error": "You do not have permissions"}']))
+
+    # truncated responses
+    content = json.dumps(RECORDS).encode('utf-8')
+    with pytest.raises(REDCapError):
+        list(iter_json_array(chunked(content[:-1], 10)))
+    with pytest.raises(REDCapError):
+        list(iter_json_array(chunked(content[:40], 10)))
+
+    with pytest.raises(REDCapError):
+        list(iter_json_array([b'[{"a": 1}] [']))
+
+
+def test_write_records_json(tmp_path):
+    dst = tmp_path / 'AB00001.Pronet.json'
+
+    changed, crc = write_records_json(iter(RECORDS), dst)
+    assert changed
+    assert dst.read_bytes() == json.dumps(RECORDS).encode('utf-8')
+    assert crc == lochness.crc32file(dst)
+
+    mtime = dst.stat().st_mtime_ns
+    assert write_records_json(iter(RECORDS), dst) == (False, crc)
+    assert dst.stat().st_mtime_ns == mtime
+
+    # a known crc32 of the existing file is trusted
+    assert write_records_json(iter(RECORDS), dst, dst_crc=crc) == \
+        (False, crc)
+    assert write_records_json(iter(RECORDS), dst, dst_crc='0')[0]
+
+    assert write_records_json(RECORDS[:1], dst)[0]
+    assert json.loads(dst.read_text()) == RECORDS[:1]
+
+    assert write_records_json([], dst)[0]
+    assert dst.read_text() == '[]'
+
+    # no temporary files left behind
+    assert [x.name for x in tmp_path.iterdir()] == [dst.name]
@@ -0,0 +1,153 @@
+import collections as col
+import json
+from pathlib import Path
+
+import pandas as pd
+
+import lochness.redcap as REDCap
+from lochness import ratelimit
+from lochness.functools import new_cycle
+from lochness.redcap import extract_run_sheets, get_run_sheets_for_datatypes
+from lochness.redcap import RunSheetExtractor
+
+FIELD_FORMS = {'chric_record_id': 'informed_consent',
+               'chric_consent_date': 'informed_consent',
+               'chrmri_date': 'mri_run_sheet',
+               'chrmri_scanner': 'mri_run_sheet',
+               'chreeg_date': 'eeg_run_sheet'}
+
+Subject = col.namedtuple('Subject', ['study', 'id', 'redcap', 'metadata_csv',
+                                     'protected_folder', 'general_folder'])
+
+RECORDS = [
+    {'chric_record_id': 'AB00001', 'redcap_event_name': 'screening_arm_1',
+     'redcap_repeat_instrument': '', 'redcap_repeat_instance': '',
+     'chric_consent_date': '2021-01-01', 'informed_consent_complete': '2',
+     'chrmri_date': '', 'chrmri_scanner___1': '0',
+     'chrmri_scanner___2': '0', 'mri_run_sheet_complete': '',
+     'chreeg_date': '', 'eeg_run_sheet_complete': ''},
+    {'chric_record_id': 'AB00001', 'redcap_event_name': 'baseline_arm_1',
+     'redcap_repeat_instrument': '', 'redcap_repeat_instance': '',
+     'chric_consent_date': '', 'informed_consent_complete': '',
+     'chrmri_date': '2021-02-01', 'chrmri_scanner___1': '1',
+     'chrmri_scanner___2': '0', 'mri_run_sheet_complete': '2',
+     'chreeg_date': '2021-02-02', 'eeg_run_sheet_complete': '2'},
+    {'chric_record_id': 'AB00001', 'redcap_event_name': 'baseline_arm_1',
+     'redcap_repeat_instrument': 'mri_run_sheet',
+     'redcap_repeat_instance': 2,
+     'chric_consent_date': '', 'informed_consent_complete': '',
+     'chrmri_date': '2021-02-10', 'chrmri_scanner___1': '0',
+     'chrmri_scanner___2': '1', 'mri_run_sheet_complete': '1',
+     'chreeg_date': '', 'eeg_run_sheet_complete': ''},
+]
+
+
+def test_extract_run_sheets():
+    run_sheets = extract_run_sheets(RECORDS, FIELD_FORMS, 'chric_record_id')
+
+    assert run_sheets['speech_sampling_run_sheet'] == []
+    assert len(run_sheets['eeg_run_sheet']) == 1
+    assert len(run_sheets['mri_run_sheet']) == 2
+
+    mri_row = run_sheets['mri_run_sheet'][1]
+    assert list(mri_row) == [
+            'chric_record_id', 'redcap_event_name',
+            'redcap_repeat_instrument', 'redcap_repeat_instance',
+            'chrmri_date', 'chrmri_scanner___1', 'chrmri_scanner___2',
+            'mri_run_sheet_complete']
+    assert mri_row['redcap_repeat_instance'] == 2
+    assert mri_row['chrmri_scanner___2'] == '1'
+
+
+def test_run_sheets_extracted_while_streaming():
+    # a record with fewer keys first, as in a sparse export
+    records = [{k: v for k, v in RECORDS[1].items()
+                if not k.startswith('chrmri_scanner')}] + RECORDS
+
+    extractor = RunSheetExtractor(FIELD_FORMS, 'chric_record_id')
+    streamed = extractor.observe(iter(records))
+    assert next(streamed) == records[0]
+    assert list(streamed) == RECORDS
+    assert extractor.run_sheets() == \
+        extract_run_sheets(list(records), FIELD_FORMS, 'chric_record_id')
+
+    mri_rows = extractor.run_sheets()['mri_run_sheet']
+    assert mri_rows[0]['chrmri_scanner___1'] == ''
+    assert list(mri_rows[0]) == list(mri_rows[1])
+
+
+def test_run_sheets_written_only_when_changed(tmp_path, monkeypatch):
+    new_cycle()
+    monkeypatch.setattr(
+            REDCap, 'get_data_dictionary',
+            lambda *args, **kwargs: REDCap.DataDictionary(b'', FIELD_FORMS,
+                                                          frozenset()))
+    monkeypatch.setattr(
+            REDCap, 'post_to_redcap',
+            lambda *args, **kwargs: (_ for _ in ()).throw(AssertionError))
+
+    surveys = tmp_path / 'raw' / 'AB00001' / 'surveys'
+    surveys.mkdir(parents=True)
+    json_path = surveys / 'AB00001.Pronet.json'
+    json_path.write_text(json.dumps(RECORDS))
+
+    get_run_sheets_for_datatypes('url', 'key', 'AB00001', 'chric_record_id',
+                                 json_path)
+
+    mri_dir = tmp_path / 'raw' / 'AB00001' / 'mri'
+    assert sorted(x.name for x in mri_dir.glob('*.csv')) == [
+            'AB00001.Pronet.Run_sheet_mri_1.csv',
+            'AB00001.Pronet.Run_sheet_mri_2.csv']
+    run_sheet_df = pd.read_csv(mri_dir / 'AB00001.Pronet.Run_sheet_mri_1.csv',
+                               index_col=0)
+    assert run_sheet_df.loc['chrmri_date', 'field_value'] == '2021-02-01'
+
+    eeg_file = tmp_path / 'raw' / 'AB00001' / 'eeg' / \
+        'AB00001.Pronet.Run_sheet_eeg_1.csv'
+    mtime = eeg_file.stat().st_mtime_ns
+    get_run_sheets_for_datatypes('url', 'key', 'AB00001', 'chric_record_id',
+                                 json_path, content_dict_list=RECORDS)
+    assert eeg_file.stat().st_mtime_ns == mtime
+
+
+def test_data_dictionary_fetched_before_the_stream(tmp_path, monkeypatch):
+    new_cycle()
+    ratelimit.configure({'rate_limits': {'redcap.Pronet': {
+        'max_in_flight': 1}}})
+    limiter = ratelimit.get('redcap.Pronet')
+
+    def iter_records_from_redcap(api_url, data, debug_tup, alias=None):
+        with ratelimit.get(alias):
+            yield from RECORDS
+
+    def get_data_dictionary(api_url, api_key, alias=None):
+        # the slot of a single request limit must not be held by the stream
+        assert limiter._slots.acquire(blocking=False)
+        limiter._slots.release()
+        return REDCap.DataDictionary(b'', FIELD_FORMS, frozenset())
+
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap',
+                        iter_records_from_redcap)
+    monkeypatch.setattr(REDCap, 'get_data_dictionary', get_data_dictionary)
+
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'BIDS': False,
+                'redcap_id_colname': 'chric_record_id',
+                'redcap': {'StudyA': {'deidentify': True}},
+                'keyring': {'lochness': {'REDCAP': {'StudyA': {
+                                'redcap.Pronet': ['Pronet']}}},
+                            'redcap.Pronet': {
+                                'URL': 'https://redcap',
+                                'API_TOKEN': {'Pronet': 'key'}}}}
+    subject = Subject('StudyA', 'AB00001', {'redcap.Pronet': ['AB00001']},
+                      str(tmp_path / 'metadata.csv'),
+                      str(tmp_path / 'PHOENIX/PROTECTED/StudyA/AB00001'),
+                      str(tmp_path / 'PHOENIX/GENERAL/StudyA/AB00001'))
+    try:
+        REDCap.sync(Lochness, subject)
+    finally:
+        ratelimit.configure({})
+
+    json_path = Path(subject.protected_folder) / 'surveys' / 'raw' / \
+        'AB00001.Pronet.json'
+    assert json.loads(json_path.read_text()) == RECORDS
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from lochness.redcap import data_trigger_capture, det_log, det_notify
+
+
+BODY = 'redcap_url=https%3A%2F%2Fredcap.server%2F&' \
+       'project_url=https%3A%2F%2Fredcap.server%2Fredcap%2F&' \
+       'project_id=123&username=admin&record={record}&' \
+       'instrument=inclusionexclusion_criteria_review'
+
+
+@pytest.fixture
+def listener(tmp_path):
+    with det_notify.Listener(tmp_path / 'det.sock',
+                             batch_seconds=0.2) as socket_listener:
+        httpd = data_trigger_capture.make_server(
+                tmp_path / 'det.csv', port=0,
+                notify_socket=tmp_path / 'det.sock')
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        yield httpd, socket_listener
+        httpd.shutdown()
+        httpd.server_close()
+        httpd.writer.stop()
+
+
+def test_concurrent_triggers(listener, tmp_path):
+    httpd, socket_listener = listener
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+
+    def post(num):
+        return requests.post(url, data=BODY.format(record=f'AB{num:05d}'),
+                             timeout=10).status_code
+
+    with ThreadPoolExecutor(10) as pool:
+        assert set(pool.map(post, range(200))) == {200}
+    httpd.writer.flush()
+
+    records = [x['record'] for x in
+               det_log.read_entries(tmp_path / 'det.jsonl')]
+    assert sorted(records) == [f'AB{x:05d}' for x in range(200)]
+    assert len(socket_listener.wait(1)) > 0
+
+
+def test_malformed_trigger(listener):
+    httpd, _ = listener
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    assert requests.post(url, data='redcap_url=x', timeout=10) \
+        .status_code == 400
+    assert requests.post(url, data='hello', timeout=10).status_code == 200
@@ -0,0 +1,54 @@
+import json
+
+import lochness.redcap as REDCap
+from lochness.functools import new_cycle
+from lochness.redcap import upenn_subject_ids
+
+RECORDS = [
+    {'record_id': '1', 'session_subid': 'AB00001_1', 'score': '10'},
+    {'record_id': '1', 'session_subid': '', 'score': '11'},
+    {'record_id': '2', 'session_subid': 'ab00002', 'score': '20'},
+    {'record_id': '3', 'session_subid': 'AB00001=2', 'score': '30'},
+    {'record_id': '4', 'session_subid': 'Ab00001_1', 'score': '40'},
+    {'record_id': '5', 'session_subid': 'test', 'score': '50'},
+]
+
+
+def test_upenn_subject_ids():
+    assert upenn_subject_ids('AB00001') == {'AB00001'}
+    assert upenn_subject_ids('ab00001') == {'AB00001'}
+    assert upenn_subject_ids('AB00001_1') == {'AB00001'}
+    assert upenn_subject_ids('site_ab00001=3') == {'AB00001'}
+    assert upenn_subject_ids('AB00001_0') == set()
+    assert upenn_subject_ids('xAB00001') == set()
+    assert upenn_subject_ids('Ab00001') == set()
+    assert upenn_subject_ids('') == set()
+
+
+def test_upenn_snapshot_single_query(monkeypatch):
+    new_cycle()
+    queries = []
+
+    def iter_records_from_redcap(api_url, data, debug_tup, alias=None):
+        queries.append(data)
+        return iter(json.loads(json.dumps(RECORDS)))
+
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap',
+                        iter_records_from_redcap)
+
+    records = REDCap.get_upenn_subject_records('url', 'key', 'AB00001',
+                                               alias='redcap.UPENN')
+    assert [x['score'] for x in records] == ['10', '11', '30']
+
+    records[0]['score'] = 'changed'
+    records = REDCap.get_upenn_subject_records('url', 'key', 'AB00001',
+                                               alias='redcap.UPENN')
+    assert records[0]['score'] == '10'
+
+    records = REDCap.get_upenn_subject_records('url', 'key', 'AB00002',
+                                               alias='redcap.UPENN')
+    assert [x['score'] for x in records] == ['20']
+
+    assert REDCap.get_upenn_subject_records('url', 'key', 'AB00003') == []
+    assert len(queries) == 2  # one per alias
+    assert 'filterLogic' not in queries[0]
@@ -0,0 +1,96 @@
+import json
+
+import lochness.redcap as REDCap
+from lochness.functools import new_cycle
+from lochness.redcap import merge_records
+
+
+def watermark_Lochness(tmp_path, enabled=True):
+    return {'phoenix_root': str(tmp_path / 'PHOENIX'),
+            'redcap_id_colname': 'chric_record_id',
+            'redcap_watermarks': enabled}
+
+
+def test_merge_records():
+    records = [
+        {'chric_record_id': 'AB00001', 'redcap_event_name': 'screening',
+         'redcap_repeat_instrument': '', 'redcap_repeat_instance': '',
+         'value': 'a'},
+        {'chric_record_id': 'AB00001', 'redcap_event_name': 'baseline',
+         'redcap_repeat_instrument': '', 'redcap_repeat_instance': '',
+         'value': 'b'},
+    ]
+    updates = [
+        {'chric_record_id': 'AB00001', 'redcap_event_name': 'baseline',
+         'redcap_repeat_instrument': '', 'redcap_repeat_instance': '',
+         'value': 'B'},
+        {'chric_record_id': 'AB00001', 'redcap_event_name': 'baseline',
+         'redcap_repeat_instrument': 'mri_run_sheet',
+         'redcap_repeat_instance': 2, 'value': 'c'},
+    ]
+
+    merged = merge_records(records, updates, 'chric_record_id')
+    assert [x['value'] for x in merged] == ['a', 'B', 'c']
+
+
+def test_watermark_mode_off(tmp_path, monkeypatch):
+    new_cycle()
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap', None)
+    Lochness = watermark_Lochness(tmp_path, enabled=False)
+    assert REDCap.get_modified_subject_records(
+            Lochness, 'url', 'key', 'redcap.Pronet', 'Pronet',
+            'AB00001') is None
+    REDCap.commit_watermarks(Lochness)
+    assert REDCap.get_watermark(Lochness, 'redcap.Pronet', 'Pronet') is None
+
+
+def test_watermarks_committed_only_on_success(tmp_path, monkeypatch):
+    new_cycle()
+    queries = []
+
+    def iter_records_from_redcap(api_url, data, debug_tup, alias=None):
+        queries.append(data)
+        return iter([{'chric_record_id': 'ab00001', 'value': 'new'},
+                     {'chric_record_id': 'AB00002', 'value': 'new'}])
+
+    monkeypatch.setattr(REDCap, 'iter_records_from_redcap',
+                        iter_records_from_redcap)
+    Lochness = watermark_Lochness(tmp_path)
+
+    # first cycle, without a watermark yet
+    args = (Lochness, 'url', 'key', 'redcap.Pronet', 'Pronet')
+    assert REDCap.get_modified_subject_records(*args, 'AB00001') is None
+    REDCap.commit_watermarks(Lochness, False)
+    assert REDCap.get_watermark(Lochness, 'redcap.Pronet', 'Pronet') is None
+
+    assert REDCap.get_modified_subject_records(*args, 'AB00001') is None
+    REDCap.commit_watermarks(Lochness, True)
+    watermark = REDCap.get_watermark(Lochness, 'redcap.Pronet', 'Pronet')
+    assert watermark is not None
+    assert queries == []
+
+    # next cycle, a single export of the records modified since
+    new_cycle()
+    assert REDCap.get_modified_subject_records(*args, 'AB00001') == \
+        [{'chric_record_id': 'ab00001', 'value': 'new'}]
+    assert REDCap.get_modified_subject_records(*args, 'AB00003') == []
+    assert len(queries) == 1
+    assert 'dateRangeBegin' in queries[0]
+
+    REDCap.commit_watermarks(Lochness, False)
+    assert REDCap.get_watermark(Lochness, 'redcap.Pronet', 'Pronet') == \
+        watermark
+
+
+def test_watermarks_per_shard():
+    import collections as col
+    import lochness.shard as shard
+    FakeSubject = col.namedtuple('FakeSubject', ['study', 'id'])
+    subject = FakeSubject('PronetLA', 'LA00001')
+
+    assert REDCap.watermark_project({}, 'Pronet', subject) == 'Pronet'
+
+    Lochness = {'shard': shard.Shard(1, 3)}
+    index = shard.shard_of('PronetLA', 'LA00001', 3)
+    assert REDCap.watermark_project(Lochness, 'Pronet', subject) == \
+        f'Pronet#shard{index}of3'
@@ -0,0 +1,59 @@
+import time
+import collections as col
+
+import pandas as pd
+
+import lochness.state as state
+import lochness.scheduler as scheduler
+
+
+FakeSubject = col.namedtuple('FakeSubject',
+                             ['study', 'id', 'consent', 'redcap'])
+
+
+def get_lochness(tmp_path, det_rows):
+    det_csv = tmp_path / 'det.csv'
+    pd.DataFrame(det_rows, columns=['record', 'timestamp']).to_csv(det_csv)
+    return {'phoenix_root': str(tmp_path / 'PHOENIX'),
+            'state_db': str(tmp_path / 'state.db'),
+            'redcap': {'StudyA': {'data_entry_trigger_csv': str(det_csv)}}}
+
+
+def test_activity_signals(tmp_path):
+    now = time.time()
+    Lochness = get_lochness(tmp_path, [['AB00001', now - 100],
+                                       ['ab00001', now - 50]])
+    store = state.get(Lochness)
+    store.put('mindlamp', 'AB00001',
+              'U1234_StudyA_activity_2022_03_04.json', local_hash='a')
+    store.put('mindlamp', 'AB00001',
+              'U1234_StudyA_sensor_2022_03_05.json', local_hash='b')
+
+    subject = FakeSubject('StudyA', 'AB00001', '2022-01-01',
+                          {'redcap.StudyA': ['AB00001']})
+    signals = scheduler.activity_signals(
+            Lochness, subject, {'AB00001': now - 100, 'ab00001': now - 50})
+    assert signals['data_entry_trigger'] == now - 50
+    assert signals['mindlamp'] == pd.Timestamp('2022-03-05',
+                                               tz='UTC').timestamp()
+    assert now - 5 < signals['new_data'] <= time.time()
+    assert 'consent' in signals
+
+
+def test_prioritize(tmp_path):
+    now = time.time()
+    Lochness = get_lochness(tmp_path, [['AB00003', now - 10],
+                                       ['AB00002', now - 1000]])
+    subjects = [
+        FakeSubject('StudyA', 'AB00001', '2020-01-01', {}),
+        FakeSubject('StudyA', 'AB00002', '2020-01-01',
+                    {'redcap.StudyA': ['AB00002']}),
+        FakeSubject('StudyA', 'AB00003', '2020-01-01',
+                    {'redcap.StudyA': ['AB00003']}),
+        FakeSubject('StudyA', 'AB00004', None, {}),
+        FakeSubject('StudyA', 'AB00005', '2021-01-01', {}),
+        FakeSubject('StudyA', 'AB00006', None, {}),
+    ]
+    ordered = scheduler.prioritize(Lochness, subjects)
+    assert [x.id for x in ordered] == ['AB00003', 'AB00002', 'AB00005',
+                                       'AB00001', 'AB00004', 'AB00006']
@@ -0,0 +1,138 @@
+import sys
+import argparse
+import datetime as dt
+from pathlib import Path
+
+import pytest
+
+import lochness
+import lochness.executor as executor
+import lochness.scheduler as scheduler
+
+sys.path.append(str(Path(lochness.__path__[0]).parent / 'scripts'))
+import sync
+
+
+# 2022-03-07 is a Monday
+MONDAY_0300 = dt.datetime(2022, 3, 7, 3, 0)
+MONDAY_1200 = dt.datetime(2022, 3, 7, 12, 0)
+SATURDAY_0300 = dt.datetime(2022, 3, 12, 3, 0)
+
+
+def test_parse_window():
+    window = scheduler.parse_window('Mon-Fri 01:00-05:00')
+    assert window.days == {0, 1, 2, 3, 4}
+    assert window.start == dt.time(1, 0)
+    assert scheduler.parse_window('Fri-Mon 01:00-05:00').days == \
+        {4, 5, 6, 0}
+    assert scheduler.parse_window('Sat,Sun 1:00-5:00').days == {5, 6}
+    assert scheduler.parse_window('22:00-02:00').days == set(range(7))
+    for text in 'Mon-Fri', 'Funday 01:00-02:00', 'Mon 25:00-26:00':
+        with pytest.raises(scheduler.ScheduleError):
+            scheduler.parse_window(text)
+
+
+def test_in_window():
+    window = scheduler.parse_window('Mon-Fri 01:00-05:00')
+    assert scheduler.in_window(window, MONDAY_0300)
+    assert not scheduler.in_window(window, MONDAY_1200)
+    assert not scheduler.in_window(window, SATURDAY_0300)
+
+    # past midnight, the window belongs to the day it starts
+    window = scheduler.parse_window('Sun 22:00-02:00')
+    assert scheduler.in_window(window, dt.datetime(2022, 3, 6, 23, 0))
+    assert scheduler.in_window(window, dt.datetime(2022, 3, 7, 1, 0))
+    assert not scheduler.in_window(window, dt.datetime(2022, 3, 8, 1, 0))
+
+
+def test_schedule(tmp_path):
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'schedule': {
+                    'mindlamp': {'interval': 3600},
+                    'xnat': {'interval': 86400,
+                             'windows': ['Mon-Fri 01:00-05:00']}}}
+    schedule = scheduler.Schedule(Lochness)
+    sources = ['box', 'mindlamp', 'xnat']
+
+    assert schedule.due(sources, MONDAY_0300) == sources
+    assert schedule.due(sources, MONDAY_1200) == ['box', 'mindlamp']
+
+    schedule.mark_run(['box', 'mindlamp', 'xnat'], MONDAY_0300.timestamp())
+    now = MONDAY_0300 + dt.timedelta(minutes=30)
+    assert schedule.due(sources, now) == ['box']
+    assert schedule.due(sources, now + dt.timedelta(hours=1)) == \
+        ['box', 'mindlamp']
+
+    # mindlamp is due in 30 minutes, before the poll interval
+    assert schedule.sleep_seconds(sources, 86400, now) == 1800
+    # xnat is next due on Tuesday at 03:00, within its window
+    assert schedule.sleep_seconds(['xnat'], 10 ** 6, now) == \
+        (dt.datetime(2022, 3, 8, 3, 0) - now).total_seconds()
+
+    # a new Schedule reads when sources ran from the state store
+    assert scheduler.Schedule(Lochness).due(sources, now) == ['box']
+
+
+def test_unknown_schedule_fields(tmp_path):
+    with pytest.raises(scheduler.ScheduleError):
+        scheduler.Schedule({'schedule': {'box': {'every': 10}}})
+
+
+def test_windows_without_an_interval(tmp_path):
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'poll_interval': 600,
+                'schedule': {'xnat': {'windows': ['Mon-Sun 00:00-23:59']}}}
+    schedule = scheduler.Schedule(Lochness)
+    schedule.mark_run(['xnat'], MONDAY_0300.timestamp())
+    assert schedule.due(['xnat'], MONDAY_0300) == []
+    assert schedule.sleep_seconds(['xnat'], 86400, MONDAY_0300) == 600
+
+    del Lochness['poll_interval']
+    with pytest.raises(scheduler.ScheduleError):
+        scheduler.Schedule(Lochness)
+    with pytest.raises(scheduler.ScheduleError):
+        scheduler.SourceSchedule(0)
+
+
+def test_transfer_runs_when_no_source_is_due(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sync, 'pull',
+                        lambda args, *x: calls.append(('pull', args.source))
+                        or [])
+    monkeypatch.setattr(sync, 'transfer',
+                        lambda args, Lochness: calls.append(('transfer',)))
+    monkeypatch.setattr(sync, 'lochness_to_lochness_transfer_receive_sftp',
+                        lambda Lochness: calls.append(('receive',)))
+
+    args = argparse.Namespace(lochness_sync_receive=False, shard=None,
+                              hdd=[], source=[sync.REDCap, sync.Box],
+                              input_sources=['redcap', 'box'])
+    assert sync.do(args, {}, []) == []
+    assert calls == [('transfer',)]
+
+    calls.clear()
+    assert sync.do(args, {}, ['box']) == ['box']
+    assert calls == [('pull', [sync.Box]), ('transfer',)]
+
+    calls.clear()
+    args.lochness_sync_receive = True
+    sync.do(args, {}, [])
+    assert calls == [('receive',)]
+
+
+def test_only_completed_sources_are_marked_run(monkeypatch):
+    results = [
+        executor.Result('box', 'StudyA', 'AB00001', True, 1.0),
+        executor.Result('redcap', 'StudyA', 'AB00001', True, 1.0),
+        executor.Result('redcap', 'StudyA', 'AB00002', False, 0.0,
+                        skipped=True),
+        executor.Result('xnat', 'StudyA', 'AB00001', False, 1.0)]
+    monkeypatch.setattr(sync, 'pull', lambda *x: results)
+    monkeypatch.setattr(sync, 'transfer', lambda args, Lochness: None)
+
+    args = argparse.Namespace(
+            lochness_sync_receive=False, shard=None, hdd=[],
+            source=[sync.Box, sync.REDCap, sync.XNAT, sync.Mindlamp],
+            input_sources=['box', 'redcap', 'xnat', 'mindlamp'])
+    assert sync.do(args, {}, ['box', 'mindlamp', 'redcap', 'xnat']) == \
+        ['box', 'mindlamp']
@@ -0,0 +1,102 @@
+import os
+import time
+import collections as col
+
+import pytest
+
+import lochness.shard as shard
+
+
+FakeSubject = col.namedtuple('FakeSubject', ['study', 'id'])
+
+
+def test_parse():
+    assert shard.parse('2/3') == shard.Shard(2, 3)
+    for value in '0/3', '4/3', '1', 'a/b':
+        with pytest.raises(shard.ShardError):
+            shard.parse(value)
+
+
+def test_shards_cover_subjects_once():
+    subjects = [FakeSubject(study, f'{study[-2:]}{num:05d}')
+                for study in ['PronetLA', 'PronetYA']
+                for num in range(200)]
+    selected = [shard.select(subjects, [index], 3) for index in (1, 2, 3)]
+    assert sorted(sum(selected, []), key=str) == sorted(subjects, key=str)
+    assert all(len(x) > 100 for x in selected)
+
+    # stable regardless of the order of the subjects
+    assert shard.select(list(reversed(subjects)), [1], 3) == \
+        list(reversed(selected[0]))
+    assert shard.shard_of('PronetLA', 'LA00001', 3) == \
+        shard.shard_of('PronetLA', 'LA00001', 3)
+
+
+def test_leases_take_over_expired_shards(tmp_path):
+    node1 = shard.Leases(tmp_path, shard.Shard(1, 2), ttl=60, node='node1')
+    node2 = shard.Leases(tmp_path, shard.Shard(2, 2), ttl=60, node='node2')
+
+    # a shard never leased is left to its node, which may be starting
+    assert node1.acquire() == [1]
+    node1.started -= 60
+    assert node1.acquire() == [1, 2]  # node2 did not start within a ttl
+    assert node2.acquire() == [2]     # node2 takes its own shard back
+    node1.renew()
+    assert node1.held == {1}
+    assert node1.acquire() == [1]
+
+    # node2 stops, and its lease is expired right away
+    node2.release()
+    assert node2.read(2)['expires'] == 0
+    assert node1.acquire() == [1, 2]
+    assert node1.read(2)['node'] == 'node1'
+    node1.release()
+
+
+def test_subjects_of_a_shard_taken_back_are_skipped(tmp_path):
+    node1 = shard.Leases(tmp_path, shard.Shard(1, 2), ttl=60, node='node1')
+    node2 = shard.Leases(tmp_path, shard.Shard(2, 2), ttl=60, node='node2')
+    node1.started -= 60
+    assert node1.acquire() == [1, 2]
+
+    synced = []
+    def sync(Lochness, subject, dry=False):
+        synced.append(subject.id)
+
+    own = node1.while_held(1, sync)
+    foreign = node1.while_held(2, sync)
+    foreign({}, FakeSubject('StudyA', 'AB00001'))
+
+    # node2 comes back in the middle of the cycle
+    node2.acquire()
+    node1.renew()
+    foreign({}, FakeSubject('StudyA', 'AB00002'))
+    own({}, FakeSubject('StudyA', 'AB00003'))
+    assert synced == ['AB00001', 'AB00003']
+    node1.release()
+    node2.release()
+
+
+def test_is_primary():
+    assert shard.is_primary(None, None)
+    assert shard.is_primary(shard.Shard(1, 3), [1])
+    assert not shard.is_primary(shard.Shard(2, 3), [2])
+    # the node which took the primary shard over
+    assert shard.is_primary(shard.Shard(2, 3), [1, 2])
+
+
+def test_leases_not_taken_while_valid(tmp_path):
+    node1 = shard.Leases(tmp_path, shard.Shard(1, 2), ttl=0.1, node='node1')
+    node2 = shard.Leases(tmp_path, shard.Shard(2, 2), ttl=60, node='node2')
+    node2.acquire()
+    assert node1.acquire() == [1]
+
+    # a lock left by a dead node is removed once it is stale
+    lock = node1._path(2).with_suffix('.lock')
+    lock.touch()
+    assert not node1._claim(2, force=True)
+    old = time.time() - shard.STALE_LOCK_SECONDS - 1
+    os.utime(lock, (old, old))
+    assert node1._claim(2, force=True)
+    node1.release()
+    node2.release()
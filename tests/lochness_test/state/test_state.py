@@ -0,0 +1,124 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+from lochness import state
+
+
+def test_put_and_get(tmp_path):
+    store = state.StateStore(tmp_path / 'state.db')
+    assert store.get('xnat', 'subject01', 'EXP01') is None
+
+    store.put('xnat', 'subject01', 'EXP01', remote_version='2021-01-01')
+    record = store.get('xnat', 'subject01', 'EXP01')
+    assert record.remote_version == '2021-01-01'
+    assert record.local_hash is None
+
+    assert store.is_current('xnat', 'subject01', 'EXP01', '2021-01-01')
+    assert not store.is_current('xnat', 'subject01', 'EXP01', '2021-02-01')
+    assert not store.is_current('xnat', 'subject02', 'EXP01', '2021-01-01')
+
+    # tables are separate for each source
+    assert store.get('box', 'subject01', 'EXP01') is None
+
+
+def test_put_replaces_and_stats_local_file(tmp_path):
+    local_file = tmp_path / 'data.json'
+    local_file.write_text('{}')
+
+    store = state.StateStore(tmp_path / 'state.db')
+    store.put('mindlamp', 'subject01', 'data.json', local_hash='a')
+    store.put('mindlamp', 'subject01', 'data.json', local_hash='b',
+              local_path=local_file)
+
+    record = store.get('mindlamp', 'subject01', 'data.json')
+    assert record.local_hash == 'b'
+    assert record.local_size == 2
+    assert record.local_mtime == local_file.stat().st_mtime
+
+    store.delete('mindlamp', 'subject01', 'data.json')
+    assert store.get('mindlamp', 'subject01', 'data.json') is None
+
+
+def test_local_hash_only_valid_for_unchanged_file(tmp_path):
+    local_file = tmp_path / 'AB00001.Pronet.json'
+    local_file.write_text('[]')
+
+    store = state.StateStore(tmp_path / 'state.db')
+    assert store.local_hash('redcap', 'AB00001', local_file.name,
+                            local_file) is None
+
+    store.put('redcap', 'AB00001', local_file.name, local_hash='crc',
+              local_path=local_file)
+    assert store.local_hash('redcap', 'AB00001', local_file.name,
+                            local_file) == 'crc'
+
+    local_file.write_text('[{}]')
+    assert store.local_hash('redcap', 'AB00001', local_file.name,
+                            local_file) is None
+
+    local_file.unlink()
+    assert store.local_hash('redcap', 'AB00001', local_file.name,
+                            local_file) is None
+
+
+def test_persistent_across_stores(tmp_path):
+    state.StateStore(tmp_path / 'state.db').put(
+            'box', 'subject01', 12345, remote_version='sha1')
+
+    store = state.StateStore(tmp_path / 'state.db')
+    assert store.is_current('box', 'subject01', '12345', 'sha1')
+
+
+def test_invalid_source_name(tmp_path):
+    store = state.StateStore(tmp_path / 'state.db')
+    with pytest.raises(state.StateError):
+        store.get('box; DROP TABLE box', 'subject01', '1')
+
+
+def test_shared_between_threads(tmp_path):
+    store = state.StateStore(tmp_path / 'state.db')
+
+    def put(n):
+        for i in range(20):
+            store.put('daris', f'subject{n}', f'uid{i}', remote_version=i)
+
+    threads = [threading.Thread(target=put, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for n in range(4):
+        assert store.get('daris', f'subject{n}', 'uid19').remote_version \
+                == '19'
+
+
+def test_get_store_location(tmp_path):
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX')}
+    store = state.get(Lochness)
+    assert Path(store.path) == tmp_path / '.lochness_state.db'
+    assert state.get(Lochness) is store
+
+    Lochness['state_db'] = str(tmp_path / 'other.db')
+    assert Path(state.get(Lochness).path) == tmp_path / 'other.db'
+
+
+def test_sharded_store_location(tmp_path, monkeypatch):
+    monkeypatch.setattr(state, 'LOCAL_STATE_DIR', str(tmp_path / 'local'))
+    Lochness = {'phoenix_root': str(tmp_path / 'PHOENIX'),
+                'shard': (1, 2)}
+    path = state.state_db_path(Lochness)
+    assert path.parent == tmp_path / 'local'
+    assert Path(state.get(Lochness).path) == path
+
+    # a database on the shared PHOENIX mount is refused
+    for state_db in tmp_path / '.lochness_state.db', \
+            tmp_path / 'PHOENIX' / 'GENERAL' / 'state.db':
+        Lochness['state_db'] = str(state_db)
+        with pytest.raises(state.StateError):
+            state.state_db_path(Lochness)
+
+    Lochness['state_db'] = str(tmp_path / 'local' / 'node1.db')
+    assert state.state_db_path(Lochness) == tmp_path / 'local' / 'node1.db'
@@ -0,0 +1,12 @@
+import hashlib
+
+from lochness.utils.checksum import get_sha
+
+
+def test_get_sha_reads_the_whole_file(tmp_path):
+    content = b'a' * 65536 + b'b' * 100000
+    (tmp_path / 'a.json').write_bytes(content)
+    (tmp_path / 'b.json').write_bytes(b'a' * 65536 + b'c' * 100000)
+
+    assert get_sha(tmp_path / 'a.json') == hashlib.sha256(content).hexdigest()
+    assert get_sha(tmp_path / 'a.json') != get_sha(tmp_path / 'b.json')
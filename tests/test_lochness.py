@@ -33,6 +33,11 @@ class SyncArgs(object):
         self.dry = False
         self.rsync = False
         self.s3 = False
+        self.workers = 1
+        self.max_per_source = None
+        self.shard = None
+        self.shard_leases = False
+        self.prioritize = False
 
         self.source = [SOURCES[x] for x in self.source]
     def __str__(self):